@@ -19,6 +19,7 @@ import logging
 import requests
 
 from oslo.config import cfg
+from akanda.rug import stats
 from akanda.rug.openstack.common import jsonutils
 
 AKANDA_ULA_PREFIX = 'fdca:3ba5:a17a:acda::/64'
@@ -41,6 +42,7 @@ def _get_proxyless_session():
     return s
 
 
+@stats.timed('appliance')
 def is_alive(host, port):
     path = AKANDA_BASE_PATH + 'firewall/rules'
     try:
@@ -53,6 +55,7 @@ def is_alive(host, port):
     return False
 
 
+@stats.timed('appliance')
 def get_interfaces(host, port):
     path = AKANDA_BASE_PATH + 'system/interfaces'
     s = _get_proxyless_session()
@@ -60,6 +63,7 @@ def get_interfaces(host, port):
     return r.json().get('interfaces', [])
 
 
+@stats.timed('appliance')
 def update_config(host, port, config_dict):
     path = AKANDA_BASE_PATH + 'system/config'
     headers = {'Content-type': 'application/json'}
@@ -77,6 +81,7 @@ def update_config(host, port, config_dict):
         return r.json()
 
 
+@stats.timed('appliance')
 def read_labels(host, port):
     path = AKANDA_BASE_PATH + 'firewall/labels'
     s = _get_proxyless_session()
@@ -107,7 +107,7 @@ def load_provider_rules(path):
     try:
         return jsonutils.load(open(path))
     except:  # pragma nocover
-        LOG.exception('unable to open provider rules: %s' % path)
+        LOG.exception('unable to open provider rules: %s', path)
 
 
 def generate_network_config(client, router, interfaces):
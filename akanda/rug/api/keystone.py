@@ -0,0 +1,243 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Keystone token shared by all of the API clients.
+
+Every worker thread has its own neutron and nova clients, because the
+clients are not thread-safe. Instead of letting each of them
+authenticate on its own, they get their token from a TokenCache that
+is shared by all of the threads in the process. Worker processes
+inherit the token fetched by the parent, and when a cache file is
+configured the processes also share the tokens they fetch later.
+"""
+
+import contextlib
+import fcntl
+import logging
+import os
+import threading
+
+import requests
+
+from akanda.rug.openstack.common import jsonutils
+from akanda.rug.openstack.common import timeutils
+
+LOG = logging.getLogger(__name__)
+
+# Tokens are refreshed this many seconds before keystone says they
+# expire, so a request is not sent with a token that is about to go
+# bad.
+EXPIRY_WINDOW = 300
+
+
+class Token(object):
+    def __init__(self, id_, expires, endpoints):
+        self.id = id_
+        self.expires = expires
+        self.endpoints = endpoints
+
+    def is_expiring(self):
+        return timeutils.is_soon(self.expires, EXPIRY_WINDOW)
+
+    def endpoint_for(self, service_type):
+        return self.endpoints[service_type]
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'expires': timeutils.isotime(self.expires),
+            'endpoints': self.endpoints,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(
+            d['id'],
+            timeutils.normalize_time(timeutils.parse_isotime(d['expires'])),
+            d['endpoints'],
+        )
+
+    @classmethod
+    def from_access(cls, access, region):
+        """Build a Token from the 'access' part of a keystone v2 response.
+        """
+        endpoints = {}
+        for service in access.get('serviceCatalog', []):
+            for ep in service['endpoints']:
+                if region and ep.get('region') != region:
+                    continue
+                endpoints[service['type']] = ep['publicURL'].rstrip('/')
+                break
+        return cls.from_dict({
+            'id': access['token']['id'],
+            'expires': access['token']['expires'],
+            'endpoints': endpoints,
+        })
+
+
+class TokenCache(object):
+    """Hold the keystone token used by all of the clients in a process.
+
+    Only one caller at a time refreshes the token. Callers that were
+    waiting for the refresh use the new token instead of asking
+    keystone for one of their own.
+    """
+
+    def __init__(self, conf, token=None):
+        self.conf = conf
+        self._token = token
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get(self, stale_token_id=None):
+        """Return a usable token.
+
+        :param stale_token_id: The id of a token that was rejected, so
+                               it should not be returned again.
+        :type stale_token_id: str
+        """
+        token = self._token
+        if self._usable(token, stale_token_id):
+            return token
+        with self._lock:
+            # Someone else may have refreshed the token while we were
+            # waiting for the lock.
+            if self._usable(self._token, stale_token_id):
+                return self._token
+            with self._file_lock():
+                token = self._load()
+                if not self._usable(token, stale_token_id):
+                    token = self._authenticate()
+                    self._save(token)
+            self._token = token
+        return token
+
+    @staticmethod
+    def _usable(token, stale_token_id):
+        return (token is not None and
+                token.id != stale_token_id and
+                not token.is_expiring())
+
+    def _authenticate(self):
+        LOG.debug('requesting a new token from %s', self.conf.auth_url)
+        body = {
+            'auth': {
+                'passwordCredentials': {
+                    'username': self.conf.admin_user,
+                    'password': self.conf.admin_password,
+                },
+                'tenantName': self.conf.admin_tenant_name,
+            },
+        }
+        r = requests.post(
+            self.conf.auth_url.rstrip('/') + '/tokens',
+            data=jsonutils.dumps(body),
+            headers={'Content-type': 'application/json'},
+            timeout=30,
+        )
+        r.raise_for_status()
+        return Token.from_access(r.json()['access'], self.conf.auth_region)
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        "Keep other processes from refreshing the token at the same time."
+        if not self.conf.auth_token_cache_file:
+            yield
+            return
+        with open(self.conf.auth_token_cache_file + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load(self):
+        if not self.conf.auth_token_cache_file:
+            return None
+        try:
+            with open(self.conf.auth_token_cache_file, 'r') as f:
+                return Token.from_dict(jsonutils.loads(f.read()))
+        except (IOError, ValueError, KeyError) as e:
+            LOG.debug('could not read cached token: %s', e)
+            return None
+
+    def _save(self, token):
+        if not self.conf.auth_token_cache_file:
+            return
+        filename = self.conf.auth_token_cache_file
+        tmpname = '%s.%d' % (filename, os.getpid())
+        try:
+            fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(jsonutils.dumps(token.to_dict()))
+            os.rename(tmpname, filename)
+        except (IOError, OSError) as e:
+            LOG.warning('could not save token to %s: %s', filename, e)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_token_cache(conf):
+    """Return the TokenCache for this process.
+
+    A worker process starts with a copy of the cache from its parent,
+    so it gets a new lock but keeps using the token the parent had.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = TokenCache(conf)
+        elif _cache._pid != os.getpid():
+            _cache = TokenCache(conf, token=_cache._token)
+        return _cache
+
+
+def share_token(http_client, service_type, endpoint_attr, conf):
+    """Make a client authenticate through the process TokenCache.
+
+    The client calls authenticate() when it does not have a token yet
+    and when keystone rejects the one it has, so replacing that method
+    is enough to have all of the clients use the same token.
+
+    :param http_client: The HTTP client object of a neutron or nova client.
+    :param service_type: The type of the service in the keystone catalog.
+    :type service_type: str
+    :param endpoint_attr: The name of the attribute on http_client
+                          that holds the service endpoint.
+    :type endpoint_attr: str
+    :param conf: The configuration with the authentication settings.
+    """
+    if conf.auth_strategy != 'keystone':
+        return
+
+    def authenticate():
+        token = get_token_cache(conf).get(
+            stale_token_id=http_client.auth_token or None,
+        )
+        http_client.auth_token = token.id
+        setattr(http_client, endpoint_attr, token.endpoint_for(service_type))
+
+    def unauthenticate():
+        # Keep the rejected token around, so authenticate() can tell
+        # the cache not to hand it out again.
+        pass
+
+    http_client.authenticate = authenticate
+    http_client.unauthenticate = unauthenticate
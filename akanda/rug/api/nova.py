@@ -18,9 +18,26 @@ import logging
 
 from novaclient.v1_1 import client
 
+from akanda.rug import stats
+from akanda.rug.api import keystone
+from akanda.rug.api import singleflight
+
 
 LOG = logging.getLogger(__name__)
 
+# Identical reads made at the same time by the threads in a worker
+# process only go to nova once.
+SHARED_READS = singleflight.SingleFlight('nova')
+
+
+def _own_instance(nova, instance):
+    """Rebuild an instance shared with other threads around our own client.
+    """
+    if instance is None:
+        return None
+    return instance.__class__(nova.client.servers, instance._info,
+                              loaded=True)
+
 
 class Nova(object):
     def __init__(self, conf):
@@ -31,8 +48,12 @@ class Nova(object):
             conf.admin_tenant_name,
             auth_url=conf.auth_url,
             auth_system=conf.auth_strategy,
-            region_name=conf.auth_region)
+            region_name=conf.auth_region,
+            connection_pool=True)
+        keystone.share_token(self.client.client, 'compute',
+                             'management_url', conf)
 
+    @stats.timed('nova')
     def create_router_instance(self, router, router_image_uuid):
         nics = [{'net-id': p.network_id, 'v4-fixed-ip': '', 'port-id': p.id}
                 for p in router.ports]
@@ -53,15 +74,20 @@ class Nova(object):
             nics=nics)
         assert server and server.created
 
+    @stats.timed('nova')
     def get_instance(self, router):
-        instances = self.client.servers.list(
-            search_opts=dict(name='ak-' + router.id))
+        return self._get_instance_by_name('ak-' + router.id)
+
+    @singleflight.shared_read(SHARED_READS, _own_instance)
+    def _get_instance_by_name(self, name):
+        instances = self.client.servers.list(search_opts=dict(name=name))
 
         if instances:
             return instances[0]
         else:
             return None
 
+    @stats.timed('nova')
     def get_router_instance_status(self, router):
         instance = self.get_instance(router)
         if instance:
@@ -69,12 +95,14 @@ class Nova(object):
         else:
             return None
 
+    @stats.timed('nova')
     def destroy_router_instance(self, router):
         instance = self.get_instance(router)
         if instance:
             LOG.debug('deleting vm for router %s', router.id)
             self.client.servers.delete(instance.id)
 
+    @stats.timed('nova')
     def reboot_router_instance(self, router, router_image_uuid):
         instance = self.get_instance(router)
         if instance:
@@ -16,6 +16,7 @@
 
 
 import collections
+import copy
 import itertools
 import socket
 import time
@@ -25,6 +26,9 @@ import netaddr
 from oslo.config import cfg
 from neutronclient.v2_0 import client
 
+from akanda.rug import stats
+from akanda.rug.api import keystone
+from akanda.rug.api import singleflight
 from akanda.rug.common.linux import ip_lib
 from akanda.rug.openstack.common import importutils
 from akanda.rug.openstack.common import context
@@ -46,6 +50,18 @@ STATUS_BUILD = 'BUILD'
 STATUS_DOWN = 'DOWN'
 STATUS_ERROR = 'ERROR'
 
+# Seconds to wait for the interface of a local port after plugging it.
+DEVICE_READY_TIMEOUT = 5
+
+# Identical reads made at the same time by the threads in a worker
+# process only go to neutron once.
+SHARED_READS = singleflight.SingleFlight('neutron')
+
+
+def _own_copy(client, result):
+    "Copy a result shared with other threads so the caller can change it."
+    return copy.deepcopy(result)
+
 
 class RouterGone(Exception):
     pass
@@ -241,6 +257,7 @@ class AkandaExtClientWrapper(client.Client):
     routerstatus_path = '/dhrouterstatus'
 
     @client.APIParamsCall
+    @stats.timed('neutron')
     def update_router_status(self, router, status):
         return self.put(
             '%s/%s' % (self.routerstatus_path, router),
@@ -258,6 +275,7 @@ class L3PluginApi(proxy.RpcProxy):
             topic=topic, default_version=self.BASE_RPC_API_VERSION)
         self.host = host
 
+    @stats.timed('neutron')
     def get_routers(self, router_id=None):
         """Make a remote process call to retrieve the sync data for routers."""
         router_id = [router_id] if router_id else None
@@ -269,6 +287,21 @@ class L3PluginApi(proxy.RpcProxy):
         return retval
 
 
+def _wait_for_device(device_name, timeout=DEVICE_READY_TIMEOUT):
+    """Wait for the interface of a port that was just plugged.
+
+    Returns False if it did not appear in time.
+    """
+    deadline = time.time() + timeout
+    delay = 0.05
+    while not ip_lib.device_exists(device_name):
+        if time.time() >= deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+    return True
+
+
 class Quantum(object):
     def __init__(self, conf):
         self.conf = conf
@@ -280,6 +313,8 @@ class Quantum(object):
             auth_strategy=conf.auth_strategy,
             region_name=conf.auth_region
         )
+        keystone.share_token(self.api_client.httpclient, 'network',
+                             'endpoint_url', conf)
         self.rpc_client = L3PluginApi(PLUGIN_RPC_TOPIC, cfg.CONF.host)
 
     def get_routers(self, detailed=True):
@@ -290,6 +325,7 @@ class Quantum(object):
         routers = self.api_client.list_routers().get('routers', [])
         return [Router.from_dict(r) for r in routers]
 
+    @stats.timed('neutron')
     def get_router_detail(self, router_id):
         """Return detailed information about a router and it's networks."""
         router = self.rpc_client.get_routers(router_id=router_id)
@@ -298,6 +334,8 @@ class Quantum(object):
         except IndexError:
             raise RouterGone('the router is no longer available')
 
+    @stats.timed('neutron')
+    @singleflight.shared_read(SHARED_READS, _own_copy)
     def get_router_for_tenant(self, tenant_id):
         response = self.api_client.list_routers(tenant_id=tenant_id)
         routers = response.get('routers', [])
@@ -309,10 +347,13 @@ class Quantum(object):
             LOG.debug('query response: %r', response)
             return None
 
+    @stats.timed('neutron')
     def get_network_ports(self, network_id):
         return [Port.from_dict(p) for p in
                 self.api_client.list_ports(network_id=network_id)['ports']]
 
+    @stats.timed('neutron')
+    @singleflight.shared_read(SHARED_READS, _own_copy)
     def get_network_subnets(self, network_id):
         response = []
         subnet_response = self.api_client.list_subnets(network_id=network_id)
@@ -326,6 +367,7 @@ class Quantum(object):
                          network_id, e)
         return response
 
+    @stats.timed('neutron')
     def create_router_management_port(self, router_id):
         port_dict = dict(admin_state_up=True,
                          network_id=self.conf.management_network_id,
@@ -342,10 +384,12 @@ class Quantum(object):
 
         return port
 
+    @stats.timed('neutron')
     def delete_router_management_port(self, router_id, port_id):
         args = dict(port_id=port_id, owner=DEVICE_OWNER_ROUTER_MGT)
         self.api_client.remove_interface_router(router_id, args)
 
+    @stats.timed('neutron')
     def create_router_external_port(self, router):
         # FIXME: Need to make this smarter in case the switch is full.
         network_args = {'network_id': self.conf.external_network_id}
@@ -382,6 +426,7 @@ class Quantum(object):
             )
         return new_port
 
+    @stats.timed('neutron')
     def get_router_external_port(self, router):
         for i in xrange(self.conf.max_retries):
             LOG.debug(
@@ -397,7 +442,7 @@ class Quantum(object):
             ]
             if len(ports):
                 port = Port.from_dict(ports[0])
-                LOG.debug('Found router external port: %s' % port.id)
+                LOG.debug('Found router external port: %s', port.id)
                 return port
             time.sleep(self.conf.retry_delay)
         raise RouterGatewayMissing()
@@ -445,17 +490,20 @@ class Quantum(object):
             LOG.info('new local %s port: %r', network_type, port)
 
         # create the tap interface if it doesn't already exist
-        if not ip_lib.device_exists(driver.get_device_name(port)):
+        device_name = driver.get_device_name(port)
+        if not ip_lib.device_exists(device_name):
             driver.plug(
                 port.network_id,
                 port.id,
-                driver.get_device_name(port),
+                device_name,
                 port.mac_address)
 
-            # add sleep to ensure that port is setup before use
-            time.sleep(1)
+            # make sure that the port is set up before it is used
+            if not _wait_for_device(device_name):
+                LOG.warning('%s did not appear after %s seconds',
+                            device_name, DEVICE_READY_TIMEOUT)
 
-        driver.init_l3(driver.get_device_name(port), [ip_address])
+        driver.init_l3(device_name, [ip_address])
         return port
 
     def ensure_local_external_port(self):
@@ -500,6 +548,7 @@ class Quantum(object):
                 router_id, status, e,
             )
 
+    @stats.timed('neutron')
     def clear_device_id(self, port):
         self.api_client.update_port(port.id, {'port': {'device_id': ''}})
 
@@ -0,0 +1,114 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Merge identical API reads made at the same time by several threads.
+"""
+
+import functools
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # Number of other threads that asked for the same call
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """Run only one of a set of identical concurrent calls.
+
+    The first thread to ask for a key runs the call. Threads asking
+    for the same key before it finishes wait for it and get the same
+    result, or the same exception. The result is then shared by all of
+    them, including the thread that ran the call, so none of them may
+    change it without making a copy first.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.requests = 0
+        self.merged = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """Call func(*args, **kwargs), or wait for the call already
+        running for key.
+
+        Returns a tuple containing the result and a flag set when the
+        result is shared with other threads.
+        """
+        with self._lock:
+            self.requests += 1
+            call = self._calls.get(key)
+            if call is not None:
+                self.merged += 1
+                call.waiters += 1
+                waiting = True
+            else:
+                call = self._calls[key] = _Call()
+                waiting = False
+        if waiting:
+            return self._wait(call)
+        return self._run(key, call, func, args, kwargs)
+
+    def _run(self, key, call, func, args, kwargs):
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                # No thread can join the call once it is removed.
+                shared = call.waiters > 0
+            call.done.set()
+        return call.result, shared
+
+    def _wait(self, call):
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result, True
+
+
+def shared_read(group, adapt=None):
+    """Decorate an API client method so identical concurrent calls merge.
+
+    The calls are identified by the method name and its arguments.
+
+    :param group: The SingleFlight tracking the calls.
+    :type group: SingleFlight
+    :param adapt: Called with the client and the result when the
+                  result is shared with other threads, to give each
+                  caller its own copy.
+    :type adapt: callable
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(self, *args, **kwargs):
+            key = (f.__name__, args, frozenset(kwargs.items()))
+            result, shared = group.do(key, f, self, *args, **kwargs)
+            if shared and adapt is not None:
+                result = adapt(self, result)
+            return result
+        return wrapper
+    return decorator
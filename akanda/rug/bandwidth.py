@@ -0,0 +1,181 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Report the traffic through the routers of a worker.
+
+The counters of the routers are read by a thread of their own, a few
+routers at a time, so metering never holds up the state machines.
+"""
+
+import collections
+import logging
+import multiprocessing.pool
+import threading
+import time
+
+from oslo.config import cfg
+
+from akanda.rug.openstack.common import timeutils
+
+LOG = logging.getLogger(__name__)
+
+bandwidth_opts = [
+    cfg.IntOpt('bandwidth_interval', default=300,
+               help='Seconds between readings of the traffic counters of '
+                    'the routers, 0 to read them only when asked.'),
+    cfg.IntOpt('bandwidth_poll_concurrency', default=4,
+               help='Number of routers whose traffic counters each worker '
+                    'reads at the same time.'),
+]
+
+
+def _bandwidth_message(tenant_id, traffic, timestamp):
+    """Build the report for the routers of a tenant.
+
+    The report is published as akanda.tenant.bandwidth.used, so the
+    consumers of the akanda.bandwidth.used notifications, which had one
+    router each, are not handed a payload they do not understand.
+
+    :param traffic: The traffic of each router, keyed by router id.
+    """
+    return {
+        'tenant_id': tenant_id,
+        'timestamp': timestamp,
+        'event_type': 'akanda.tenant.bandwidth.used',
+        'payload': dict(
+            (router_id, dict((t.pop('name'), t) for t in labels))
+            for router_id, labels in traffic.items()
+        ),
+    }
+
+
+class BandwidthCollector(object):
+    """Read the traffic of the routers and publish it.
+
+    All of the routers are read every interval seconds, and the ones
+    asked for with request() as soon as possible. Reading the counters
+    of a router resets them, so each reading is the traffic since the
+    one before, however long ago and by whichever rug it was made. The
+    traffic is published as akanda.tenant.bandwidth.used notifications,
+    one for each tenant with the traffic of all of its routers that
+    were read.
+    """
+
+    def __init__(self, routers, notify, interval, concurrency=4):
+        """
+        :param routers: Returns (tenant_id, router_id, vm) for each of
+                        the routers of the worker.
+        :type routers: callable
+        :param notify: Publishes a notification.
+        :type notify: callable
+        :param interval: Seconds between readings of all of the
+                         routers, 0 to read them only when asked.
+        :param concurrency: Number of routers read at the same time.
+        """
+        self._routers = routers
+        self._notify = notify
+        self.interval = interval
+        self.concurrency = max(concurrency, 1)
+        self._lock = threading.Lock()
+        self._requested = set()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._pool = None
+        self._t = None
+
+    def start(self):
+        self._t = threading.Thread(
+            name='bandwidth',
+            target=self._run,
+        )
+        self._t.setDaemon(True)
+        self._t.start()
+
+    def stop(self):
+        self._stopped = True
+        if self._t:
+            LOG.debug('stopping %s', self._t.getName())
+            self._wake.set()
+            self._t.join(timeout=1)
+            self._t = None
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def request(self, router_id):
+        "Read the traffic of the router as soon as possible."
+        with self._lock:
+            self._requested.add(router_id)
+        self._wake.set()
+
+    def _run(self):
+        next_run = time.time() + self.interval
+        while not self._stopped:
+            timeout = None
+            if self.interval:
+                timeout = max(next_run - time.time(), 0)
+            self._wake.wait(timeout)
+            self._wake.clear()
+            if self._stopped:
+                break
+            with self._lock:
+                requested, self._requested = self._requested, set()
+            try:
+                if self.interval and time.time() >= next_run:
+                    next_run = time.time() + self.interval
+                    self.collect()
+                elif requested:
+                    self.collect(requested)
+            except Exception:
+                LOG.exception('could not report bandwidth')
+
+    def _read(self, target):
+        tenant_id, router_id, vm = target
+        try:
+            return vm.read_stats()
+        except Exception as e:
+            LOG.warning('could not read the traffic of %s: %s',
+                        router_id, e)
+            return None
+
+    def collect(self, router_ids=None):
+        """Read the routers and publish their traffic.
+
+        :param router_ids: The routers to read, or None for all of them.
+        """
+        routers = self._routers()
+        if router_ids is None:
+            targets = routers
+        else:
+            targets = [t for t in routers if t[1] in router_ids]
+        if not targets:
+            return
+        if self._pool is None:
+            self._pool = multiprocessing.pool.ThreadPool(self.concurrency)
+        start = time.time()
+        readings = self._pool.map(self._read, targets)
+        timestamp = timeutils.isotime()
+        by_tenant = collections.defaultdict(dict)
+        for (tenant_id, router_id, vm), labels in zip(targets, readings):
+            if labels is None:
+                continue
+            by_tenant[tenant_id][router_id] = labels
+        for tenant_id, traffic in sorted(by_tenant.items()):
+            self._notify(_bandwidth_message(tenant_id, traffic, timestamp))
+        LOG.debug('read the traffic of %d routers in %.3f seconds, '
+                  'reported %d tenants', len(targets), time.time() - start,
+                  len(by_tenant))
@@ -19,8 +19,12 @@
 """
 import logging
 
+from cliff import command
+
 from akanda.rug import commands
+from akanda.rug import control
 from akanda.rug.cli import message
+from akanda.rug.openstack.common import jsonutils
 
 
 class WorkerDebug(message.MessageSending):
@@ -35,3 +39,37 @@ class WorkerDebug(message.MessageSending):
         return {
             'command': commands.WORKERS_DEBUG,
         }
+
+
+class WorkerStatus(command.Command):
+    """show what the workers are doing"""
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(WorkerStatus, self).get_parser(prog_name)
+        parser.add_argument(
+            '--socket',
+            help='the control socket of the rug, defaults to the '
+                 'control_socket setting',
+        )
+        parser.add_argument(
+            '--router',
+            action='append',
+            default=[],
+            help='only show this router, may be repeated',
+        )
+        return parser
+
+    def take_action(self, parsed_args):
+        path = parsed_args.socket or self.app.rug_ini.control_socket
+        self.log.debug('querying %s', path)
+        status = control.query(path)
+        if parsed_args.router:
+            wanted = set(parsed_args.router)
+            for w in status.get('workers', []):
+                w['routers'] = [r for r in w.get('routers', [])
+                                if r['router_id'] in wanted]
+        self.app.stdout.write(
+            jsonutils.dumps(status, indent=2, sort_keys=True) + '\n'
+        )
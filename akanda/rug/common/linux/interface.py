@@ -39,7 +39,6 @@ from oslo.config import cfg
 
 from akanda.rug.common.linux import ip_lib
 from akanda.rug.common.linux import ovs_lib
-from akanda.rug.common.linux import utils
 from akanda.rug.openstack.common.gettextutils import _
 from akanda.rug.openstack.common import log as logging
 
@@ -73,30 +72,33 @@ class LinuxInterfaceDriver(object):
         """Set the L3 settings for the interface using data from the port.
            ip_cidrs: list of 'X.X.X.X/YY' strings
         """
-        device = ip_lib.IPDevice(device_name,
-                                 self.root_helper,
-                                 namespace=namespace)
+        with ip_lib.IPBatch(self.root_helper, namespace) as batch:
+            device = ip_lib.IPDevice(device_name,
+                                     self.root_helper,
+                                     namespace=namespace,
+                                     batch=batch)
 
-        previous = {}
-        for address in device.addr.list(scope='global', filters=['permanent']):
-            previous[address['cidr']] = address['ip_version']
+            previous = {}
+            for address in device.addr.list(scope='global',
+                                            filters=['permanent']):
+                previous[address['cidr']] = address['ip_version']
 
-        # add new addresses
-        for ip_cidr in ip_cidrs:
+            # add new addresses
+            for ip_cidr in ip_cidrs:
 
-            net = netaddr.IPNetwork(ip_cidr)
-            if ip_cidr in previous:
-                del previous[ip_cidr]
-                continue
+                net = netaddr.IPNetwork(ip_cidr)
+                if ip_cidr in previous:
+                    del previous[ip_cidr]
+                    continue
 
-            device.addr.add(net.version, ip_cidr, str(net.broadcast))
+                device.addr.add(net.version, ip_cidr, str(net.broadcast))
 
-        # clean up any old addresses
-        for ip_cidr, ip_version in previous.items():
-            device.addr.delete(ip_version, ip_cidr)
+            # clean up any old addresses
+            for ip_cidr, ip_version in previous.items():
+                device.addr.delete(ip_version, ip_cidr)
 
-    def check_bridge_exists(self, bridge):
-        if not ip_lib.device_exists(bridge):
+    def check_bridge_exists(self, bridge, batch=None):
+        if not ip_lib.device_exists(bridge, batch=batch):
             raise Exception('Bridge %s does not exist' % bridge)
 
     def get_device_name(self, port):
@@ -138,17 +140,18 @@ class OVSInterfaceDriver(LinuxInterfaceDriver):
 
     def _ovs_add_port(self, bridge, device_name, port_id, mac_address,
                       internal=True):
-        cmd = ['ovs-vsctl', '--', '--may-exist',
-               'add-port', bridge, device_name]
-        if internal:
-            cmd += ['--', 'set', 'Interface', device_name, 'type=internal']
-        cmd += ['--', 'set', 'Interface', device_name,
-                'external-ids:iface-id=%s' % port_id,
-                '--', 'set', 'Interface', device_name,
-                'external-ids:iface-status=active',
-                '--', 'set', 'Interface', device_name,
-                'external-ids:attached-mac=%s' % mac_address]
-        utils.execute(cmd, self.root_helper)
+        ovs = ovs_lib.OVSBridge(bridge, self.root_helper)
+        with ovs.transaction(check_error=True) as txn:
+            txn.add_port(device_name)
+            if internal:
+                txn.set_db_attribute('Interface', device_name, 'type',
+                                     'internal')
+            txn.set_db_attribute('Interface', device_name,
+                                 'external-ids:iface-id', port_id)
+            txn.set_db_attribute('Interface', device_name,
+                                 'external-ids:iface-status', 'active')
+            txn.set_db_attribute('Interface', device_name,
+                                 'external-ids:attached-mac', mac_address)
 
     def plug(self, network_id, port_id, device_name, mac_address,
              bridge=None, namespace=None, prefix=None):
@@ -156,18 +159,27 @@ class OVSInterfaceDriver(LinuxInterfaceDriver):
         if not bridge:
             bridge = self.conf.ovs_integration_bridge
 
-        self.check_bridge_exists(bridge)
+        with ip_lib.IPBatch(self.root_helper) as batch:
+            self._plug(bridge, port_id, device_name, mac_address,
+                       namespace, prefix, batch)
+
+    def _plug(self, bridge, port_id, device_name, mac_address, namespace,
+              prefix, batch):
+        self.check_bridge_exists(bridge, batch=batch)
 
         if not ip_lib.device_exists(device_name,
                                     self.root_helper,
-                                    namespace=namespace):
+                                    namespace=namespace,
+                                    batch=batch):
 
-            ip = ip_lib.IPWrapper(self.root_helper)
+            ip = ip_lib.IPWrapper(self.root_helper, batch=batch)
             tap_name = self._get_tap_name(device_name, prefix)
 
             if self.conf.ovs_use_veth:
                 root_dev, ns_dev = ip.add_veth(tap_name, device_name)
 
+            # The veth has to exist before it is added to the bridge.
+            batch.run()
             internal = not self.conf.ovs_use_veth
             self._ovs_add_port(bridge, tap_name, port_id, mac_address,
                                internal=internal)
@@ -220,10 +232,15 @@ class BridgeInterfaceDriver(LinuxInterfaceDriver):
     def plug(self, network_id, port_id, device_name, mac_address,
              bridge=None, namespace=None, prefix=None):
         """Plugin the interface."""
+        with ip_lib.IPBatch(self.root_helper) as batch:
+            self._plug(device_name, mac_address, namespace, prefix, batch)
+
+    def _plug(self, device_name, mac_address, namespace, prefix, batch):
         if not ip_lib.device_exists(device_name,
                                     self.root_helper,
-                                    namespace=namespace):
-            ip = ip_lib.IPWrapper(self.root_helper)
+                                    namespace=namespace,
+                                    batch=batch):
+            ip = ip_lib.IPWrapper(self.root_helper, batch=batch)
 
             # Enable agent to define the prefix
             if prefix:
@@ -31,6 +31,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import itertools
+
 import netaddr
 
 from akanda.rug.common.linux import utils
@@ -39,15 +41,23 @@ from akanda.rug.openstack.common.gettextutils import _
 
 LOOPBACK_DEVNAME = 'lo'
 
+# The commands that can be collected in an IPBatch.
+BATCH_COMMANDS = frozenset(['addr', 'link', 'route', 'tuntap'])
+
 
 class SubProcessBase(object):
-    def __init__(self, root_helper=None, namespace=None):
+    def __init__(self, root_helper=None, namespace=None, batch=None):
         self.root_helper = root_helper
         self.namespace = namespace
+        self.batch = batch
 
     def _run(self, options, command, args):
+        if self.batch is not None:
+            # Queries have to see the changes made so far.
+            self.batch.run()
         if self.namespace:
-            return self._as_root(options, command, args)
+            return self._execute_as_root(options, command, args,
+                                         self.namespace)
         else:
             return self._execute(options, command, args)
 
@@ -57,6 +67,18 @@ class SubProcessBase(object):
 
         namespace = self.namespace if not use_root_namespace else None
 
+        if self.batch is not None:
+            if self.batch.accepts(command, args, namespace):
+                self.batch.add(options, command, args)
+                return ''
+            self.batch.run()
+
+        return self._execute_as_root(options, command, args, namespace)
+
+    def _execute_as_root(self, options, command, args, namespace):
+        if not self.root_helper:
+            raise Exception('Sudo is required to run this command')
+
         return self._execute(options,
                              command,
                              args,
@@ -75,14 +97,101 @@ class SubProcessBase(object):
                              root_helper=root_helper)
 
 
-class IPWrapper(SubProcessBase):
+class IPBatch(SubProcessBase):
+    """Run the changes made with ip together, with one `ip -batch`.
+
+    The devices created with the batch queue their changes here, and
+    they are all made when the batch is run: when a query has to see
+    them, when a command that cannot be batched comes along, or at the
+    end of the with block. The links and addresses of the devices are
+    read from one `ip -o` dump, which is kept until the next change.
+    """
+
     def __init__(self, root_helper=None, namespace=None):
+        super(IPBatch, self).__init__(root_helper=root_helper,
+                                      namespace=namespace)
+        self._pending = []
+        self._dumps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Like `ip -batch`, stop at the first error.
+        if exc_type is None:
+            self.run()
+        else:
+            self._pending = []
+
+    def device(self, name):
+        return IPDevice(name, self.root_helper, self.namespace, batch=self)
+
+    def accepts(self, command, args, namespace):
+        if namespace != self.namespace or command not in BATCH_COMMANDS:
+            return False
+        # Do not quote arguments for the batch parser.
+        return not any(
+            not s or any(c.isspace() or c in '"\'\\' for c in s)
+            for s in map(str, args)
+        )
+
+    def add(self, options, command, args):
+        self._pending.append((
+            tuple(str(o) for o in options),
+            ' '.join([command] + [str(a) for a in args]),
+        ))
+        self._dumps.clear()
+
+    def run(self):
+        "Make the changes queued so far."
+        pending, self._pending = self._pending, []
+        # The options apply to the whole batch.
+        for options, commands in itertools.groupby(pending,
+                                                   key=lambda p: p[0]):
+            if self.namespace:
+                ip_cmd = ['ip', 'netns', 'exec', self.namespace, 'ip']
+            else:
+                ip_cmd = ['ip']
+            utils.execute(
+                ip_cmd + ['-%s' % o for o in options] + ['-batch', '-'],
+                root_helper=self.root_helper,
+                process_input=''.join('%s\n' % c for _, c in commands),
+            )
+
+    def _dump(self, command, split):
+        if command not in self._dumps:
+            self.run()
+            by_device = {}
+            for line in self._run('o', command, ('show',)).split('\n'):
+                tokens = split(line)
+                if len(tokens) >= 3:
+                    name = tokens[1].strip().split('@')[0]
+                    by_device.setdefault(name, []).append(line)
+            self._dumps[command] = by_device
+        return self._dumps[command]
+
+    def link_line(self, name):
+        "Return the line of `ip -o link show` for the device."
+        lines = self._dump('link', lambda l: l.split(':', 2)).get(name)
+        if not lines:
+            raise RuntimeError('Device "%s" does not exist.' % name)
+        return lines[0]
+
+    def addr_lines(self, name):
+        "Return the addresses of the device from `ip -o addr show`."
+        lines = self._dump('addr', lambda l: l.split(None, 2)).get(name, [])
+        return [l.split(None, 2)[2].split('\\')[0].strip() for l in lines]
+
+
+class IPWrapper(SubProcessBase):
+    def __init__(self, root_helper=None, namespace=None, batch=None):
         super(IPWrapper, self).__init__(root_helper=root_helper,
-                                        namespace=namespace)
+                                        namespace=namespace,
+                                        batch=batch)
         self.netns = IpNetnsCommand(self)
 
     def device(self, name):
-        return IPDevice(name, self.root_helper, self.namespace)
+        return IPDevice(name, self.root_helper, self.namespace, self.batch)
 
     def get_devices(self, exclude_loopback=False):
         retval = []
@@ -100,19 +209,19 @@ class IPWrapper(SubProcessBase):
 
                 retval.append(IPDevice(name,
                                        self.root_helper,
-                                       self.namespace))
+                                       self.namespace,
+                                       self.batch))
         return retval
 
     def add_tuntap(self, name, mode='tap'):
         self._as_root('', 'tuntap', ('add', name, 'mode', mode))
-        return IPDevice(name, self.root_helper, self.namespace)
+        return self.device(name)
 
     def add_veth(self, name1, name2):
         self._as_root('', 'link',
                       ('add', name1, 'type', 'veth', 'peer', 'name', name2))
 
-        return (IPDevice(name1, self.root_helper, self.namespace),
-                IPDevice(name2, self.root_helper, self.namespace))
+        return (self.device(name1), self.device(name2))
 
     def ensure_namespace(self, name):
         if not self.netns.exists(name):
@@ -145,9 +254,10 @@ class IPWrapper(SubProcessBase):
 
 
 class IPDevice(SubProcessBase):
-    def __init__(self, name, root_helper=None, namespace=None):
+    def __init__(self, name, root_helper=None, namespace=None, batch=None):
         super(IPDevice, self).__init__(root_helper=root_helper,
-                                       namespace=namespace)
+                                       namespace=namespace,
+                                       batch=batch)
         self.name = name
         self.link = IpLinkCommand(self)
         self.addr = IpAddrCommand(self)
@@ -182,6 +292,14 @@ class IpDeviceCommandBase(IpCommandBase):
     def name(self):
         return self._parent.name
 
+    @property
+    def _batch(self):
+        "The batch that can answer queries about the device, if any."
+        batch = self._parent.batch
+        if batch is not None and batch.namespace == self._parent.namespace:
+            return batch
+        return None
+
 
 class IpLinkCommand(IpDeviceCommandBase):
     COMMAND = 'link'
@@ -238,6 +356,8 @@ class IpLinkCommand(IpDeviceCommandBase):
 
     @property
     def attributes(self):
+        if self._batch is not None:
+            return self._parse_line(self._batch.link_line(self.name))
         return self._parse_line(self._run('show', self.name, options='o'))
 
     def _parse_line(self, value):
@@ -281,6 +401,10 @@ class IpAddrCommand(IpDeviceCommandBase):
         if filters is None:
             filters = []
 
+        if (self._batch is not None and to is None and
+                set(filters) <= set(['permanent'])):
+            return self._list_batch(scope, 'permanent' in filters)
+
         retval = []
 
         if scope:
@@ -292,30 +416,45 @@ class IpAddrCommand(IpDeviceCommandBase):
             line = line.strip()
             if not line.startswith('inet'):
                 continue
-            parts = line.split()
-            if parts[0] == 'inet6':
-                version = 6
-                scope = parts[3]
-                broadcast = '::'
-            else:
-                version = 4
-                if parts[2] == 'brd':
-                    broadcast = parts[3]
-                    scope = parts[5]
-                else:
-                    # sometimes output of 'ip a' might look like:
-                    # inet 192.168.100.100/24 scope global eth0
-                    # and broadcast needs to be calculated from CIDR
-                    broadcast = str(netaddr.IPNetwork(parts[1]).broadcast)
-                    scope = parts[3]
-
-            retval.append(dict(cidr=parts[1],
-                               broadcast=broadcast,
-                               scope=scope,
-                               ip_version=version,
-                               dynamic=('dynamic' == parts[-1])))
+            retval.append(self._parse_address(line))
         return retval
 
+    def _list_batch(self, scope, permanent):
+        # Filter the dump the way ip filters the addresses.
+        retval = []
+        for line in self._batch.addr_lines(self.name):
+            address = self._parse_address(line)
+            if scope and address['scope'] != scope:
+                continue
+            if permanent and 'dynamic' in line.split():
+                continue
+            retval.append(address)
+        return retval
+
+    def _parse_address(self, line):
+        parts = line.split()
+        if parts[0] == 'inet6':
+            version = 6
+            scope = parts[3]
+            broadcast = '::'
+        else:
+            version = 4
+            if parts[2] == 'brd':
+                broadcast = parts[3]
+                scope = parts[5]
+            else:
+                # sometimes output of 'ip a' might look like:
+                # inet 192.168.100.100/24 scope global eth0
+                # and broadcast needs to be calculated from CIDR
+                broadcast = str(netaddr.IPNetwork(parts[1]).broadcast)
+                scope = parts[3]
+
+        return dict(cidr=parts[1],
+                    broadcast=broadcast,
+                    scope=scope,
+                    ip_version=version,
+                    dynamic=('dynamic' == parts[-1]))
+
 
 class IpRouteCommand(IpDeviceCommandBase):
     COMMAND = 'route'
@@ -432,9 +571,11 @@ class IpNetnsCommand(IpCommandBase):
         return False
 
 
-def device_exists(device_name, root_helper=None, namespace=None):
+def device_exists(device_name, root_helper=None, namespace=None,
+                  batch=None):
     try:
-        address = IPDevice(device_name, root_helper, namespace).link.address
+        address = IPDevice(device_name, root_helper, namespace,
+                           batch).link.address
     except RuntimeError:
         return False
     return bool(address)
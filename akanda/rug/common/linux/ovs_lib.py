@@ -35,9 +35,10 @@
 # @author: Dan Wendlandt, Nicira Networks, Inc.
 # @author: Dave Lapsley, Nicira Networks, Inc.
 
-import re
+import json
 
 from akanda.rug.common.linux import utils
+from akanda.rug.openstack.common import excutils
 from akanda.rug.openstack.common.gettextutils import _
 from akanda.rug.openstack.common import log as logging
 
@@ -59,42 +60,114 @@ class VifPort:
                 self.switch.br_name)
 
 
+def _ovsdb_value(value):
+    """Turn a value from the JSON output of ovs-vsctl into Python.
+
+    Maps become dicts, sets become lists and uuids become strings.
+    """
+    if isinstance(value, list) and len(value) == 2:
+        kind, data = value
+        if kind == 'map':
+            return dict((k, _ovsdb_value(v)) for k, v in data)
+        if kind == 'set':
+            return [_ovsdb_value(v) for v in data]
+        if kind in ('uuid', 'named-uuid'):
+            return data
+    return value
+
+
+class OVSTransaction(object):
+    """Make several changes with one ovs-vsctl.
+
+    ovs-vsctl runs all of the commands given to it, separated by '--',
+    in one database transaction, so either all of the changes are made
+    or none are. The commands are collected until commit() is called,
+    or the with block ends without an error.
+    """
+
+    def __init__(self, bridge, check_error=False):
+        self.bridge = bridge
+        self.check_error = check_error
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def add(self, *args):
+        "Add an ovs-vsctl command, with its options."
+        self.commands.append([str(a) for a in args])
+
+    def add_port(self, port_name, may_exist=True):
+        if may_exist:
+            self.add("--may-exist", "add-port", self.bridge.br_name,
+                     port_name)
+        else:
+            self.add("add-port", self.bridge.br_name, port_name)
+
+    def delete_port(self, port_name):
+        self.add("--if-exists", "del-port", self.bridge.br_name, port_name)
+
+    def set_db_attribute(self, table_name, record, column, value):
+        self.add("set", table_name, record, "%s=%s" % (column, value))
+
+    def clear_db_attribute(self, table_name, record, column):
+        self.add("clear", table_name, record, column)
+
+    def commit(self):
+        "Run the commands collected so far, and return the output."
+        commands, self.commands = self.commands, []
+        if not commands:
+            return None
+        args = []
+        for command in commands:
+            args += ["--"] + command
+        return self.bridge.run_vsctl(args, check_error=self.check_error)
+
+
 class OVSBridge:
     def __init__(self, br_name, root_helper):
         self.br_name = br_name
         self.root_helper = root_helper
-        self.re_id = self.re_compile_id()
-
-    def re_compile_id(self):
-        external = 'external_ids\s*'
-        mac = 'attached-mac="(?P<vif_mac>([a-fA-F\d]{2}:){5}([a-fA-F\d]{2}))"'
-        iface = 'iface-id="(?P<vif_id>[^"]+)"'
-        name = 'name\s*:\s"(?P<port_name>[^"]*)"'
-        port = 'ofport\s*:\s(?P<ofport>-?\d+)'
-        _re = ('%(external)s:\s{ ( %(mac)s,? | %(iface)s,? | . )* }'
-               ' \s+ %(name)s \s+ %(port)s' % locals())
-        return re.compile(_re, re.M | re.X)
-
-    def run_vsctl(self, args):
+
+    def run_vsctl(self, args, check_error=False):
         full_args = ["ovs-vsctl", "--timeout=2"] + args
         try:
             return utils.execute(full_args, root_helper=self.root_helper)
         except Exception, e:
-            LOG.error(_("Unable to execute %(cmd)s. Exception: %(exception)s"),
-                      {'cmd': full_args, 'exception': e})
+            if not check_error:
+                LOG.error(_("Unable to execute %(cmd)s. "
+                            "Exception: %(exception)s"),
+                          {'cmd': full_args, 'exception': e})
+                return None
+            with excutils.save_and_reraise_exception():
+                LOG.error(_("Unable to execute %(cmd)s. "
+                            "Exception: %(exception)s"),
+                          {'cmd': full_args, 'exception': e})
+
+    def transaction(self, check_error=False):
+        """Return an OVSTransaction for changes to the bridge.
+
+        :param check_error: Raise the error if ovs-vsctl fails, instead
+                            of only logging it.
+        """
+        return OVSTransaction(self, check_error)
 
     def reset_bridge(self):
         self.run_vsctl(["--", "--if-exists", "del-br", self.br_name])
         self.run_vsctl(["add-br", self.br_name])
 
     def add_port(self, port_name):
-        self.run_vsctl(["--", "--may-exist", "add-port", self.br_name,
-                        port_name])
+        with self.transaction() as txn:
+            txn.add_port(port_name)
         return self.get_port_ofport(port_name)
 
     def delete_port(self, port_name):
-        self.run_vsctl(["--", "--if-exists", "del-port", self.br_name,
-                        port_name])
+        with self.transaction() as txn:
+            txn.delete_port(port_name)
 
     def set_db_attribute(self, table_name, record, column, value):
         args = ["set", table_name, record, "%s=%s" % (column, value)]
@@ -178,20 +251,23 @@ class OVSBridge:
         self.run_ofctl("del-flows", [flow_str])
 
     def add_tunnel_port(self, port_name, remote_ip):
-        self.run_vsctl(["add-port", self.br_name, port_name])
-        self.set_db_attribute("Interface", port_name, "type", "gre")
-        self.set_db_attribute("Interface", port_name, "options:remote_ip",
-                              remote_ip)
-        self.set_db_attribute("Interface", port_name, "options:in_key", "flow")
-        self.set_db_attribute("Interface", port_name, "options:out_key",
-                              "flow")
+        with self.transaction() as txn:
+            txn.add_port(port_name, may_exist=False)
+            txn.set_db_attribute("Interface", port_name, "type", "gre")
+            txn.set_db_attribute("Interface", port_name, "options:remote_ip",
+                                 remote_ip)
+            txn.set_db_attribute("Interface", port_name, "options:in_key",
+                                 "flow")
+            txn.set_db_attribute("Interface", port_name, "options:out_key",
+                                 "flow")
         return self.get_port_ofport(port_name)
 
     def add_patch_port(self, local_name, remote_name):
-        self.run_vsctl(["add-port", self.br_name, local_name])
-        self.set_db_attribute("Interface", local_name, "type", "patch")
-        self.set_db_attribute("Interface", local_name, "options:peer",
-                              remote_name)
+        with self.transaction() as txn:
+            txn.add_port(local_name, may_exist=False)
+            txn.set_db_attribute("Interface", local_name, "type", "patch")
+            txn.set_db_attribute("Interface", local_name, "options:peer",
+                                 remote_name)
         return self.get_port_ofport(local_name)
 
     def db_get_map(self, table, record, column):
@@ -234,60 +310,72 @@ class OVSBridge:
             LOG.error(_("Unable to execute %(cmd)s. Exception: %(exception)s"),
                       {'cmd': args, 'exception': e})
 
+    def get_interfaces(self):
+        """Read the ports of the bridge and all of the interfaces.
+
+        Both come from one ovs-vsctl, with the interfaces as JSON.
+
+        :returns: The names of the ports of the bridge, and a dict of
+                  the interfaces by name, each with its external_ids
+                  and ofport.
+        """
+        output = self.run_vsctl(["--format=json",
+                                 "--", "list-ports", self.br_name,
+                                 "--", "--columns=name,external_ids,ofport",
+                                 "list", "Interface"])
+        port_names = []
+        interfaces = {}
+        for line in (output or '').splitlines():
+            if line.startswith('{'):
+                table = json.loads(line)
+                for row in table['data']:
+                    iface = dict(zip(table['headings'],
+                                     [_ovsdb_value(v) for v in row]))
+                    interfaces[iface['name']] = iface
+            elif line.strip():
+                port_names.append(line.strip())
+        return port_names, interfaces
+
+    def _vif_port(self, name, iface):
+        """Return a VifPort for the interface, or None if it is not a VIF.
+        """
+        external_ids = iface.get('external_ids', {})
+        if "attached-mac" not in external_ids:
+            return None
+        if "iface-id" in external_ids:
+            iface_id = external_ids["iface-id"]
+        elif "xs-vif-uuid" in external_ids:
+            # if this is a xenserver and iface-id is not automatically
+            # synced to OVS from XAPI, we grab it from XAPI directly
+            iface_id = self.get_xapi_iface_id(external_ids["xs-vif-uuid"])
+        else:
+            return None
+        ofport = iface.get('ofport')
+        if ofport == []:
+            # Not assigned yet
+            ofport = None
+        return VifPort(name, ofport, iface_id,
+                       external_ids["attached-mac"], self)
+
     # returns a VIF object for each VIF port
     def get_vif_ports(self):
         edge_ports = []
-        port_names = self.get_port_name_list()
+        port_names, interfaces = self.get_interfaces()
         for name in port_names:
-            external_ids = self.db_get_map("Interface", name, "external_ids")
-            ofport = self.db_get_val("Interface", name, "ofport")
-            if "iface-id" in external_ids and "attached-mac" in external_ids:
-                p = VifPort(name, ofport, external_ids["iface-id"],
-                            external_ids["attached-mac"], self)
-                edge_ports.append(p)
-            elif ("xs-vif-uuid" in external_ids and
-                  "attached-mac" in external_ids):
-                # if this is a xenserver and iface-id is not automatically
-                # synced to OVS from XAPI, we grab it from XAPI directly
-                iface_id = self.get_xapi_iface_id(external_ids["xs-vif-uuid"])
-                p = VifPort(name, ofport, iface_id,
-                            external_ids["attached-mac"], self)
-                edge_ports.append(p)
-
+            port = self._vif_port(name, interfaces.get(name, {}))
+            if port is not None:
+                edge_ports.append(port)
         return edge_ports
 
     def get_vif_port_set(self):
-        edge_ports = set()
-        port_names = self.get_port_name_list()
-        for name in port_names:
-            external_ids = self.db_get_map("Interface", name, "external_ids")
-            if "iface-id" in external_ids and "attached-mac" in external_ids:
-                edge_ports.add(external_ids['iface-id'])
-            elif ("xs-vif-uuid" in external_ids and
-                  "attached-mac" in external_ids):
-                # if this is a xenserver and iface-id is not automatically
-                # synced to OVS from XAPI, we grab it from XAPI directly
-                iface_id = self.get_xapi_iface_id(external_ids["xs-vif-uuid"])
-                edge_ports.add(iface_id)
-        return edge_ports
+        return set(port.vif_id for port in self.get_vif_ports())
 
     def get_vif_port_by_id(self, port_id):
-        args = ['--', '--columns=external_ids,name,ofport',
-                'find', 'Interface',
-                'external_ids:iface-id="%s"' % port_id]
-        result = self.run_vsctl(args)
-        if not result:
-            return
-        match = self.re_id.search(result)
-        try:
-            vif_mac = match.group('vif_mac')
-            vif_id = match.group('vif_id')
-            port_name = match.group('port_name')
-            ofport = int(match.group('ofport'))
-            return VifPort(port_name, ofport, vif_id, vif_mac, self)
-        except Exception, e:
-            LOG.info(_("Unable to parse regex results. Exception: %s"), e)
-            return
+        port_names, interfaces = self.get_interfaces()
+        for name, iface in sorted(interfaces.items()):
+            if iface.get('external_ids', {}).get('iface-id') == port_id:
+                return self._vif_port(name, iface)
+        return None
 
     def delete_ports(self, all_ports=False):
         if all_ports:
@@ -0,0 +1,147 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Local control socket for asking the rug what it is doing.
+
+A client connects to the Unix socket, sends the name of a request on
+a line of its own, and reads a JSON document until the rug closes the
+connection. The parent process asks all of the workers at once, so
+the answer does not wait for the messages queued for them and nothing
+is written to the log.
+"""
+
+import errno
+import logging
+import os
+import socket
+import SocketServer
+import threading
+
+from oslo.config import cfg
+
+from akanda.rug.openstack.common import jsonutils
+from akanda.rug.openstack.common import timeutils
+from akanda.rug import populate
+
+LOG = logging.getLogger(__name__)
+
+# Seconds to wait for the workers to answer.
+QUERY_TIMEOUT = 5
+
+control_opts = [
+    cfg.StrOpt('control_socket',
+               default='/var/run/akanda-rug/control.sock',
+               help='Unix socket where the rug answers status queries, '
+                    'empty to disable it.'),
+]
+
+
+def snapshot(sched, timeout=QUERY_TIMEOUT):
+    """Describe what all of the workers are doing.
+
+    :param sched: The scheduler that owns the workers.
+    :type sched: akanda.rug.scheduler.Scheduler
+    """
+    answers = sched.query('status', timeout)
+    workers = []
+    for w, answer in zip(sched.workers, answers):
+        info = {
+            'name': w['worker'].name,
+            'pid': w['worker'].pid,
+            'alive': w['worker'].is_alive(),
+            'answered': answer is not None,
+        }
+        try:
+            info['inbox_depth'] = w['queue'].qsize()
+        except NotImplementedError:
+            # Not available on every platform.
+            pass
+        if answer is not None:
+            info.update(answer)
+        workers.append(info)
+    return {
+        'taken_at': timeutils.isotime(),
+        'pre_populate': populate.status(),
+        'workers': workers,
+    }
+
+
+class _ControlHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        request = self.rfile.readline(1024).strip() or 'status'
+        if request == 'status':
+            try:
+                reply = snapshot(self.server.scheduler)
+            except Exception as e:
+                LOG.exception('could not take status snapshot')
+                reply = {'error': unicode(e)}
+        else:
+            reply = {'error': 'unknown request %r' % request}
+        self.wfile.write(jsonutils.dumps(reply) + '\n')
+
+
+def start_server(path, sched):
+    """Answer the requests sent to the control socket from a thread.
+
+    Returns the server, or None when it could not be started.
+    """
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Remove the socket left behind by an earlier run.
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        server = SocketServer.UnixStreamServer(path, _ControlHandler)
+        os.chmod(path, 0o600)
+    except (OSError, socket.error) as e:
+        LOG.error('could not open control socket %s: %s', path, e)
+        return None
+    server.scheduler = sched
+    t = threading.Thread(
+        target=server.serve_forever,
+        name='ControlServer',
+    )
+    t.setDaemon(True)
+    t.start()
+    LOG.info('answering status queries on %s', path)
+    return server
+
+
+def query(path, request='status', timeout=30):
+    """Send a request to the control socket of a running rug.
+
+    Returns the decoded answer.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall(request + '\n')
+        chunks = []
+        while True:
+            data = s.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        s.close()
+    return jsonutils.loads(''.join(chunks))
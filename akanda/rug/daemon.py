@@ -18,9 +18,15 @@
 """Utilities for managing ourselves as a daemon.
 """
 
+import ctypes
+import ctypes.util
 import logging
+import os
 import signal
 
+# From <sys/prctl.h>
+PR_SET_PDEATHSIG = 1
+
 
 def ignore_signals():
     """Ignore signals that might interrupt processing.
@@ -28,3 +34,22 @@ def ignore_signals():
     for s in [signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2, signal.SIGALRM]:
         logging.getLogger(__name__).info('ignoring signal %s', s)
         signal.signal(s, signal.SIG_IGN)
+
+
+def die_with_parent():
+    """Ask the kernel to kill this process when its parent exits.
+
+    Only works on Linux. Returns True if the request was made.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        prctl = libc.prctl
+    except (OSError, AttributeError):
+        return False
+    parent = os.getppid()
+    if prctl(PR_SET_PDEATHSIG, signal.SIGKILL, 0, 0, 0) != 0:
+        return False
+    # The parent may have exited before the request was made.
+    if os.getppid() != parent:
+        os.kill(os.getpid(), signal.SIGKILL)
+    return True
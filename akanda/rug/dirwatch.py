@@ -0,0 +1,195 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Keep the names of the files in a directory in memory.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = (IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+               IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+_EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+
+def _inotify():
+    """Return the C library if it supports inotify, otherwise None.
+    """
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                               use_errno=True)
+            libc.inotify_init1
+            libc.inotify_add_watch
+            libc.inotify_rm_watch
+        except (OSError, AttributeError):
+            libc = False
+        _libc = libc
+    return _libc or None
+
+
+class DirectoryWatcher(object):
+    """The names of the files in a directory.
+
+    The names are listed again when inotify reports that the
+    directory changed. Where inotify cannot be used, the modification
+    time of the directory is checked at most once every poll_interval
+    seconds when the names are asked for. A directory that does not
+    exist is empty.
+    """
+
+    def __init__(self, path, poll_interval=1.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._names = frozenset()
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._listed_at = 0
+        self._checked_at = 0
+        self._fd = None
+        self._wd = None
+        self._closed = False
+        if path:
+            self._start_watch()
+            self._list()
+
+    def _start_watch(self):
+        libc = _inotify()
+        if libc is None:
+            return
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            LOG.debug('could not use inotify: %s',
+                      os.strerror(ctypes.get_errno()))
+            return
+        wd = libc.inotify_add_watch(fd, self.path, _WATCH_MASK)
+        if wd < 0:
+            LOG.debug('could not watch %s: %s',
+                      self.path, os.strerror(ctypes.get_errno()))
+            os.close(fd)
+            return
+        self._fd = fd
+        self._wd = wd
+        t = threading.Thread(
+            target=self._read_events,
+            name='DirectoryWatcher',
+        )
+        t.setDaemon(True)
+        t.start()
+
+    def _read_events(self):
+        """Runs in the thread.
+        """
+        try:
+            while True:
+                try:
+                    data = os.read(self._fd, 4096)
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    LOG.warning('could not read changes to %s: %s',
+                                self.path, e)
+                    break
+                self._list()
+                if self._watch_removed(data):
+                    break
+        finally:
+            # Fall back to polling, unless we were told to stop.
+            os.close(self._fd)
+            self._fd = None
+            if not self._closed:
+                LOG.debug('no longer notified of changes to %s', self.path)
+
+    @staticmethod
+    def _watch_removed(data):
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            if mask & IN_IGNORED:
+                return True
+            offset += _EVENT_HEADER.size + length
+        return False
+
+    def _list(self):
+        with self._lock:
+            now = time.time()
+            try:
+                mtime = os.stat(self.path).st_mtime
+                names = frozenset(os.listdir(self.path))
+            except OSError:
+                mtime = None
+                names = frozenset()
+            self._names = names
+            self._mtime = mtime
+            self._listed_at = now
+            self._checked_at = now
+
+    def _poll(self):
+        now = time.time()
+        if now - self._checked_at < self.poll_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        # The directory may have changed again within the resolution
+        # of its timestamp after it was listed, so list it until the
+        # last change is older than that.
+        if mtime != self._mtime or (mtime is not None and
+                                    self._listed_at - mtime < 1):
+            self._list()
+
+    def names(self):
+        """Return the names of the files in the directory.
+        """
+        if self.path and self._fd is None and not self._closed:
+            self._poll()
+        return self._names
+
+    def __contains__(self, name):
+        return name in self.names()
+
+    def close(self):
+        """Stop watching the directory.
+        """
+        self._closed = True
+        if self._fd is not None:
+            # The thread is told the watch was removed and exits.
+            _inotify().inotify_rm_watch(self._fd, self._wd)
@@ -19,12 +19,67 @@
 """
 
 import collections
+import time
 
-Event = collections.namedtuple(
+_EventBase = collections.namedtuple(
     'Event',
     ['tenant_id', 'router_id', 'crud', 'body'],
 )
 
+
+class Trace(object):
+    """The times at which an event reached each part of the rug.
+
+    The first hop is when the event was created, usually right after
+    the message was received from AMQP.
+    """
+
+    # Stop recording hops after this many, so an event that keeps a
+    # router busy for a long time does not grow without bounds.
+    MAX_HOPS = 32
+
+    def __init__(self, hops=None):
+        if hops is None:
+            hops = [('received', time.time())]
+        self.hops = hops
+
+    def stamp(self, hop):
+        if len(self.hops) < self.MAX_HOPS:
+            self.hops.append((hop, time.time()))
+
+    @property
+    def total(self):
+        return self.hops[-1][1] - self.hops[0][1]
+
+    def intervals(self):
+        "Return the hops with the seconds since the hop before each."
+        return [
+            (hop, when - prev)
+            for (_, prev), (hop, when) in zip(self.hops, self.hops[1:])
+        ]
+
+
+class Event(_EventBase):
+    """An event for a router, with a trace of where it has been.
+
+    The trace is not part of the value of the event, so events with
+    the same contents compare equal no matter when they were received.
+    """
+
+    # Used for events built by the namedtuple helpers, which do not
+    # go through __new__.
+    trace = None
+
+    def __new__(cls, tenant_id, router_id, crud, body, trace=None):
+        self = _EventBase.__new__(cls, tenant_id, router_id, crud, body)
+        self.trace = trace if trace is not None else Trace()
+        return self
+
+    def __reduce__(self):
+        # Keep the trace when the event is sent to a worker process.
+        return (self.__class__, tuple(self) + (self.trace,))
+
+
 CREATE = 'create'
 READ = 'read'
 UPDATE = 'update'
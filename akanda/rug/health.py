@@ -27,27 +27,37 @@ from akanda.rug import event
 LOG = logging.getLogger(__name__)
 
 
-def _health_inspector(period, scheduler):
+def _health_inspector(period, scheduler, sweep_lock):
     """Runs in the thread.
     """
     while True:
         time.sleep(period)
         LOG.debug('waking up')
-        e = event.Event(
-            tenant_id='*',
-            router_id='*',
-            crud=event.POLL,
-            body={},
-        )
-        scheduler.handle_message('*', e)
+        # Skip this sweep if the routers are still being fed to the
+        # workers by the pre-population task.
+        if not sweep_lock.acquire(False):
+            LOG.debug('pre-population in progress, skipping health check')
+            continue
+        try:
+            e = event.Event(
+                tenant_id='*',
+                router_id='*',
+                crud=event.POLL,
+                body={},
+            )
+            scheduler.handle_message('*', e)
+        finally:
+            sweep_lock.release()
 
 
-def start_inspector(period, scheduler):
+def start_inspector(period, scheduler, sweep_lock=None):
     """Start a health check thread.
     """
+    if sweep_lock is None:
+        sweep_lock = threading.Lock()
     t = threading.Thread(
         target=_health_inspector,
-        args=(period, scheduler,),
+        args=(period, scheduler, sweep_lock),
         name='HealthInspector',
     )
     t.setDaemon(True)
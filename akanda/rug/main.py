@@ -15,20 +15,26 @@
 # under the License.
 
 
+import contextlib
 import functools
 import logging
 import multiprocessing
+import Queue
 import signal
 import socket
 import sys
 import threading
+import time
 
 from oslo.config import cfg
 
+from akanda.rug import bandwidth
+from akanda.rug import control
 from akanda.rug import daemon
 from akanda.rug import health
 from akanda.rug.openstack.common import log
 from akanda.rug import metadata
+from akanda.rug import metrics
 from akanda.rug import notifications
 from akanda.rug import scheduler
 from akanda.rug import populate
@@ -46,6 +52,9 @@ def shuffle_notifications(notification_queue, sched):
             target, message = notification_queue.get()
             if target is None:
                 break
+            metrics.NOTIFICATIONS[getattr(message, 'crud', 'unknown')] += 1
+            if getattr(message, 'trace', None) is not None:
+                message.trace.stamp('shuffled')
             sched.handle_message(target, message)
         except IOError:
             # FIXME(rods): if a signal arrive during an IO operation
@@ -59,6 +68,73 @@ def shuffle_notifications(notification_queue, sched):
             LOG.exception('unhandled exception processing message')
 
 
+class StartupTimer(object):
+    """Time the phases of starting the rug, and log them together.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - start))
+
+    def report(self):
+        LOG.info(
+            'started in %.2f seconds (%s)',
+            time.time() - self.start,
+            ', '.join('%s %.2f' % p for p in self.phases),
+        )
+
+
+def run_in_parallel(timer, steps):
+    """Run the startup steps at the same time, and wait for all of them.
+
+    :param steps: The name and callable of each step.
+    :raises: The error of the first step that failed.
+    """
+    errors = []
+
+    def run(name, func):
+        try:
+            with timer.phase(name):
+                func()
+        except Exception:
+            LOG.exception('%s failed', name)
+            errors.append(sys.exc_info())
+
+    threads = [
+        threading.Thread(target=run, args=step, name=step[0])
+        for step in steps
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+def _ensure_local_ports():
+    # Each port gets its own client, since they are not thread-safe.
+    steps = [
+        ('service port',
+         lambda: quantum_api.Quantum(cfg.CONF).ensure_local_service_port()),
+    ]
+    if cfg.CONF.plug_external_port:
+        steps.append(
+            ('external port',
+             lambda: quantum_api.Quantum(cfg.CONF)
+             .ensure_local_external_port()),
+        )
+    return steps
+
+
 def register_and_load_opts():
 
     # Set the logging format to include the process and thread, since
@@ -104,6 +180,9 @@ def register_and_load_opts():
         cfg.StrOpt('auth_url'),
         cfg.StrOpt('auth_strategy', default='keystone'),
         cfg.StrOpt('auth_region'),
+        cfg.StrOpt('auth_token_cache_file',
+                   help=('File used to share the keystone token between '
+                         'the worker processes')),
 
         cfg.StrOpt('management_network_id'),
         cfg.StrOpt('external_network_id'),
@@ -142,6 +221,14 @@ def register_and_load_opts():
             help='Directory to scan for routers to ignore for debugging',
         ),
 
+        cfg.IntOpt(
+            'pre_populate_rate',
+            default=50,
+            help=('Maximum number of routers per second to send to the '
+                  'workers when pre-populating them on startup, '
+                  '0 for no limit'),
+        ),
+
         cfg.IntOpt(
             'queue_warning_threshold',
             default=worker.Worker.QUEUE_WARNING_THRESHOLD_DEFAULT,
@@ -154,16 +241,44 @@ def register_and_load_opts():
             help=('Number of reboots to allow before assuming '
                   'a router needs manual intervention'),
         ),
+        cfg.IntOpt(
+            'deleted_router_ttl',
+            default=worker.Worker.DELETED_ROUTER_TTL_DEFAULT,
+            help=('Number of seconds to keep ignoring events for a '
+                  'router after it is deleted'),
+        ),
+        cfg.IntOpt(
+            'deleted_router_memory',
+            default=worker.Worker.DELETED_ROUTER_MEMORY_DEFAULT,
+            help=('Kilobytes each worker may use to remember deleted '
+                  'routers, the oldest are forgotten first'),
+        ),
         cfg.IntOpt(
             'error_state_cooldown',
             default=30,
             help=('Number of seconds to ignore new events when a router goes '
                   'into ERROR state'),
         ),
+        cfg.IntOpt(
+            'amqp_prefetch_count',
+            default=100,
+            help=('Maximum number of messages the notification listener '
+                  'receives before acknowledging them, 0 for no limit'),
+        ),
+        cfg.IntOpt(
+            'notification_queue_size',
+            default=10000,
+            help=('Maximum number of events waiting to be handed to the '
+                  'workers before the notification listener stops '
+                  'receiving messages, 0 for no limit'),
+        ),
 
     ])
 
     cfg.CONF.register_opts(metadata.metadata_opts)
+    cfg.CONF.register_opts(metrics.metrics_opts)
+    cfg.CONF.register_opts(bandwidth.bandwidth_opts)
+    cfg.CONF.register_opts(control.control_opts)
 
     AGENT_OPTIONS = [
         cfg.StrOpt('root_helper', default='sudo'),
@@ -210,9 +325,15 @@ def register_and_load_opts():
                          default='notifications.info',
                          help='The name of the topic queue ceilometer '
                               'consumes events from.')
+    c_queue_size = cfg.IntOpt('queue_size',
+                              default=1000,
+                              help='Maximum number of messages waiting to '
+                                   'be sent to ceilometer by each worker, '
+                                   'before new ones are dropped.')
     cfg.CONF.register_group(ceilometer_group)
     cfg.CONF.register_opt(c_enable_reporting, group=ceilometer_group)
     cfg.CONF.register_opt(c_topic, group=ceilometer_group)
+    cfg.CONF.register_opt(c_queue_size, group=ceilometer_group)
 
 
 def main(argv=sys.argv[1:]):
@@ -228,31 +349,37 @@ def main(argv=sys.argv[1:]):
     log.setup('akanda-rug')
     cfg.CONF.log_opt_values(LOG, logging.INFO)
 
-    # Purge the mgt tap interface on startup
-    quantum = quantum_api.Quantum(cfg.CONF)
-    # TODO(mark): develop better way restore after machine reboot
-    # quantum.purge_management_interface()
-
-    # bring the mgt tap interface up
-    quantum.ensure_local_service_port()
-
-    # bring the external port
-    if cfg.CONF.plug_external_port:
-        quantum.ensure_local_external_port()
+    timer = StartupTimer()
 
     # Set up the queue to move messages between the eventlet-based
     # listening process and the scheduler.
-    notification_queue = multiprocessing.Queue()
+    # The listener acknowledges the messages once the events are in
+    # the queue, so a full queue holds the rest back at the broker.
+    notification_queue = multiprocessing.Queue(
+        cfg.CONF.notification_queue_size)
 
     # Ignore signals that might interrupt processing.
     daemon.ignore_signals()
 
     # If we see a SIGINT, stop processing.
     def _stop_processing(*args):
-        notification_queue.put((None, None))
+        try:
+            notification_queue.put_nowait((None, None))
+        except Queue.Full:
+            # The queue is read by the thread we interrupted.
+            raise KeyboardInterrupt()
     signal.signal(signal.SIGINT, _stop_processing)
 
-    # Listen for notifications.
+    # Count the messages the listener receives and drops, for the
+    # metrics.
+    message_counts = None
+    if cfg.CONF.metrics_port:
+        message_counts = notifications.MessageCounts()
+        message_counts.start_reading()
+
+    # Listen for notifications. The local ports are plugged once the
+    # processes are started, so none are forked while the threads
+    # plugging the ports are running.
     notification_proc = multiprocessing.Process(
         target=notifications.listen,
         kwargs={
@@ -261,19 +388,14 @@ def main(argv=sys.argv[1:]):
             'notifications_exchange_name':
             cfg.CONF.incoming_notifications_exchange,
             'rpc_exchange_name': cfg.CONF.rpc_exchange,
-            'notification_queue': notification_queue
+            'notification_queue': notification_queue,
+            'prefetch_count': cfg.CONF.amqp_prefetch_count,
+            'counts': message_counts,
         },
         name='notification-listener',
     )
-    notification_proc.start()
-
-    mgt_ip_address = quantum_api.get_local_service_ip(cfg.CONF).split('/')[0]
-    metadata_proc = multiprocessing.Process(
-        target=metadata.serve,
-        args=(mgt_ip_address,),
-        name='metadata-proxy'
-    )
-    metadata_proc.start()
+    with timer.phase('listener'):
+        notification_proc.start()
 
     # Set up the notifications publisher
     Publisher = (notifications.Publisher if cfg.CONF.ceilometer.enabled
@@ -282,6 +404,7 @@ def main(argv=sys.argv[1:]):
         cfg.CONF.amqp_url,
         exchange_name=cfg.CONF.outgoing_notifications_exchange,
         topic=cfg.CONF.ceilometer.topic,
+        queue_size=cfg.CONF.ceilometer.queue_size,
     )
 
     # Set up a factory to make Workers that know how many threads to
@@ -293,24 +416,65 @@ def main(argv=sys.argv[1:]):
         ignore_directory=cfg.CONF.ignored_router_directory,
         queue_warning_threshold=cfg.CONF.queue_warning_threshold,
         reboot_error_threshold=cfg.CONF.reboot_error_threshold,
+        deleted_router_ttl=cfg.CONF.deleted_router_ttl,
+        deleted_router_memory=cfg.CONF.deleted_router_memory,
+        bandwidth_interval=cfg.CONF.bandwidth_interval,
+        bandwidth_poll_concurrency=cfg.CONF.bandwidth_poll_concurrency,
     )
 
     # Set up the scheduler that knows how to manage the routers and
     # dispatch messages.
-    sched = scheduler.Scheduler(
-        num_workers=cfg.CONF.num_worker_processes,
-        worker_factory=worker_factory,
-    )
-
-    # Prepopulate the workers with existing routers on startup
-    populate.pre_populate_workers(sched)
-
-    # Set up the periodic health check
-    health.start_inspector(cfg.CONF.health_check_period, sched)
+    with timer.phase('workers'):
+        sched = scheduler.Scheduler(
+            num_workers=cfg.CONF.num_worker_processes,
+            worker_factory=worker_factory,
+        )
 
-    # Block the main process, copying messages from the notification
-    # listener to the scheduler
+    metadata_procs = None
     try:
+        # TODO(mark): develop better way restore after machine reboot
+        # quantum.purge_management_interface()
+
+        # Bring the mgt tap interface and the external port up, while
+        # the workers start.
+        run_in_parallel(timer, _ensure_local_ports())
+
+        # The proxy listens on the address of the mgt tap interface.
+        mgt_ip_address = quantum_api.get_local_service_ip(
+            cfg.CONF).split('/')[0]
+        metadata_procs = metadata.ProxyProcesses(
+            mgt_ip_address,
+            cfg.CONF.metadata_workers,
+        )
+        with timer.phase('metadata proxy'):
+            metadata_procs.start()
+
+        # Publish the metrics of all of the workers
+        if cfg.CONF.metrics_port:
+            metrics.start_server(cfg.CONF.metrics_host,
+                                 cfg.CONF.metrics_port,
+                                 sched, message_counts)
+
+        # Answer status queries from rug-ctl
+        if cfg.CONF.control_socket:
+            control.start_server(cfg.CONF.control_socket, sched)
+
+        # Keep the periodic health check from polling all of the
+        # routers while they are still being fed to the workers on
+        # startup.
+        sweep_lock = threading.Lock()
+
+        # Prepopulate the workers with existing routers on startup
+        populate.pre_populate_workers(sched, sweep_lock)
+
+        # Set up the periodic health check
+        health.start_inspector(cfg.CONF.health_check_period, sched,
+                               sweep_lock)
+
+        timer.report()
+
+        # Block the main process, copying messages from the
+        # notification listener to the scheduler
         shuffle_notifications(notification_queue, sched)
     finally:
         # Terminate the scheduler and its workers
@@ -319,6 +483,6 @@ def main(argv=sys.argv[1:]):
         # Terminate the listening process
         LOG.debug('stopping %s', notification_proc.name)
         notification_proc.terminate()
-        LOG.debug('stopping %s', metadata_proc.name)
-        metadata_proc.terminate()
+        if metadata_procs is not None:
+            metadata_procs.stop()
         LOG.info('exiting')
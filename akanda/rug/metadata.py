@@ -33,19 +33,27 @@
 #
 # @author: Mark McClain, DreamHost
 
+import collections
+import errno
 import hashlib
 import hmac
+import multiprocessing
+import signal
 import socket
-import urlparse
+import time
+import urllib
 
 import eventlet
+from eventlet.green import httplib
+import eventlet.greenio
+import eventlet.pools
 import eventlet.wsgi
-import httplib2
 from oslo.config import cfg
 import webob
 import webob.dec
 import webob.exc
 
+from akanda.rug import daemon
 from akanda.rug.openstack.common import log as logging
 
 LOG = logging.getLogger(__name__)
@@ -61,12 +69,138 @@ metadata_opts = [
     cfg.StrOpt('neutron_metadata_proxy_shared_secret',
                default='',
                help='Shared secret to sign instance-id request',
-               deprecated_name='quantum_metadata_proxy_shared_secret')
+               deprecated_name='quantum_metadata_proxy_shared_secret'),
+    cfg.IntOpt('nova_metadata_connections',
+               default=20,
+               help="Maximum number of connections kept open to the Nova "
+                    "metadata server."),
+    cfg.IntOpt('metadata_cache_ttl',
+               default=5,
+               help="Seconds to reuse the answers of the Nova metadata "
+                    "server for the same instance and path, 0 to always "
+                    "ask again."),
+    cfg.IntOpt('metadata_cache_size',
+               default=10000,
+               help="Maximum number of answers of the Nova metadata "
+                    "server kept for reuse."),
+    cfg.IntOpt('metadata_cache_bytes',
+               default=16 * 1024 * 1024,
+               help="Maximum total size in bytes of the answers of the "
+                    "Nova metadata server kept for reuse by each proxy "
+                    "process."),
+    cfg.IntOpt('metadata_workers',
+               default=1,
+               help="Number of processes serving the metadata proxy."),
 ]
 
+# Seconds between reports of how well the cache works.
+CACHE_REPORT_INTERVAL = 300
+
+# From <asm-generic/socket.h>, for the Python versions without it.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+class NovaConnectionPool(eventlet.pools.Pool):
+    """Keep-alive connections to the Nova metadata server.
+    """
+
+    def __init__(self, host, port, max_size, timeout=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        super(NovaConnectionPool, self).__init__(max_size=max_size)
+
+    def create(self):
+        return httplib.HTTPConnection(self.host, self.port,
+                                      timeout=self.timeout)
+
+    def get_url(self, path, headers):
+        """Return the status and the body of the answer to a GET.
+
+        A connection closed by the server while it was idle is opened
+        again, once.
+        """
+        for attempt in (1, 2):
+            with self.item() as conn:
+                try:
+                    conn.request('GET', path, headers=headers)
+                    resp = conn.getresponse()
+                    content = resp.read()
+                except (socket.error, httplib.HTTPException):
+                    conn.close()
+                    if attempt == 2:
+                        raise
+                    continue
+                if resp.will_close:
+                    conn.close()
+                return resp.status, content
+
+
+class ResponseCache(object):
+    """Answers of the Nova metadata server, kept for a few seconds.
+
+    The oldest answers are dropped first when the cache holds max_size
+    answers or max_bytes bytes of them. An answer larger than max_bytes
+    is not kept at all.
+    """
+
+    def __init__(self, ttl, max_size, max_bytes):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        # Total size of the answers kept
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, content = entry
+            if expires > time.time():
+                self.hits += 1
+                return content
+            self._remove(key)
+        self.misses += 1
+        return None
+
+    def put(self, key, content):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        if key in self._entries:
+            self._remove(key)
+        if len(content) > self.max_bytes:
+            return
+        while (len(self._entries) >= self.max_size or
+               self.bytes + len(content) > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+        self._entries[key] = (time.time() + self.ttl, content)
+        self.bytes += len(content)
+
+    def _remove(self, key):
+        expires, content = self._entries.pop(key)
+        self.bytes -= len(content)
+
 
 class MetadataProxyHandler(object):
 
+    # Signatures remembered before starting over.
+    MAX_SIGNATURES = 10000
+
+    def __init__(self, pool=None, cache=None):
+        if pool is None:
+            pool = NovaConnectionPool(cfg.CONF.nova_metadata_ip,
+                                      cfg.CONF.nova_metadata_port,
+                                      cfg.CONF.nova_metadata_connections)
+        if cache is None:
+            cache = ResponseCache(cfg.CONF.metadata_cache_ttl,
+                                  cfg.CONF.metadata_cache_size,
+                                  cfg.CONF.metadata_cache_bytes)
+        self.pool = pool
+        self.cache = cache
+        self._signatures = {}
+
     @webob.dec.wsgify(RequestClass=webob.Request)
     def __call__(self, req):
         try:
@@ -88,86 +222,247 @@ class MetadataProxyHandler(object):
         return req.headers.get('X-Instance-ID')
 
     def _proxy_request(self, instance_id, req):
+        path = urllib.quote(req.path_info)
+        if req.query_string:
+            path += '?' + req.query_string
+
+        # Nova answers the same for the same instance and path, so
+        # the instances reading their metadata while they boot do not
+        # all have to wait for it.
+        key = (instance_id, path)
+        cacheable = req.method == 'GET'
+        if cacheable:
+            content = self.cache.get(key)
+            if content is not None:
+                return content
+
         headers = {
             'X-Forwarded-For': req.headers.get('X-Forwarded-For'),
             'X-Instance-ID': instance_id,
             'X-Instance-ID-Signature': self._sign_instance_id(instance_id),
             'X-Tenant-ID': req.headers.get('X-Tenant-ID')
         }
+        headers = dict((k, v) for k, v in headers.items() if v is not None)
 
-        url = urlparse.urlunsplit((
-            'http',
-            '%s:%s' % (cfg.CONF.nova_metadata_ip,
-                       cfg.CONF.nova_metadata_port),
-            req.path_info,
-            req.query_string,
-            ''))
-
-        h = httplib2.Http()
-        resp, content = h.request(url, headers=headers)
+        status, content = self.pool.get_url(path, headers)
 
-        if resp.status == 200:
-            LOG.debug(str(resp))
+        if status == 200:
+            LOG.debug('%s: %d bytes', path, len(content))
+            if cacheable:
+                self.cache.put(key, content)
             return content
-        elif resp.status == 403:
+        elif status == 403:
             msg = (
                 'The remote metadata server responded with Forbidden. This '
                 'response usually occurs when shared secrets do not match.'
             )
             LOG.warn(msg)
             return webob.exc.HTTPForbidden()
-        elif resp.status == 404:
+        elif status == 404:
             return webob.exc.HTTPNotFound()
-        elif resp.status == 500:
-            LOG.warn(
+        elif status == 500:
+            msg = (
                 'Remote metadata server experienced an internal server error.'
             )
+            LOG.warn(msg)
             return webob.exc.HTTPInternalServerError(explanation=unicode(msg))
         else:
-            raise Exception('Unexpected response code: %s' % resp.status)
+            raise Exception('Unexpected response code: %s' % status)
 
     def _sign_instance_id(self, instance_id):
-        return hmac.new(cfg.CONF.neutron_metadata_proxy_shared_secret,
-                        instance_id,
-                        hashlib.sha256).hexdigest()
+        signature = self._signatures.get(instance_id)
+        if signature is None:
+            if len(self._signatures) >= self.MAX_SIGNATURES:
+                self._signatures.clear()
+            signature = self._signatures[instance_id] = hmac.new(
+                cfg.CONF.neutron_metadata_proxy_shared_secret,
+                instance_id,
+                hashlib.sha256).hexdigest()
+        return signature
+
+
+def _listen(ip_address, port, reuse_port=False):
+    """Open the socket the proxy accepts connections from.
+
+    The management address may not be configured yet when we start,
+    so binding to it is tried a few times.
+    """
+    for i in xrange(5):
+        LOG.info(
+            'Starting the metadata proxy on %s/%s',
+            ip_address, port,
+        )
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            sock.bind((ip_address, port))
+            sock.listen(128)
+        except socket.error as err:
+            sock.close()
+            if err.errno != errno.EADDRNOTAVAIL:
+                raise
+            LOG.warn('Could not create metadata proxy socket: %s', err)
+            LOG.warn('Sleeping %s before trying again', i + 1)
+            time.sleep(i + 1)
+        else:
+            return sock
+    raise RuntimeError(
+        'Could not establish metadata proxy socket on %s/%s' %
+        (ip_address, port)
+    )
+
+
+def _can_reuse_port():
+    "Return True if several sockets can listen on the same port."
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
 
 
 class MetadataProxy(object):
     def __init__(self):
         self.pool = eventlet.GreenPool(1000)
 
-    def run(self, ip_address, port=RUG_META_PORT):
+    def run(self, ip_address, port=RUG_META_PORT, sock=None,
+            reuse_port=False):
+        """Serve the metadata.
+
+        :param sock: A listening socket shared with other proxy
+                     processes, or None to open one.
+        :param reuse_port: Let other processes listen on the port too.
+        """
         app = MetadataProxyHandler()
-        for i in xrange(5):
-            LOG.info(
-                'Starting the metadata proxy on %s/%s',
-                ip_address, port,
-            )
-            try:
-                sock = eventlet.listen(
-                    (ip_address, port),
-                    family=socket.AF_INET6,
-                    backlog=128
-                )
-            except socket.error as err:
-                if err.errno != 99:
-                    raise
-                LOG.warn('Could not create metadata proxy socket: %s', err)
-                LOG.warn('Sleeping %s before trying again', i + 1)
-                eventlet.sleep(i + 1)
-            else:
-                break
-        else:
-            raise RuntimeError(
-                'Could not establish metadata proxy socket on %s/%s' %
-                (ip_address, port)
-            )
+        eventlet.spawn_n(self._report_cache, app.cache)
+        if sock is None:
+            sock = _listen(ip_address, port, reuse_port)
         eventlet.wsgi.server(
-            sock,
+            eventlet.greenio.GreenSocket(sock),
             app,
             custom_pool=self.pool,
             log=logging.WritableLogger(LOG))
 
+    def _report_cache(self, cache):
+        reported = (0, 0)
+        while True:
+            eventlet.sleep(CACHE_REPORT_INTERVAL)
+            counts = (cache.hits, cache.misses)
+            if counts != reported:
+                LOG.info('metadata cache: %d hits, %d misses', *counts)
+                reported = counts
+
+
+def serve(ip_address, port=RUG_META_PORT, sock=None, reuse_port=False):
+    # Do not outlive the rug if it is killed.
+    daemon.die_with_parent()
+    MetadataProxy().run(ip_address, port, sock, reuse_port)
+
+
+def _exit_on_signal(signum, frame):
+    raise SystemExit(0)
+
+
+class ProxyProcesses(object):
+    """Run the metadata proxy in several processes.
+
+    The processes listen on the same port with SO_REUSEPORT, so the
+    kernel spreads the connections over them. Where that is not
+    supported, they all accept the connections from one socket opened
+    here.
+
+    The processes are started, and started again when they exit, by a
+    supervisor process, so they are not forked from the rug while its
+    worker threads are running. The supervisor itself is forked from
+    the rug and only keeps the thread that forked it, but it starts a
+    log writer thread of its own when log_async is set. The proxies
+    forked while that thread is running are safe, because the handlers
+    replace their locks in every process they are forked into.
+    """
+
+    # Seconds between checks that the processes are running.
+    CHECK_INTERVAL = 5
+
+    def __init__(self, ip_address, count, port=RUG_META_PORT):
+        self.ip_address = ip_address
+        self.count = max(count, 1)
+        self.port = port
+        self._reuse_port = False
+        self._sock = None
+        self._procs = []
+        self._supervisor = None
+
+    def start(self):
+        if self.count > 1:
+            self._reuse_port = _can_reuse_port()
+            if not self._reuse_port:
+                LOG.info('SO_REUSEPORT is not supported, sharing one '
+                         'socket between the metadata proxy processes')
+                self._sock = _listen(self.ip_address, self.port)
+        self._supervisor = multiprocessing.Process(
+            target=self._supervise,
+            name='metadata-supervisor',
+        )
+        self._supervisor.start()
+
+    def _spawn(self, index):
+        name = 'metadata-proxy'
+        if self.count > 1:
+            name += '-%d' % index
+        proc = multiprocessing.Process(
+            target=serve,
+            args=(self.ip_address,),
+            kwargs={
+                'port': self.port,
+                'sock': self._sock,
+                'reuse_port': self._reuse_port,
+            },
+            name=name,
+        )
+        proc.start()
+        return proc
+
+    def _start_procs(self):
+        self._procs = [self._spawn(i) for i in xrange(self.count)]
+
+    def check(self):
+        "Start the processes that exited again."
+        for i, proc in enumerate(self._procs):
+            if not proc.is_alive():
+                LOG.warn('%s exited with %s, starting it again',
+                         proc.name, proc.exitcode)
+                self._procs[i] = self._spawn(i)
+
+    def _stop_procs(self):
+        for proc in self._procs:
+            LOG.debug('stopping %s', proc.name)
+            proc.terminate()
+        for proc in self._procs:
+            proc.join(1)
+
+    def _supervise(self):
+        "Start the processes and watch them, in the supervisor process."
+        daemon.die_with_parent()
+        signal.signal(signal.SIGTERM, _exit_on_signal)
+        self._start_procs()
+        try:
+            while True:
+                time.sleep(self.CHECK_INTERVAL)
+                try:
+                    self.check()
+                except Exception:
+                    LOG.exception('could not check the metadata proxy')
+        finally:
+            self._stop_procs()
 
-def serve(ip_address):
-    MetadataProxy().run(ip_address)
+    def stop(self):
+        if self._supervisor is not None:
+            LOG.debug('stopping %s', self._supervisor.name)
+            self._supervisor.terminate()
+            self._supervisor.join(5)
+            self._supervisor = None
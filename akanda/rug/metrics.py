@@ -0,0 +1,263 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Metrics for all of the workers, served over HTTP by the parent.
+
+The parent process asks every worker for its numbers when the metrics
+are requested, and publishes them together in the Prometheus text
+format.
+"""
+
+import BaseHTTPServer
+import collections
+import logging
+import socket
+import threading
+
+from oslo.config import cfg
+
+from akanda.rug import populate
+
+LOG = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# Seconds to wait for the workers to report.
+QUERY_TIMEOUT = 5
+
+metrics_opts = [
+    cfg.StrOpt('metrics_host', default='127.0.0.1',
+               help='Address where the rug serves its metrics.'),
+    cfg.IntOpt('metrics_port', default=9183,
+               help='TCP port where the rug serves its metrics, '
+                    '0 to disable them.'),
+]
+
+# Notifications copied from the listener to the scheduler, keyed by
+# the type of event. Only updated by the main thread of the parent.
+NOTIFICATIONS = collections.Counter()
+
+
+def _escape(value):
+    return (unicode(value).replace('\\', '\\\\')
+            .replace('\n', '\\n').replace('"', '\\"'))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Exposition(object):
+    """Collect samples and render them in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._families = collections.OrderedDict()
+
+    def add(self, name, kind, help_, labels, value, suffix=''):
+        """Add a sample to the metric family called name.
+
+        :param labels: (name, value) pairs, in the order to show them.
+        :param suffix: Appended to the name of the sample, for the
+                       _bucket, _sum and _count parts of histograms.
+        """
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = (kind, help_, [])
+        family[2].append((name + suffix, labels, value))
+
+    def add_histogram(self, name, help_, labels, histogram):
+        "Add the samples for a stats.Histogram."
+        cumulative = 0
+        bounds = list(histogram.buckets) + [float('inf')]
+        for bound, count in zip(bounds, histogram.counts):
+            cumulative += count
+            self.add(name, 'histogram', help_,
+                     labels + [('le', _format_value(float(bound)))],
+                     cumulative, '_bucket')
+        self.add(name, 'histogram', help_, labels, histogram.total, '_sum')
+        self.add(name, 'histogram', help_, labels, histogram.count, '_count')
+
+    def render(self):
+        lines = []
+        for name, (kind, help_, samples) in self._families.items():
+            lines.append('# HELP %s %s' % (name, help_))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for sample_name, labels, value in samples:
+                if labels:
+                    sample_name += '{%s}' % ','.join(
+                        '%s="%s"' % (k, _escape(v)) for k, v in labels
+                    )
+                lines.append('%s %s' % (sample_name, _format_value(value)))
+        return (u'\n'.join(lines) + u'\n').encode('utf-8')
+
+
+def collect(sched, timeout=QUERY_TIMEOUT, message_counts=None):
+    """Gather the metrics of the parent and all of the workers.
+
+    :param sched: The scheduler that owns the workers.
+    :type sched: akanda.rug.scheduler.Scheduler
+    :param message_counts: The messages counted by the listener.
+    :type message_counts: akanda.rug.notifications.MessageCounts
+    :returns: The metrics, in the Prometheus text format.
+    """
+    out = Exposition()
+    for crud, count in sorted(dict(NOTIFICATIONS).items()):
+        out.add('akanda_rug_notifications_total', 'counter',
+                'Notifications received from the message bus.',
+                [('crud', crud)], count)
+    if message_counts is not None:
+        received = message_counts.received
+        dropped = message_counts.dropped
+        for kind, count in sorted(received.items()):
+            out.add('akanda_rug_listener_messages_total', 'counter',
+                    'Messages received by the listener, by event type '
+                    'or RPC method.',
+                    [('type', kind)], count)
+        for kind, count in sorted(dropped.items()):
+            out.add('akanda_rug_listener_dropped_total', 'counter',
+                    'Messages dropped by the listener because they do not '
+                    'concern the routers, by event type or RPC method.',
+                    [('type', kind)], count)
+    progress = populate.status()
+    if progress is not None:
+        out.add('akanda_rug_pre_populate_routers', 'gauge',
+                'Routers found by the pre-population on startup.',
+                [], progress['total'])
+        out.add('akanda_rug_pre_populate_seeded', 'gauge',
+                'Routers sent to the workers by the pre-population.',
+                [], progress['seeded'])
+        out.add('akanda_rug_pre_populate_done', 'gauge',
+                'Whether all of the routers were sent to the workers.',
+                [], int(progress['done']))
+        if progress['eta_seconds'] is not None:
+            out.add('akanda_rug_pre_populate_eta_seconds', 'gauge',
+                    'Estimated seconds until all of the routers are sent '
+                    'to the workers.',
+                    [], progress['eta_seconds'])
+    answers = sched.query('metrics', timeout)
+    for w, answer in zip(sched.workers, answers):
+        worker = [('worker', w['worker'].name)]
+        out.add('akanda_rug_worker_up', 'gauge',
+                'Whether the worker answered the last metrics query.',
+                worker, int(answer is not None))
+        try:
+            inbox = w['queue'].qsize()
+        except NotImplementedError:
+            # Not available on every platform.
+            pass
+        else:
+            out.add('akanda_rug_worker_inbox_depth', 'gauge',
+                    'Messages waiting to be read by the worker.',
+                    worker, inbox)
+        if answer is None:
+            continue
+        out.add('akanda_rug_worker_queue_depth', 'gauge',
+                'Routers waiting for a worker thread.',
+                worker, answer['queue_depth'])
+        out.add('akanda_rug_worker_tenants', 'gauge',
+                'Tenants with routers managed by the worker.',
+                worker, answer['tenants'])
+        for name, thread in sorted(answer['threads'].items()):
+            labels = worker + [('thread', name)]
+            out.add('akanda_rug_thread_alive', 'gauge',
+                    'Whether the worker thread is running.',
+                    labels, int(thread['alive']))
+            out.add('akanda_rug_thread_busy_seconds_total', 'counter',
+                    'Seconds the worker thread spent updating routers.',
+                    labels, thread['busy_seconds'])
+            out.add('akanda_rug_thread_busy_ratio', 'gauge',
+                    'Share of its life the worker thread spent busy.',
+                    labels, thread['busy_ratio'])
+        for vm_state, count in sorted(answer['routers_by_state'].items()):
+            out.add('akanda_rug_routers', 'gauge',
+                    'Routers managed by the worker, by appliance state.',
+                    worker + [('state', vm_state)], count)
+        for (service, call), histogram in answer['api_calls']:
+            out.add_histogram(
+                'akanda_rug_api_call_duration_seconds',
+                'Time taken by calls to neutron, nova and the appliances.',
+                worker + [('service', service), ('call', call)],
+                histogram,
+            )
+        publisher = answer['publisher']
+        out.add('akanda_rug_publisher_queue_depth', 'gauge',
+                'Notifications waiting to be sent to ceilometer.',
+                worker, publisher['queue_depth'])
+        out.add('akanda_rug_publisher_dropped_total', 'counter',
+                'Notifications dropped because the queue was full or '
+                'the message bus could not be reached.',
+                worker, publisher['dropped'])
+        for event_type, histogram in publisher['latency']:
+            out.add_histogram(
+                'akanda_rug_publish_latency_seconds',
+                'Time taken to send notifications, from when they were '
+                'queued.',
+                worker + [('event_type', event_type)],
+                histogram,
+            )
+    return out.render()
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        try:
+            body = collect(self.server.scheduler,
+                           message_counts=self.server.message_counts)
+        except Exception:
+            LOG.exception('could not collect metrics')
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        LOG.debug('%s - %s', self.address_string(), fmt % args)
+
+
+def start_server(host, port, sched, message_counts=None):
+    """Serve the metrics from a thread of the parent process.
+
+    Returns the server, or None when it could not be started. The
+    metrics are not worth stopping the rug for.
+    """
+    try:
+        server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+    except socket.error as e:
+        LOG.error('could not serve metrics on %s:%s: %s', host, port, e)
+        return None
+    server.scheduler = sched
+    server.message_counts = message_counts
+    t = threading.Thread(
+        target=server.serve_forever,
+        name='MetricsServer',
+    )
+    t.setDaemon(True)
+    t.start()
+    LOG.info('serving metrics on http://%s:%s/metrics', host, port)
+    return server
@@ -18,8 +18,13 @@
 """Listen for notifications.
 """
 
+import collections
+import itertools
+import json
 import logging
+import multiprocessing
 import Queue
+import re
 import urlparse
 import threading
 import uuid
@@ -33,6 +38,7 @@ import kombu.messaging
 
 from akanda.rug import commands
 from akanda.rug import event
+from akanda.rug import stats
 
 from akanda.rug.openstack.common import context
 from akanda.rug.openstack.common.rpc import common as rpc_common
@@ -104,6 +110,138 @@ _INTERESTING_NOTIFICATIONS = set([
 ])
 
 
+def _interesting(event_type, method):
+    """Could a message with this event type or RPC method become an event?
+
+    Follows the checks made by _make_event_from_message(), without
+    needing the rest of the message.
+    """
+    if method == 'router_deleted':
+        return True
+    event_type = event_type or ''
+    if event_type.startswith('routerstatus.update'):
+        return False
+    return (event_type in ('router.create.end', 'router.delete.end') or
+            event_type in _INTERFACE_NOTIFICATIONS or
+            event_type in _INTERESTING_NOTIFICATIONS or
+            event_type.endswith('.end') or
+            event_type.startswith('akanda.rug.command'))
+
+
+# The rest of a JSON key and its string value, including inside the
+# RPC envelope, where the message is an escaped string.
+_VALUE_RE = re.compile(r'\\?"\s*:\s*\\?"([^"\\]*)\\?"')
+
+
+def _find_value(key, body):
+    """Returns the value of key in body, '' if it is not there, or None
+    if the body does not show it unambiguously.
+    """
+    key = '"' + key
+    start = body.find(key)
+    if start < 0:
+        return ''
+    if body.find(key, start + 1) >= 0:
+        # The key in a nested document too.
+        return None
+    match = _VALUE_RE.match(body, start + len(key))
+    if match is None:
+        # A value that is not a string, or a longer key.
+        return None
+    return match.group(1)
+
+
+def _peek(message):
+    """Classify a message from the wire without decoding it.
+
+    Returns the event type, or RPC method, of the message and whether
+    it could become an event. When the body does not show them plainly
+    the type is None and the message has to be decoded to find out.
+    """
+    if message.content_type != 'application/json':
+        return None, True
+    body = message.body
+    event_type = _find_value('event_type', body)
+    method = _find_value('method', body)
+    if event_type is None or method is None:
+        return None, True
+    return (event_type or method or None,
+            _interesting(event_type, method))
+
+
+class MessageCounts(object):
+    """The messages the listener received and dropped, by type.
+
+    The listener counts the messages and a thread sends the totals to
+    the parent process every few seconds, where another thread keeps
+    the latest for the metrics.
+    """
+
+    PUBLISH_INTERVAL = 5
+    # Count types seen after this many as 'other', so odd messages
+    # cannot make the totals grow without bounds.
+    MAX_TYPES = 256
+
+    def __init__(self):
+        self.received = collections.Counter()
+        self.dropped = collections.Counter()
+        self._lock = threading.Lock()
+        self._totals = multiprocessing.Queue()
+        self._published = None
+
+    def count(self, kind, dropped):
+        "Count a message of the type given. Called by the listener."
+        kind = kind or 'unknown'
+        with self._lock:
+            if (kind not in self.received and
+                    len(self.received) >= self.MAX_TYPES):
+                kind = 'other'
+            self.received[kind] += 1
+            if dropped:
+                self.dropped[kind] += 1
+
+    def _start(self, target, name):
+        t = threading.Thread(target=target, name=name)
+        t.setDaemon(True)
+        t.start()
+        return t
+
+    def start_publishing(self):
+        "Send the totals to the parent. Called by the listener."
+        return self._start(self._publish, 'MessageCounts')
+
+    def _publish(self):
+        while True:
+            time.sleep(self.PUBLISH_INTERVAL)
+            self.publish()
+
+    def publish(self):
+        "Send the totals to the parent, if they changed since last time."
+        with self._lock:
+            totals = (dict(self.received), dict(self.dropped))
+        if totals != self._published:
+            self._totals.put(totals)
+            self._published = totals
+
+    def start_reading(self):
+        "Keep the totals sent by the listener. Called by the parent."
+        return self._start(self._read, 'MessageCountsReader')
+
+    def _read(self):
+        while True:
+            try:
+                received, dropped = self._totals.get()
+            except IOError:
+                # Interrupted by a signal.
+                continue
+            except EOFError:
+                break
+            # Replace the counters rather than changing them, so they
+            # can be read without the lock.
+            self.received = collections.Counter(received)
+            self.dropped = collections.Counter(dropped)
+
+
 def _make_event_from_message(message):
     """Turn a raw message from the wire into an event.Event object
     """
@@ -159,6 +297,19 @@ def _make_event_from_message(message):
     return event.Event(tenant_id, router_id, crud, message)
 
 
+# Neutron sends its notifications with the priority as the topic, and
+# all of the ones we care about are INFO.
+NOTIFICATIONS_ROUTING_KEY = 'notifications.info'
+OLD_NOTIFICATIONS_ROUTING_KEY = 'notifications.*'
+
+# Seconds to wait for another message before acknowledging the ones
+# received.
+POLL_INTERVAL = 0.001
+
+# Acknowledge at most this many messages at once.
+MAX_ACK_BATCH = 50
+
+
 def _handle_connection_error(exception, interval):
     """ Log connection retry attempts."""
     LOG.warn("Error establishing connection: %s", exception)
@@ -174,11 +325,73 @@ def _kombu_configuration(conf):
     return {k: getattr(conf.CONF.rabbit, k) for k in cfg_keys}
 
 
+class Acknowledger(object):
+    """Acknowledge messages in batches.
+
+    The listener settles the messages from its channel in the order
+    they arrived, so one basic.ack with the multiple flag set covers
+    all of the messages waiting. Transports that do not support the
+    flag get an ack for each message, sent together.
+    """
+
+    def __init__(self, batch_size, multiple=True):
+        self.batch_size = batch_size
+        self.multiple = multiple
+        self._waiting = []
+
+    @property
+    def pending(self):
+        return bool(self._waiting)
+
+    def ack(self, message):
+        self._waiting.append(message)
+        if len(self._waiting) >= self.batch_size:
+            self.flush()
+
+    def reject(self, message):
+        # The messages before this one go first, so the next batch
+        # does not cover it.
+        self.flush()
+        message.reject()
+
+    def flush(self):
+        "Acknowledge the messages waiting."
+        # Forget them first, so a lost connection does not make us
+        # try again forever.
+        waiting, self._waiting = self._waiting, []
+        if not waiting:
+            return
+        if self.multiple:
+            last = waiting[-1]
+            last.channel.basic_ack(last.delivery_tag, multiple=True)
+        else:
+            for message in waiting:
+                message.ack()
+
+
+def _ack_batch_size(prefetch_count):
+    """Return how many messages to acknowledge at once.
+
+    The broker has to be acknowledged before the prefetch window is
+    used up, or it stops sending while we wait for more messages.
+    """
+    if not prefetch_count:
+        return MAX_ACK_BATCH
+    return max(1, min(MAX_ACK_BATCH, prefetch_count // 2))
+
+
 def listen(host_id, amqp_url,
            notifications_exchange_name, rpc_exchange_name,
-           notification_queue):
+           notification_queue, prefetch_count=0, counts=None):
     """Listen for messages from AMQP and deliver them to the
     in-process queue provided.
+
+    :param prefetch_count: The number of messages the broker may send
+                           before the first of them is acknowledged,
+                           0 for no limit. The messages are acknowledged
+                           in batches of up to half of this.
+    :param counts: Where to count the messages received and dropped.
+    :type counts: MessageCounts
     """
     LOG.debug('%s starting to listen on %s', host_id, amqp_url)
 
@@ -224,7 +437,7 @@ def listen(host_id, amqp_url,
         kombu.entity.Queue(
             'akanda.notifications',
             exchange=notifications_exchange,
-            routing_key='notifications.*',
+            routing_key=NOTIFICATIONS_ROUTING_KEY,
             channel=channel,
             durable=False,
             auto_delete=False,
@@ -265,31 +478,74 @@ def listen(host_id, amqp_url,
     for q in queues:
         LOG.debug('setting up queue %s', q)
         q.declare()
+    # Bindings outlive the listener, so remove the one made by earlier
+    # versions for notifications of every priority.
+    try:
+        queues[0].unbind_from(notifications_exchange,
+                              routing_key=OLD_NOTIFICATIONS_ROUTING_KEY)
+    except NotImplementedError:
+        # Not supported by every kombu transport.
+        pass
+
+    if counts is not None:
+        counts.start_publishing()
+
+    def _count(kind, dropped):
+        if counts is not None:
+            counts.count(kind, dropped)
+
+    # The messages are acknowledged once their events are in the
+    # queue, which holds the rest back at the broker when it is full.
+    acks = Acknowledger(
+        _ack_batch_size(prefetch_count),
+        # Only AMQP brokers acknowledge several messages at once.
+        multiple=(connection.transport.driver_type == 'amqp'),
+    )
 
-    def _process_message(body, message):
+    def _process_message(message):
         "Send the message through the notification queue"
-        # LOG.debug('received %r', body)
-        # TODO:
-        #  1. Ignore notification messages that we don't care about.
-        #  2. Convert notification and rpc messages to a common format
-        #     so the lower layer does not have to understand both
+        # TODO: Convert notification and rpc messages to a common
+        # format so the lower layer does not have to understand both
+        event = None
         try:
-            event = _make_event_from_message(body)
+            event = _make_event_from_message(message.decode())
             if event:
                 LOG.debug('received message for %s', event.tenant_id)
                 notification_queue.put((event.tenant_id, event))
         except:
-            LOG.exception('could not process message: %s' % unicode(body))
-            message.reject()
+            LOG.exception('could not process message: %s', message.body)
+            acks.reject(message)
         else:
-            message.ack()
+            acks.ack(message)
+        return event
+
+    def _on_message(message):
+        # Drop the messages we know we do not care about before
+        # decoding them.
+        kind, interesting = _peek(message)
+        if not interesting:
+            _count(kind, True)
+            acks.ack(message)
+        else:
+            event = _process_message(message)
+            _count(kind, not event)
 
-    consumer = kombu.messaging.Consumer(channel, queues)
-    consumer.register_callback(_process_message)
+    consumer = kombu.messaging.Consumer(channel, queues,
+                                        on_message=_on_message)
+    if prefetch_count:
+        consumer.qos(prefetch_count=prefetch_count)
     consumer.consume()
 
     while True:
         try:
+            if acks.pending:
+                # Acknowledge what we have once no more messages are
+                # waiting.
+                try:
+                    connection.drain_events(timeout=POLL_INTERVAL)
+                except socket.timeout:
+                    acks.flush()
+                continue
             connection.drain_events()
         except (KeyboardInterrupt, SystemExit):
             LOG.info('Caught exit signal, exiting...')
@@ -310,16 +566,43 @@ def listen(host_id, amqp_url,
                           'queue')
             time.sleep(1)
 
+    try:
+        acks.flush()
+    except connection.connection_errors:
+        LOG.warning('could not acknowledge the last messages')
     connection.release()
 
 
+# Connection attempts made by a Sender that does not retry forever
+# when max_retries is 0.
+SENDER_MAX_RETRIES = 3
+
+
+def _retry_configuration(conf, forever):
+    """Return the kombu retry parameters from oslo.config.
+
+    0 for max_retries means to retry forever, which kombu does when it
+    is None. When forever is False, SENDER_MAX_RETRIES is used instead.
+    """
+    config = _kombu_configuration(conf)
+    if not config['max_retries']:
+        config['max_retries'] = None if forever else SENDER_MAX_RETRIES
+    return config
+
+
 class Sender(object):
     "Send notification messages"
 
-    def __init__(self, amqp_url, exchange_name, topic):
+    def __init__(self, amqp_url, exchange_name, topic, retry_forever=False):
+        """
+        :param retry_forever: Keep trying to reach the broker when
+                              max_retries is 0, instead of giving up
+                              after SENDER_MAX_RETRIES attempts.
+        """
         self.amqp_url = amqp_url
         self.exchange_name = exchange_name
         self.topic = topic
+        self.retry_forever = retry_forever
 
     def __enter__(self):
         LOG.debug('setting up notification sender for %s to %s',
@@ -328,12 +611,19 @@ class Sender(object):
         # Pre-pack the context in the format used by
         # openstack.common.rpc.amqp.pack_context(). Since we always
         # use the same context, there is no reason to repack it every
-        # time we get a new message.
+        # time we get a new message, or even to serialize it again.
         self._context = context.get_admin_context()
         self._packed_context = dict(
             ('_context_%s' % key, value)
             for (key, value) in self._context.to_dict().iteritems()
         )
+        self._context_keys = frozenset(self._packed_context)
+        self._envelope = json.dumps(self._packed_context)[1:-1]
+
+        # The unique ids only have to differ from each other, so
+        # number them instead of asking for a new uuid every time.
+        self._id_prefix = uuid.uuid4().hex[:24]
+        self._ids = itertools.count()
 
         # We expect to be created in one process and then used in
         # another, so we delay creating any actual AMQP connections or
@@ -346,7 +636,9 @@ class Sender(object):
             virtual_host=conn_info.path,
             port=conn_info.port,
         )
-        self._connection.connect()
+        self._connection.ensure_connection(
+            errback=_handle_connection_error,
+            **_retry_configuration(cfg, self.retry_forever))
         self._channel = self._connection.channel()
 
         # Use the same exchange where we're receiving notifications
@@ -364,30 +656,80 @@ class Sender(object):
             exchange=self._notifications_exchange,
             routing_key=self.topic,
         )
+        # Connect again and publish on a new channel if the
+        # connection is lost.
+        self._publish = self._connection.ensure(
+            self._producer,
+            self._producer.publish,
+            errback=_handle_connection_error,
+            **_retry_configuration(cfg, self.retry_forever))
         return self
 
     def __exit__(self, *args):
         self._connection.release()
 
-    def send(self, incoming):
-        msg = {}
-        msg.update(incoming)
+    def _encode(self, incoming):
         # Do the work of openstack.common.rpc.amqp._add_unique_id()
-        msg['_unique_id'] = uuid.uuid4().hex
-        # Add our context, in the way of
-        # openstack.common.rpc.amqp.pack_context()
+        unique_id = '%s%08x' % (self._id_prefix, next(self._ids))
+        if incoming and self._context_keys.isdisjoint(incoming):
+            # Add our context, in the way of
+            # openstack.common.rpc.amqp.pack_context(), as it was
+            # serialized already.
+            return '{%s, "_unique_id": "%s", %s}' % (
+                json.dumps(incoming)[1:-1], unique_id, self._envelope,
+            )
+        msg = dict(incoming)
+        msg['_unique_id'] = unique_id
         msg.update(self._packed_context)
-        self._producer.publish(msg)
+        return json.dumps(msg)
+
+    def send(self, incoming):
+        self.send_batch([incoming])
+
+    def send_batch(self, messages):
+        """Publish the messages, in order.
+
+        Returns the number of messages published, which is less than
+        all of them when the connection could not be restored.
+        """
+        sent = 0
+        try:
+            for incoming in messages:
+                self._publish(self._encode(incoming),
+                              content_type='application/json',
+                              content_encoding='utf-8')
+                sent += 1
+        except self._connection.connection_errors:
+            LOG.exception('could not publish %d notifications',
+                          len(messages) - sent)
+        return sent
 
 
 class Publisher(object):
+    """Send notification messages from a thread.
+
+    The messages are queued and sent in batches by the thread. When the
+    queue is full, because the messages cannot be sent as fast as they
+    are published, the new messages are dropped and counted.
+    """
 
-    def __init__(self, amqp_url, exchange_name, topic):
+    # Seconds to wait for more messages to send along with the first.
+    BATCH_WINDOW = 0.05
+
+    # Send at most this many messages at once.
+    MAX_BATCH = 100
+
+    def __init__(self, amqp_url, exchange_name, topic, queue_size=1000):
         self.amqp_url = amqp_url
         self.exchange_name = exchange_name
         self.topic = topic
-        self._q = Queue.Queue()
+        self._q = Queue.Queue(queue_size)
         self._t = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+        # Seconds from publish() until the message was sent, by event
+        # type.
+        self.latency = stats.Timings()
 
     def start(self):
         ready = threading.Event()
@@ -406,31 +748,85 @@ class Publisher(object):
     def stop(self):
         if self._t:
             LOG.debug('stopping %s', self._t.getName())
-            self._q.put(None)
-            self._t.join(timeout=1)
+            try:
+                self._q.put(None, timeout=1)
+            except Queue.Full:
+                LOG.warning('%s is not keeping up, not waiting for it',
+                            self._t.getName())
+            else:
+                self._t.join(timeout=1)
             self._t = None
 
     def publish(self, incoming):
-        self._q.put(incoming)
+        try:
+            self._q.put_nowait((time.time(), incoming))
+        except Queue.Full:
+            self._count_dropped(1)
+
+    def _count_dropped(self, count):
+        with self._lock:
+            if not self.dropped:
+                LOG.warning('notification queue is full, dropping messages')
+            self.dropped += count
+
+    def get_stats(self):
+        "Return the numbers reported in the metrics."
+        with self._lock:
+            dropped = self.dropped
+        return {
+            'queue_depth': self._q.qsize(),
+            'dropped': dropped,
+            'latency': self.latency.snapshot(),
+        }
+
+    def _get_batch(self):
+        """Wait for a message, and the ones published soon after it.
+
+        The batch ends with None when we are told to stop.
+        """
+        batch = [self._q.get()]
+        deadline = time.time() + self.BATCH_WINDOW
+        while batch[-1] is not None and len(batch) < self.MAX_BATCH:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self._q.get(timeout=timeout))
+                else:
+                    batch.append(self._q.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
 
     def _send(self, ready):
         """Deliver notification messages from the in-process queue
         to the appropriate topic via the AMQP service.
         """
-        with Sender(self.amqp_url, self.exchange_name, self.topic) as sender:
+        with Sender(self.amqp_url, self.exchange_name, self.topic,
+                    retry_forever=True) as sender:
             # Tell the start() method that we have set up the AMQP
             # communication stuff and are ready to do some work.
             ready.set()
 
-            while True:
-                msg = self._q.get()
-                if msg is None:
-                    break
-                LOG.debug('sending notification %r', msg)
+            stopping = False
+            while not stopping:
+                batch = self._get_batch()
+                if batch[-1] is None:
+                    stopping = True
+                    batch.pop()
+                if not batch:
+                    continue
+                LOG.debug('sending %d notifications', len(batch))
                 try:
-                    sender.send(msg)
+                    sent = sender.send_batch([msg for _, msg in batch])
                 except Exception:
-                    LOG.exception('could not publish notification')
+                    LOG.exception('could not publish notifications')
+                    sent = 0
+                now = time.time()
+                for queued_at, msg in batch[:sent]:
+                    self.latency.observe(msg.get('event_type', 'unknown'),
+                                         now - queued_at)
+                if sent < len(batch):
+                    self._count_dropped(len(batch) - sent)
 
 
 class NoopPublisher(Publisher):
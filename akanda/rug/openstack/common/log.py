@@ -46,15 +46,19 @@ It also allows setting of formatting information through conf.
 
 """
 
+import collections
 import cStringIO
 import inspect
 import itertools
 import logging
 import logging.config
 import logging.handlers
+import multiprocessing.util
 import os
 import stat
 import sys
+import threading
+import time
 import traceback
 
 from oslo.config import cfg
@@ -126,6 +130,27 @@ generic_log_opts = [
                help='Default file mode used when creating log files'),
 ]
 
+async_log_opts = [
+    cfg.BoolOpt('log_async',
+                default=False,
+                help='Write log messages from a background thread, so '
+                     'slow log output does not hold up the threads '
+                     'logging them'),
+    cfg.IntOpt('log_queue_size',
+               default=10000,
+               help='Maximum number of log messages waiting to be '
+                    'written, new DEBUG and INFO messages are dropped '
+                    'when it is full'),
+    cfg.IntOpt('log_rate_limit_burst',
+               default=50,
+               help='Number of times a router may log the same DEBUG or '
+                    'INFO message in each log_rate_limit_interval'),
+    cfg.IntOpt('log_rate_limit_interval',
+               default=10,
+               help='Seconds over which the messages repeated by a router '
+                    'are counted, 0 to disable rate limiting'),
+]
+
 log_opts = [
     cfg.StrOpt('logging_context_format_string',
                default='%(asctime)s.%(msecs)03d %(levelname)s %(name)s '
@@ -177,6 +202,7 @@ CONF = cfg.CONF
 CONF.register_cli_opts(common_cli_opts)
 CONF.register_cli_opts(logging_cli_opts)
 CONF.register_opts(generic_log_opts)
+CONF.register_opts(async_log_opts)
 CONF.register_opts(log_opts)
 
 # our new audit level
@@ -331,6 +357,209 @@ class PublishErrorsHandler(logging.Handler):
                             dict(error=record.msg))
 
 
+class RateLimitFilter(logging.Filter):
+    """Drop the messages a router repeats too often.
+
+    Only DEBUG and INFO messages logged for a router, which carry its
+    id in the router_id attribute of the record, are limited. They are
+    counted together when they come from the same router, at the same
+    level, with the same format string, so a busy router does not use
+    up the allowance of the others. Everything else, such as status
+    reports and warnings, is never dropped. The first message let
+    through after some were dropped says how many were.
+    """
+
+    # Sources tracked before the ones that have gone quiet are forgotten
+    MAX_SOURCES = 10000
+
+    def __init__(self, burst, interval):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.interval = interval
+        self._lock = threading.Lock()
+        # [window start, messages let through, messages dropped],
+        # keyed by source
+        self._windows = {}
+
+    def filter(self, record):
+        router_id = getattr(record, 'router_id', None)
+        if router_id is None or record.levelno > logging.INFO:
+            return True
+        key = (router_id, record.levelno, record.msg)
+        now = record.created
+        with self._lock:
+            window = self._windows.get(key)
+            if window is not None and now - window[0] < self.interval:
+                if window[1] < self.burst:
+                    window[1] += 1
+                    return True
+                window[2] += 1
+                return False
+            if window is None and len(self._windows) >= self.MAX_SOURCES:
+                self._expire(now)
+            self._windows[key] = [now, 1, 0]
+        if window is not None and window[2]:
+            record.msg = '%s (%d similar messages suppressed)' % (
+                record.msg, window[2])
+        return True
+
+    def _expire(self, now):
+        for key, window in self._windows.items():
+            if now - window[0] >= self.interval:
+                del self._windows[key]
+        if len(self._windows) >= self.MAX_SOURCES:
+            self._windows.clear()
+
+
+class AsyncHandler(logging.Handler):
+    """Pass log records to a background thread that writes them.
+
+    A thread logging a message only waits for the record to be added
+    to a buffer, so a stalled log file or syslog daemon does not hold
+    up the worker threads. When the buffer is full new DEBUG and INFO
+    records are dropped, and once the writer catches up it logs how
+    many were lost. Warnings and errors are never dropped: the thread
+    logging them waits for the writer to make room.
+
+    Processes forked after the handler is created start a writer
+    thread of their own the first time they log.
+    """
+
+    def __init__(self, handlers, max_size=10000):
+        """
+        :param handlers: The handlers doing the actual writing.
+        :type handlers: list of logging.Handler
+        :param max_size: The most records waiting to be written.
+        :type max_size: int
+        """
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.max_size = max_size
+        # Held while the writer of a forked process is started, so two
+        # threads logging at once do not both start one.
+        self._start_lock = threading.Lock()
+        self._start()
+
+    def createLock(self):
+        # emit() does its own locking, and only for a moment.
+        self.lock = None
+
+    def _start(self):
+        # The buffer and its lock are replaced in a forked process,
+        # since the lock may have been held by the parent's writer.
+        self._pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        self._records = collections.deque()
+        self._dropped = collections.Counter()
+        # Records dropped since the process started logging
+        self.dropped = 0
+        self._busy = False
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._write_records,
+            name='LogWriter',
+        )
+        self._thread.setDaemon(True)
+        self._thread.start()
+        # Processes started by multiprocessing exit without calling
+        # logging.shutdown(), so write what is left from its exit hook.
+        multiprocessing.util.Finalize(None, self.flush, exitpriority=-100)
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._restart()
+        try:
+            # Build the message now, since the arguments may be changed
+            # by the caller before the writer gets to the record.
+            record.msg = record.getMessage()
+            record.args = None
+        except Exception:
+            self.handleError(record)
+            return
+        with self._cond:
+            if record.levelno >= logging.WARNING:
+                while (len(self._records) >= self.max_size and
+                       self._thread.is_alive()):
+                    self._cond.wait(1)
+            elif len(self._records) >= self.max_size:
+                self._dropped[record.levelname] += 1
+                self.dropped += 1
+                return
+            self._records.append(record)
+            self._cond.notify_all()
+
+    def _restart(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # The parent's writer may have been holding the locks of
+            # the handlers when the process was forked.
+            for handler in self.handlers:
+                handler.createLock()
+            self._start()
+
+    def _write_records(self):
+        cond = self._cond
+        while True:
+            with cond:
+                while not self._records and not self._closed:
+                    self._busy = False
+                    cond.notify_all()
+                    cond.wait()
+                if not self._records:
+                    self._busy = False
+                    cond.notify_all()
+                    return
+                self._busy = True
+                records = list(self._records)
+                self._records.clear()
+                dropped = self._dropped
+                self._dropped = collections.Counter()
+                # Wake up the threads waiting for room.
+                cond.notify_all()
+            for record in records:
+                self._write(record)
+            if dropped:
+                self._write(self._summarize(dropped))
+
+    def _write(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _summarize(self, dropped):
+        counts = ', '.join('%d %s' % (n, level)
+                           for level, n in sorted(dropped.items()))
+        return logging.LogRecord(
+            __name__, logging.WARNING, __file__, 0,
+            'dropped %d log messages (%s) because the log output could '
+            'not keep up' % (sum(dropped.values()), counts),
+            None, None,
+        )
+
+    def flush(self, timeout=5):
+        """Wait for the records already buffered to be written.
+        """
+        if self._pid != os.getpid():
+            return
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._records or self._busy:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._thread.is_alive():
+                    break
+                self._cond.wait(remaining)
+        for handler in self.handlers:
+            handler.flush()
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        logging.Handler.close(self)
+
+
 def _create_logging_excepthook(product_name):
     def logging_excepthook(type, value, tb):
         extra = {}
@@ -422,6 +651,18 @@ def _setup_logging_from_conf():
         else:
             handler.setFormatter(LegacyFormatter(datefmt=datefmt))
 
+    if CONF.log_async:
+        handlers = log_root.handlers[:]
+        for handler in handlers:
+            log_root.removeHandler(handler)
+        async_handler = AsyncHandler(handlers, CONF.log_queue_size)
+        if CONF.log_rate_limit_interval > 0:
+            async_handler.addFilter(RateLimitFilter(
+                CONF.log_rate_limit_burst,
+                CONF.log_rate_limit_interval,
+            ))
+        log_root.addHandler(async_handler)
+
     if CONF.debug:
         log_root.setLevel(logging.DEBUG)
     elif CONF.verbose:
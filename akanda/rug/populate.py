@@ -30,15 +30,137 @@ from akanda.rug.api import quantum
 
 LOG = logging.getLogger(__name__)
 
+# The pre-population running in the parent process, or the last one to
+# finish, for the status queries. None until the routers are fetched.
+PROGRESS = None
 
-def _pre_populate_workers(scheduler):
+
+# Routers are fed to the workers in this order, so the ones most
+# likely to need attention are handled before the healthy ones.
+_STATUS_PRIORITY = {
+    quantum.STATUS_ERROR: 0,
+    quantum.STATUS_BUILD: 1,
+    quantum.STATUS_DOWN: 2,
+}
+
+
+def _router_priority(router):
+    return _STATUS_PRIORITY.get(router.status, len(_STATUS_PRIORITY))
+
+
+class Progress(object):
+    """Keep track of how far along the pre-population is.
+    """
+
+    # Report progress after this many routers have been seeded.
+    REPORT_INTERVAL = 100
+
+    def __init__(self, total):
+        self.total = total
+        self.seeded = 0
+        self.started = time.time()
+        self.finished = None
+
+    def advance(self):
+        self.seeded += 1
+        if self.seeded % self.REPORT_INTERVAL == 0:
+            self.report()
+
+    @property
+    def eta(self):
+        "Estimated number of seconds until all routers are seeded."
+        if not self.seeded:
+            return None
+        elapsed = time.time() - self.started
+        return elapsed / self.seeded * (self.total - self.seeded)
+
+    def finish(self):
+        self.finished = time.time()
+        self.report()
+
+    def report(self):
+        eta = self.eta
+        LOG.info('Pre-populated %d of %d routers, ETA %s seconds',
+                 self.seeded, self.total,
+                 'unknown' if eta is None else int(eta))
+
+    def snapshot(self):
+        "Return the progress reported in the status and the metrics."
+        end = self.finished or time.time()
+        return {
+            'total': self.total,
+            'seeded': self.seeded,
+            'done': self.finished is not None,
+            'elapsed_seconds': end - self.started,
+            'eta_seconds': self.eta,
+        }
+
+
+def status():
+    """Describe the pre-population, or return None if it has not
+    fetched the routers yet.
+    """
+    progress = PROGRESS
+    if progress is None:
+        return None
+    return progress.snapshot()
+
+
+def _feed_routers(scheduler, routers, rate):
+    """Send a POLL for each router to the scheduler.
+
+    Routers in ERROR, BUILD and DOWN state go first. At most rate
+    routers are sent per second, so the workers are not all asked to
+    check their routers at the same moment.
+    """
+    global PROGRESS
+    progress = PROGRESS = Progress(len(routers))
+    interval = 1.0 / rate if rate > 0 else 0
+    next_send = time.time()
+    for router in sorted(routers, key=_router_priority):
+        delay = next_send - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        next_send = max(next_send, time.time()) + interval
+        message = event.Event(
+            tenant_id=router.tenant_id,
+            router_id=router.id,
+            crud=event.POLL,
+            body={}
+        )
+        scheduler.handle_message(router.tenant_id, message)
+        progress.advance()
+    progress.finish()
+    return progress
+
+
+def _pre_populate_workers(scheduler, sweep_lock=None):
     """Fetch the existing routers from quantum.
 
     Wait for quantum to return the list of the existing routers.
     Pause up to max_sleep seconds between each attempt and ignore
     quantum client exceptions.
 
+    The sweep_lock is held from when the routers have been fetched
+    until all of them have been sent to the scheduler, so the periodic
+    health check does not poll them at the same time. It keeps polling
+    while quantum cannot be reached.
+    """
+    if sweep_lock is None:
+        sweep_lock = threading.Lock()
+    quantum_routers = _fetch_routers()
+    if quantum_routers is None:
+        return
+
+    LOG.debug('Start pre-populating the workers with %d fetched routers',
+              len(quantum_routers))
+
+    with sweep_lock:
+        _feed_routers(scheduler, quantum_routers, cfg.CONF.pre_populate_rate)
+
 
+def _fetch_routers():
+    """Return the routers, or None if quantum will not let us list them.
     """
     nap_time = 1
     max_sleep = 15
@@ -47,39 +169,25 @@ def _pre_populate_workers(scheduler):
 
     while True:
         try:
-            quantum_routers = quantum_client.get_routers(detailed=False)
-            break
+            return quantum_client.get_routers(detailed=False)
         except (q_exceptions.Unauthorized, q_exceptions.Forbidden) as err:
             LOG.warning('PrePopulateWorkers thread failed: %s', err)
-            return
+            return None
         except Exception as err:
-            LOG.warning(
-                '%s: %s' % ('Could not fetch routers from quantum', err))
-            LOG.warning('sleeping %s seconds before retrying' % nap_time)
+            LOG.warning('Could not fetch routers from quantum: %s', err)
+            LOG.warning('sleeping %s seconds before retrying', nap_time)
             time.sleep(nap_time)
             # FIXME(rods): should we get max_sleep from the config file?
             nap_time = min(nap_time * 2, max_sleep)
 
-    LOG.debug('Start pre-populating the workers with %d fetched routers',
-              len(quantum_routers))
-
-    for router in quantum_routers:
-        message = event.Event(
-            tenant_id=router.tenant_id,
-            router_id=router.id,
-            crud=event.POLL,
-            body={}
-        )
-        scheduler.handle_message(router.tenant_id, message)
-
 
-def pre_populate_workers(scheduler):
+def pre_populate_workers(scheduler, sweep_lock=None):
     """Start the pre-populating task
     """
 
     t = threading.Thread(
         target=_pre_populate_workers,
-        args=(scheduler,),
+        args=(scheduler, sweep_lock),
         name='PrePopulateWorkers'
     )
 
@@ -20,6 +20,8 @@
 
 import logging
 import multiprocessing
+import threading
+import time
 import uuid
 
 from akanda.rug import commands
@@ -29,12 +31,42 @@ from akanda.rug import daemon
 LOG = logging.getLogger(__name__)
 
 
-def _worker(inq, worker_factory):
+def _answer_queries(conn, worker):
+    """Answer the questions the parent asks about the worker.
+
+    Runs in a thread of the worker process, so the answers do not wait
+    behind the messages queued for the worker.
+    """
+    while True:
+        try:
+            seq, name = conn.recv()
+        except (EOFError, IOError):
+            break
+        try:
+            reply = (seq, True, worker.handle_query(name))
+        except Exception as e:
+            LOG.exception('could not answer query %r', name)
+            reply = (seq, False, unicode(e))
+        try:
+            conn.send(reply)
+        except (EOFError, IOError):
+            break
+
+
+def _worker(inq, worker_factory, queries=None):
     """Scheduler's worker process main function.
     """
     daemon.ignore_signals()
     LOG.debug('starting worker process')
     worker = worker_factory()
+    if queries is not None:
+        t = threading.Thread(
+            target=_answer_queries,
+            args=(queries, worker),
+            name='queries',
+        )
+        t.setDaemon(True)
+        t.start()
     while True:
         try:
             data = inq.get()
@@ -46,10 +78,12 @@ def _worker(inq, worker_factory):
             target, message = None, None
         else:
             target, message = data
+            if getattr(message, 'trace', None) is not None:
+                message.trace.stamp('scheduled')
         try:
             worker.handle_message(target, message)
         except Exception:
-            LOG.exception('Error processing data %s' % unicode(data))
+            LOG.exception('Error processing data %s', data)
         if data is None:
             break
     LOG.debug('exiting')
@@ -102,16 +136,22 @@ class Scheduler(object):
             raise ValueError('Need at least one worker process')
         self.num_workers = num_workers
         self.workers = []
+        # Only one query at a time, so the answers read from each
+        # worker's pipe belong to it.
+        self._query_lock = threading.Lock()
+        self._query_seq = 0
         # Create several worker processes, each with its own queue for
         # sending it instructions based on the notifications we get
         # when someone calls our handle_message() method.
         for i in range(self.num_workers):
             wq = multiprocessing.JoinableQueue()
+            queries, worker_queries = multiprocessing.Pipe()
             worker = multiprocessing.Process(
                 target=_worker,
                 kwargs={
                     'inq': wq,
                     'worker_factory': worker_factory,
+                    'queries': worker_queries,
                 },
                 name='p%02d' % i,
             )
@@ -119,6 +159,7 @@ class Scheduler(object):
             self.workers.append({
                 'queue': wq,
                 'worker': worker,
+                'queries': queries,
             })
         self.dispatcher = Dispatcher(self.workers)
 
@@ -149,3 +190,55 @@ class Scheduler(object):
         """
         for w in self.dispatcher.pick_workers(target):
             w['queue'].put((target, message))
+
+    def query(self, name, timeout=5):
+        """Ask all of the workers the same question.
+
+        The question goes to every worker before any answer is read,
+        so the workers answer at the same time and the whole query
+        takes about as long as the slowest worker.
+
+        :param name: The name of the query, see Worker.handle_query().
+        :type name: str
+        :param timeout: Seconds to wait for the answers.
+        :type timeout: float
+        :returns: A list with the answer of each worker, in the same
+                  order as self.workers, with None for the workers
+                  that did not answer in time.
+        """
+        with self._query_lock:
+            self._query_seq += 1
+            seq = self._query_seq
+            for w in self.workers:
+                try:
+                    w['queries'].send((seq, name))
+                except (EOFError, IOError) as e:
+                    LOG.warning('could not query %s: %s',
+                                w['worker'].name, e)
+            deadline = time.time() + timeout
+            return [
+                self._read_answer(w, seq, deadline)
+                for w in self.workers
+            ]
+
+    @staticmethod
+    def _read_answer(w, seq, deadline):
+        conn = w['queries']
+        while True:
+            remaining = deadline - time.time()
+            try:
+                if remaining <= 0 or not conn.poll(remaining):
+                    LOG.warning('%s did not answer in time', w['worker'].name)
+                    return None
+                answer_seq, ok, value = conn.recv()
+            except (EOFError, IOError) as e:
+                LOG.warning('could not read answer from %s: %s',
+                            w['worker'].name, e)
+                return None
+            if answer_seq != seq:
+                # A late answer to an earlier query that timed out.
+                continue
+            if not ok:
+                LOG.warning('%s could not answer: %s', w['worker'].name, value)
+                return None
+            return value
@@ -23,13 +23,46 @@
 # https://docs.google.com/a/dreamhost.com/document/d/1Ed5wDqCHW-CUt67ufjOUq4uYj0ECS5PweHxoueUoYUI/edit # noqa
 
 import collections
-import itertools
 import logging
+import threading
+import time
 
 from oslo.config import cfg
 
 from akanda.rug.event import POLL, CREATE, READ, UPDATE, DELETE, REBUILD
+from akanda.rug.event import Trace
+from akanda.rug import stats
 from akanda.rug import vm_manager
+from akanda.rug.openstack.common import timeutils
+
+LOG = logging.getLogger(__name__)
+
+# Time spent in the execute() and transition() methods of each state,
+# for all of the routers in the worker, keyed by (state name, method).
+TIMINGS = stats.Timings()
+
+# Traces of the events handled by the state machines in the worker,
+# from the time they were received until the router was done with
+# them.
+TRACES = stats.TraceBuffer()
+
+
+class RouterLog(logging.LoggerAdapter):
+    """Log messages for one router through the module logger.
+
+    Loggers created with logging.getLogger() are never freed, so the
+    state machines share a logger and put the router id in their
+    messages instead of each having a logger of its own. The id is also
+    set as the router_id attribute of the records, which the log rate
+    limit counts the messages of each router by.
+    """
+
+    def __init__(self, logger, router_id):
+        super(RouterLog, self).__init__(logger, {'router_id': router_id})
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = self.extra
+        return '%s: %s' % (self.extra['router_id'], msg), kwargs
 
 
 class StateParams(object):
@@ -41,6 +74,101 @@ class StateParams(object):
         self.bandwidth_callback = bandwidth_callback
         self.reboot_error_threshold = reboot_error_threshold
         self.router_image_uuid = router_image_uuid
+        # The states keep everything they need in the params, so each
+        # router only needs one instance of each state class.
+        self._states = {}
+
+    def state(self, cls):
+        "Return the instance of the state class for this router."
+        try:
+            return self._states[cls]
+        except KeyError:
+            st = self._states[cls] = cls(self)
+            return st
+
+
+class PendingActions(object):
+    """The actions waiting to be run by a state machine.
+
+    Events are merged with the pending actions as they arrive, instead
+    of piling up for CalcAction to collapse later, so a storm of events
+    leaves at most one entry for each kind of action behind:
+
+    - A DELETE replaces everything else, and nothing is added after it.
+    - A POLL following any other action is dropped, and a pending POLL
+      is replaced by whatever arrives next.
+    - An action that is already pending is dropped. The pending one
+      looks at the router when it runs, so it does the work of both.
+    - A CREATE replaces an UPDATE just before it, and an UPDATE
+      following a CREATE is dropped.
+    - Anything else is added to the end of the queue.
+
+    CalcAction merges consecutive actions the same way, and still
+    upgrades a CREATE or UPDATE to the REBUILD after it. A REBUILD is
+    not merged into the action before it here, because it could then
+    be merged with a REBUILD before that. CalcAction holds the lock
+    while it looks at the queue, since merging can change the entries.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._actions = collections.deque()
+        # Number of events received since the queue was last empty,
+        # including the ones merged into the pending actions.
+        self.events = 0
+
+    def append(self, action):
+        with self.lock:
+            self.events += 1
+            actions = self._actions
+            if DELETE in actions:
+                return
+            if action == DELETE:
+                actions.clear()
+                actions.append(DELETE)
+                return
+            if not actions:
+                actions.append(action)
+                return
+            last = actions[-1]
+            if (action == POLL or action in actions or
+                    (last, action) == (CREATE, UPDATE)):
+                return
+            if last == POLL or (last, action) == (UPDATE, CREATE):
+                actions[-1] = action
+            else:
+                actions.append(action)
+
+    def appendleft(self, action):
+        "Put an action back at the front of the queue."
+        with self.lock:
+            self._actions.appendleft(action)
+
+    def popleft(self):
+        with self.lock:
+            action = self._actions.popleft()
+            if not self._actions:
+                self.events = 0
+            return action
+
+    def __getitem__(self, index):
+        with self.lock:
+            return self._actions[index]
+
+    def __len__(self):
+        return len(self._actions)
+
+    def __contains__(self, action):
+        with self.lock:
+            return action in self._actions
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self._actions))
+
+    def __repr__(self):
+        with self.lock:
+            return repr(self._actions)
 
 
 class State(object):
@@ -71,6 +199,9 @@ class State(object):
     def __str__(self):
         return self.name
 
+    def _state(self, cls):
+        return self.params.state(cls)
+
     def execute(self, action, worker_context):
         return action
 
@@ -80,7 +211,12 @@ class State(object):
 
 class CalcAction(State):
     def execute(self, action, worker_context):
-        queue = self.queue
+        # Hold the queue lock so new events are not merged into the
+        # entries while we look at them.
+        with self.queue.lock:
+            return self._collapse(action, self.queue)
+
+    def _collapse(self, action, queue):
         if DELETE in queue:
             self.log.debug('shortcutting to delete')
             return DELETE
@@ -90,7 +226,7 @@ class CalcAction(State):
                 'action = %s, len(queue) = %s, queue = %s',
                 action,
                 len(queue),
-                list(itertools.islice(queue, 0, 60))
+                queue,
             )
 
             if action == UPDATE and queue[0] == CREATE:
@@ -103,7 +239,7 @@ class CalcAction(State):
             elif action in (CREATE, UPDATE) and queue[0] == REBUILD:
                 # upgrade to REBUILD from CREATE/UPDATE by taking the next
                 # item from the queue
-                self.log.debug('upgrading from %s to rebuild' % action)
+                self.log.debug('upgrading from %s to rebuild', action)
                 action = queue.popleft()
                 continue
 
@@ -137,17 +273,17 @@ class CalcAction(State):
 
     def transition(self, action, worker_context):
         if self.vm.state == vm_manager.GONE:
-            next_action = StopVM(self.params)
+            next_action = self._state(StopVM)
         elif action == DELETE:
-            next_action = StopVM(self.params)
+            next_action = self._state(StopVM)
         elif action == REBUILD:
-            next_action = RebuildVM(self.params)
+            next_action = self._state(RebuildVM)
         elif self.vm.state == vm_manager.BOOTING:
-            next_action = CheckBoot(self.params)
+            next_action = self._state(CheckBoot)
         elif self.vm.state == vm_manager.DOWN:
-            next_action = CreateVM(self.params)
+            next_action = self._state(CreateVM)
         else:
-            next_action = Alive(self.params)
+            next_action = self._state(Alive)
         if self.vm.state == vm_manager.ERROR:
             if action == POLL:
                 # If the selected action is to poll, and we are in an
@@ -163,7 +299,9 @@ class CalcAction(State):
                 # If this isn't a POLL, and the configured `error_cooldown`
                 # has passed, clear the error status before doing what we
                 # really want to do.
-                next_action = ClearError(self.params, next_action)
+                next_action = self._state(ClearError).set_next_state(
+                    next_action,
+                )
         return next_action
 
 
@@ -176,7 +314,7 @@ class PushUpdate(State):
         return action
 
     def transition(self, action, worker_context):
-        return CalcAction(self.params)
+        return self._state(CalcAction)
 
 
 class ClearError(State):
@@ -187,6 +325,11 @@ class ClearError(State):
         super(ClearError, self).__init__(params)
         self._next_state = next_state
 
+    def set_next_state(self, next_state):
+        "Set the state to go to once the error is cleared."
+        self._next_state = next_state
+        return self
+
     def execute(self, action, worker_context):
         # If we are being told explicitly to update the VM, we should
         # ignore any error status.
@@ -196,7 +339,7 @@ class ClearError(State):
     def transition(self, action, worker_context):
         if self._next_state:
             return self._next_state
-        return CalcAction(self.params)
+        return self._state(CalcAction)
 
 
 class Alive(State):
@@ -206,15 +349,15 @@ class Alive(State):
 
     def transition(self, action, worker_context):
         if self.vm.state == vm_manager.GONE:
-            return StopVM(self.params)
+            return self._state(StopVM)
         elif self.vm.state == vm_manager.DOWN:
-            return CreateVM(self.params)
+            return self._state(CreateVM)
         elif action == POLL and self.vm.state == vm_manager.CONFIGURED:
-            return CalcAction(self.params)
+            return self._state(CalcAction)
         elif action == READ and self.vm.state == vm_manager.CONFIGURED:
-            return ReadStats(self.params)
+            return self._state(ReadStats)
         else:
-            return ConfigureVM(self.params)
+            return self._state(ConfigureVM)
 
 
 class CreateVM(State):
@@ -234,12 +377,12 @@ class CreateVM(State):
 
     def transition(self, action, worker_context):
         if self.vm.state == vm_manager.GONE:
-            return StopVM(self.params)
+            return self._state(StopVM)
         elif self.vm.state == vm_manager.ERROR:
-            return CalcAction(self.params)
+            return self._state(CalcAction)
         elif self.vm.state == vm_manager.DOWN:
-            return CreateVM(self.params)
-        return CheckBoot(self.params)
+            return self._state(CreateVM)
+        return self._state(CheckBoot)
 
 
 class CheckBoot(State):
@@ -254,13 +397,13 @@ class CheckBoot(State):
 
     def transition(self, action, worker_context):
         if self.vm.state == vm_manager.REPLUG:
-            return ReplugVM(self.params)
+            return self._state(ReplugVM)
         if self.vm.state in (vm_manager.DOWN,
                              vm_manager.GONE):
-            return StopVM(self.params)
+            return self._state(StopVM)
         if self.vm.state == vm_manager.UP:
-            return ConfigureVM(self.params)
-        return CalcAction(self.params)
+            return self._state(ConfigureVM)
+        return self._state(CalcAction)
 
 
 class ReplugVM(State):
@@ -270,8 +413,8 @@ class ReplugVM(State):
 
     def transition(self, action, worker_context):
         if self.vm.state == vm_manager.RESTART:
-            return StopVM(self.params)
-        return ConfigureVM(self.params)
+            return self._state(StopVM)
+        return self._state(ConfigureVM)
 
 
 class StopVM(State):
@@ -287,10 +430,10 @@ class StopVM(State):
         if self.vm.state not in (vm_manager.DOWN, vm_manager.GONE):
             return self
         if self.vm.state == vm_manager.GONE:
-            return Exit(self.params)
+            return self._state(Exit)
         if action == DELETE:
-            return Exit(self.params)
-        return CreateVM(self.params)
+            return self._state(Exit)
+        return self._state(CreateVM)
 
 
 class RebuildVM(State):
@@ -308,8 +451,8 @@ class RebuildVM(State):
         if self.vm.state not in (vm_manager.DOWN, vm_manager.GONE):
             return self
         if self.vm.state == vm_manager.GONE:
-            return Exit(self.params)
-        return CreateVM(self.params)
+            return self._state(Exit)
+        return self._state(CreateVM)
 
 
 class Exit(State):
@@ -329,34 +472,35 @@ class ConfigureVM(State):
 
     def transition(self, action, worker_context):
         if self.vm.state == vm_manager.REPLUG:
-            return ReplugVM(self.params)
+            return self._state(ReplugVM)
         if self.vm.state in (vm_manager.RESTART,
                              vm_manager.DOWN,
                              vm_manager.GONE):
-            return StopVM(self.params)
+            return self._state(StopVM)
         if self.vm.state == vm_manager.UP:
-            return PushUpdate(self.params)
+            return self._state(PushUpdate)
         # Below here, assume vm.state == vm_manager.CONFIGURED
         if action == READ:
-            return ReadStats(self.params)
-        return CalcAction(self.params)
+            return self._state(ReadStats)
+        return self._state(CalcAction)
 
 
 class ReadStats(State):
     def execute(self, action, worker_context):
-        stats = self.vm.read_stats()
-        self.params.bandwidth_callback(stats)
+        # The traffic is read by the worker, without waiting for it here.
+        self.params.bandwidth_callback(self.vm.router_id)
         return POLL
 
     def transition(self, action, worker_context):
-        return CalcAction(self.params)
+        return self._state(CalcAction)
 
 
 class Automaton(object):
     def __init__(self, router_id, tenant_id,
                  delete_callback, bandwidth_callback,
                  worker_context, queue_warning_threshold,
-                 reboot_error_threshold):
+                 reboot_error_threshold, error_callback=None,
+                 router_callback=None):
         """
         :param router_id: UUID of the router being managed
         :type router_id: str
@@ -366,10 +510,9 @@ class Automaton(object):
                                 the router should be deleted.
         :type delete_callback: callable
         :param bandwidth_callback: To be invoked when the Automaton
-                                   needs to report how much bandwidth
+                                   is asked to report how much bandwidth
                                    a router has used.
-        :type bandwidth_callback: callable taking router_id and bandwidth
-                                  info dict
+        :type bandwidth_callback: callable taking router_id
         :param worker_context: a WorkerContext
         :type worker_context: WorkerContext
         :param queue_warning_threshold: Limit after which adding items
@@ -378,6 +521,13 @@ class Automaton(object):
         :param reboot_error_threshold: Limit after which trying to reboot
                                        the router puts it into an error state.
         :type reboot_error_threshold: int
+        :param error_callback: Invoked when the router goes into or
+                               out of the ERROR state.
+        :type error_callback: callable taking router_id and a flag
+                              set when the router is in ERROR
+        :param router_callback: Invoked each time the router details
+                                are loaded from neutron.
+        :type router_callback: callable taking a quantum.Router
         """
         self.router_id = router_id
         self.tenant_id = tenant_id
@@ -386,12 +536,18 @@ class Automaton(object):
         self._reboot_error_threshold = reboot_error_threshold
         self.deleted = False
         self.bandwidth_callback = bandwidth_callback
-        self._queue = collections.deque()
-        self.log = logging.getLogger(__name__ + '.' + router_id)
+        self._queue = PendingActions()
+        # The trace of the oldest event waiting for the router. The
+        # events merged into it are newer, so they would only show
+        # shorter delays.
+        self._trace = None
+        self.log = RouterLog(LOG, router_id)
 
         self.action = POLL
         self.vm = vm_manager.VmManager(router_id, tenant_id, self.log,
-                                       worker_context)
+                                       worker_context,
+                                       error_callback=error_callback,
+                                       router_callback=router_callback)
         self._state_params = StateParams(
             self.vm,
             self.log,
@@ -400,7 +556,9 @@ class Automaton(object):
             self._reboot_error_threshold,
             cfg.CONF.router_image_uuid
         )
-        self.state = CalcAction(self._state_params)
+        self.state = self._state_params.state(CalcAction)
+        # When the state machine last moved to another state.
+        self.last_transition = time.time()
 
     def service_shutdown(self):
         "Called when the parent process is being stopped"
@@ -416,6 +574,17 @@ class Automaton(object):
 
     def update(self, worker_context):
         "Called when the router config should be changed"
+        if self._trace is not None:
+            self._trace.stamp('update')
+        try:
+            self._update(worker_context)
+        finally:
+            if self._trace is not None:
+                self._trace.stamp('done')
+                TRACES.add(self._trace)
+                self._trace = None
+
+    def _update(self, worker_context):
         while self._queue:
             while True:
                 if self.deleted:
@@ -424,6 +593,9 @@ class Automaton(object):
                     )
                     return
 
+                if self._trace is not None:
+                    self._trace.stamp(self.state.name)
+                start = time.time()
                 try:
                     self.log.debug('%s.execute(%s) vm.state=%s',
                                    self.state, self.action, self.vm.state)
@@ -439,12 +611,26 @@ class Automaton(object):
                         self.state,
                         self.action
                     )
+                finally:
+                    TIMINGS.observe((self.state.name, 'execute'),
+                                    time.time() - start)
+                if (self._trace is not None and
+                        isinstance(self.state, ConfigureVM) and
+                        self.vm.state == vm_manager.CONFIGURED):
+                    self._trace.stamp('configured')
 
                 old_state = self.state
-                self.state = self.state.transition(
-                    self.action,
-                    worker_context,
-                )
+                start = time.time()
+                try:
+                    self.state = self.state.transition(
+                        self.action,
+                        worker_context,
+                    )
+                finally:
+                    TIMINGS.observe((old_state.name, 'transition'),
+                                    time.time() - start)
+                if self.state is not old_state:
+                    self.last_transition = time.time()
                 self.log.debug('%s.transition(%s) -> %s vm.state=%s',
                                old_state, self.action, self.state,
                                self.vm.state)
@@ -493,12 +679,21 @@ class Automaton(object):
                 self.router_image_uuid = cfg.CONF.router_image_uuid
 
         self._queue.append(message.crud)
-        queue_len = len(self._queue)
-        if queue_len > self._queue_warning_threshold:
+        trace = getattr(message, 'trace', None)
+        if self._trace is None and isinstance(trace, Trace):
+            # A wildcard event goes to every router, so each state
+            # machine records its own copy of the trace.
+            self._trace = Trace(list(trace.hops))
+            self._trace.stamp('queued')
+        # The queue itself stays short because events are merged, so
+        # warn about the number of events waiting instead.
+        backlog = self._queue.events
+        if backlog > self._queue_warning_threshold:
             logger = self.log.warning
         else:
             logger = self.log.debug
-        logger('incoming message brings queue length to %s', queue_len)
+        logger('incoming message brings queue length to %s (%s events)',
+               len(self._queue), backlog)
         return True
 
     @property
@@ -509,6 +704,21 @@ class Automaton(object):
     def router_image_uuid(self, value):
         self.state.params.router_image_uuid = value
 
+    def get_status(self):
+        """Return a description of the router for status queries.
+        """
+        return {
+            'router_id': self.router_id,
+            'tenant_id': self.tenant_id,
+            'state': self.state.name,
+            'vm_state': self.vm.state,
+            'last_transition': timeutils.iso8601_from_timestamp(
+                self.last_transition
+            ),
+            'pending': list(self._queue),
+            'deleted': self.deleted,
+        }
+
     def has_more_work(self):
         "Called to check if there are more messages in the state machine queue"
         return (not self.deleted) and bool(self._queue)
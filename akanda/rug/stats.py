@@ -0,0 +1,173 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Timing statistics collected inside a worker process.
+"""
+
+import bisect
+import collections
+import copy
+import functools
+import threading
+import time
+
+# Upper bounds, in seconds, of the histogram buckets. Anything slower
+# than the last bound goes in an extra overflow bucket.
+BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0, 60.0, 300.0)
+
+
+class Histogram(object):
+    """Count durations in buckets.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def average(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def format_buckets(self):
+        "Return the non-empty buckets as text, for logging."
+        labels = ['<=%gs' % b for b in self.buckets]
+        labels.append('>%gs' % self.buckets[-1])
+        return ' '.join(
+            '%s:%d' % (label, n)
+            for label, n in zip(labels, self.counts)
+            if n
+        )
+
+
+class Timings(object):
+    """Histograms of the time taken by named steps.
+
+    Safe to update from several threads.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def observe(self, key, seconds):
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = Histogram(self._buckets)
+            h.observe(seconds)
+
+    def snapshot(self):
+        "Return sorted (key, Histogram) pairs with copies of the data."
+        with self._lock:
+            return sorted(
+                (key, copy.deepcopy(h))
+                for key, h in self._histograms.items()
+            )
+
+
+# Time taken by the calls made to neutron, nova and the appliances
+# from this process, keyed by (service, call name).
+API_CALLS = Timings()
+
+
+def timed(service, timings=API_CALLS):
+    """Decorate a function to record how long each call to it takes.
+
+    Failed calls are recorded too, since a slow failure costs as much
+    as a slow success.
+    """
+    def decorator(f):
+        key = (service, f.__name__)
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                timings.observe(key, time.time() - start)
+        return wrapper
+    return decorator
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of a sorted list of values.
+    """
+    if not values:
+        return 0.0
+    idx = max(0, int(round(pct / 100.0 * len(values))) - 1)
+    return values[min(idx, len(values) - 1)]
+
+
+class TraceBuffer(object):
+    """Keep the most recently completed event traces.
+
+    Old traces are dropped as new ones arrive, so the summaries describe
+    recent behavior and the memory used is fixed.
+    """
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, size=1000):
+        self._lock = threading.Lock()
+        self._traces = collections.deque(maxlen=size)
+
+    def add(self, trace):
+        with self._lock:
+            self._traces.append(trace)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._traces)
+
+    def summary(self):
+        """Return the latency percentiles for each hop and for the total.
+
+        The result is a list of (hop, count, percentiles) tuples, where
+        percentiles maps each of PERCENTILES to the seconds taken to
+        reach the hop from the one before it. The hops are listed in
+        the order they were first seen, followed by 'total'.
+        """
+        with self._lock:
+            traces = list(self._traces)
+        durations = collections.OrderedDict()
+        for trace in traces:
+            for hop, seconds in trace.intervals():
+                durations.setdefault(hop, []).append(seconds)
+        if traces:
+            durations['total'] = [t.total for t in traces]
+        result = []
+        for hop, values in durations.items():
+            values.sort()
+            result.append((
+                hop,
+                len(values),
+                dict((p, percentile(values, p)) for p in self.PERCENTILES),
+            ))
+        return result
@@ -21,24 +21,215 @@
 import collections
 import logging
 import threading
+import time
 
 from akanda.rug import state
-from akanda.rug.openstack.common import timeutils
 
 LOG = logging.getLogger(__name__)
 
 
-class RouterContainer(object):
+class DeletedRouters(object):
+    """Remember the routers that were deleted, for a limited time.
+
+    Events that arrive for a router after it was deleted are dropped
+    instead of creating a new state machine that has to ask neutron
+    whether the router still exists. Lookups are a dict access, and
+    the set is shared by all of the tenant managers in a worker.
+
+    Entries expire after ttl seconds. If more routers are deleted
+    within that time than fit in memory_kb, the oldest entries are
+    dropped early.
+    """
+
+    # Rough number of bytes used by an entry, counting the router id,
+    # the expiry time and the container overhead.
+    ENTRY_SIZE = 256
+
+    def __init__(self, ttl=3600, memory_kb=1024):
+        self.ttl = ttl
+        self.capacity = max(1, memory_kb * 1024 // self.ENTRY_SIZE)
+        self._lock = threading.Lock()
+        # Expiry time, keyed by router id
+        self._expires = {}
+        # (expiry time, router id) in the order the routers were
+        # deleted, which is also the order they expire in.
+        self._order = collections.deque()
+
+    def add(self, router_id):
+        with self._lock:
+            now = time.time()
+            expires = now + self.ttl
+            self._expires[router_id] = expires
+            self._order.append((expires, router_id))
+            self._purge(now)
+
+    def _purge(self, now):
+        while self._order:
+            expires, router_id = self._order[0]
+            if expires > now and len(self._expires) <= self.capacity:
+                break
+            self._order.popleft()
+            # A router deleted more than once has several entries in
+            # the order queue, so only the newest one removes it.
+            if self._expires.get(router_id) == expires:
+                del self._expires[router_id]
+
+    def __contains__(self, router_id):
+        expires = self._expires.get(router_id)
+        return expires is not None and expires > time.time()
+
+    def __len__(self):
+        return len(self._expires)
+
+
+class ErroredRouters(object):
+    """Index of the routers in the ERROR state, by tenant.
+
+    The state machines report their routers going into and out of
+    ERROR, so commands sent to the errored routers only have to look
+    at those routers instead of asking every state machine. The index
+    is shared by all of the tenant managers in a worker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Sets of router ids, keyed by tenant id. Tenants without
+        # errored routers are not listed.
+        self._by_tenant = {}
+
+    def set(self, tenant_id, router_id, error):
+        with self._lock:
+            if error:
+                self._by_tenant.setdefault(tenant_id, set()).add(router_id)
+            else:
+                self._discard(tenant_id, router_id)
+
+    def discard(self, tenant_id, router_id):
+        with self._lock:
+            self._discard(tenant_id, router_id)
+
+    def _discard(self, tenant_id, router_id):
+        routers = self._by_tenant.get(tenant_id)
+        if routers is None:
+            return
+        routers.discard(router_id)
+        if not routers:
+            del self._by_tenant[tenant_id]
+
+    def routers(self, tenant_id):
+        "Return the ids of the errored routers owned by the tenant."
+        with self._lock:
+            return set(self._by_tenant.get(tenant_id, ()))
+
+    def tenants(self):
+        "Return the ids of the tenants with errored routers."
+        with self._lock:
+            return list(self._by_tenant)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(r) for r in self._by_tenant.values())
+
+
+class NetworkRouters(object):
+    """Index of the routers attached to each network, subnet and port.
+
+    The index is built from the internal ports of the routers, as they
+    are loaded by the state machines, so events about a network can be
+    sent to the routers attached to it without asking neutron. Network,
+    subnet and port ids are all UUIDs, so they share one index. It is
+    shared by all of the tenant managers in a worker.
+    """
 
     def __init__(self):
+        self._lock = threading.Lock()
+        # Sets of router ids, keyed by network, subnet or port id
+        self._routers = {}
+        # The ids each router is listed under, keyed by router id
+        self._keys = {}
+
+    def update(self, router):
+        keys = set()
+        for port in router.internal_ports:
+            keys.add(port.id)
+            keys.add(port.network_id)
+            keys.update(ip.subnet_id for ip in port.fixed_ips)
+        with self._lock:
+            old_keys = self._keys.get(router.id, set())
+            if keys == old_keys:
+                return
+            for key in old_keys - keys:
+                self._remove(key, router.id)
+            for key in keys - old_keys:
+                self._routers.setdefault(key, set()).add(router.id)
+            if keys:
+                self._keys[router.id] = keys
+            else:
+                self._keys.pop(router.id, None)
+
+    def discard(self, router_id):
+        with self._lock:
+            for key in self._keys.pop(router_id, ()):
+                self._remove(key, router_id)
+
+    def _remove(self, key, router_id):
+        routers = self._routers[key]
+        routers.discard(router_id)
+        if not routers:
+            del self._routers[key]
+
+    def routers(self, keys):
+        "Return the ids of the routers attached to any of the keys."
+        with self._lock:
+            found = set()
+            for key in keys:
+                found.update(self._routers.get(key, ()))
+            return found
+
+    def __len__(self):
+        with self._lock:
+            return len(self._routers)
+
+
+def _network_keys_for_message(message):
+    """Return the network, subnet and port ids in a port or subnet event.
+    """
+    body = message.body
+    if not isinstance(body, dict):
+        return set()
+    payload = body.get('payload')
+    if not isinstance(payload, dict):
+        return set()
+    keys = set()
+    port = payload.get('port')
+    if isinstance(port, dict):
+        keys.add(port.get('id'))
+        keys.add(port.get('network_id'))
+        keys.update(ip.get('subnet_id') for ip in port.get('fixed_ips', []))
+    subnet = payload.get('subnet')
+    if isinstance(subnet, dict):
+        keys.add(subnet.get('id'))
+        keys.add(subnet.get('network_id'))
+    # The delete notifications only give the id.
+    keys.add(payload.get('port_id'))
+    keys.add(payload.get('subnet_id'))
+    keys.discard(None)
+    return keys
+
+
+class RouterContainer(object):
+
+    def __init__(self, deleted=None):
         self.state_machines = {}
-        self.deleted = collections.deque(maxlen=50)
+        if deleted is None:
+            deleted = DeletedRouters()
+        self.deleted = deleted
         self.lock = threading.Lock()
 
     def __delitem__(self, item):
         with self.lock:
             del self.state_machines[item]
-            self.deleted.append(item)
+        self.deleted.add(item)
 
     def items(self):
         with self.lock:
@@ -49,13 +240,16 @@ class RouterContainer(object):
             return list(self.state_machines.values())
 
     def has_been_deleted(self, router_id):
-        with self.lock:
-            return router_id in self.deleted
+        return router_id in self.deleted
 
     def __getitem__(self, item):
         with self.lock:
             return self.state_machines[item]
 
+    def get(self, item, default=None):
+        with self.lock:
+            return self.state_machines.get(item, default)
+
     def __setitem__(self, key, value):
         with self.lock:
             self.state_machines[key] = value
@@ -64,6 +258,10 @@ class RouterContainer(object):
         with self.lock:
             return item in self.state_machines
 
+    def __len__(self):
+        with self.lock:
+            return len(self.state_machines)
+
 
 class TenantRouterManager(object):
     """Keep track of the state machines for the routers for a given tenant.
@@ -71,12 +269,23 @@ class TenantRouterManager(object):
 
     def __init__(self, tenant_id, notify_callback,
                  queue_warning_threshold,
-                 reboot_error_threshold):
+                 reboot_error_threshold,
+                 deleted_routers=None,
+                 errored_routers=None,
+                 network_routers=None,
+                 bandwidth_callback=None):
         self.tenant_id = tenant_id
         self.notify = notify_callback
+        self._bandwidth_callback = bandwidth_callback
         self._queue_warning_threshold = queue_warning_threshold
         self._reboot_error_threshold = reboot_error_threshold
-        self.state_machines = RouterContainer()
+        self.state_machines = RouterContainer(deleted_routers)
+        if errored_routers is None:
+            errored_routers = ErroredRouters()
+        self.errored_routers = errored_routers
+        if network_routers is None:
+            network_routers = NetworkRouters()
+        self.network_routers = network_routers
         self._default_router_id = None
 
     def _delete_router(self, router_id):
@@ -84,9 +293,15 @@ class TenantRouterManager(object):
         if router_id in self.state_machines:
             LOG.debug('deleting state machine for %s', router_id)
             del self.state_machines[router_id]
+        self.errored_routers.discard(self.tenant_id, router_id)
+        self.network_routers.discard(router_id)
         if self._default_router_id == router_id:
             self._default_router_id = None
 
+    def _router_error(self, router_id, error):
+        "Called when a router goes into or out of the ERROR state"
+        self.errored_routers.set(self.tenant_id, router_id, error)
+
     def shutdown(self):
         LOG.info('shutting down')
         for rid, sm in self.state_machines.items():
@@ -94,19 +309,14 @@ class TenantRouterManager(object):
                 sm.service_shutdown()
             except Exception:
                 LOG.exception(
-                    'Failed to shutdown state machine for %s' % rid
+                    'Failed to shutdown state machine for %s', rid
                 )
 
-    def _report_bandwidth(self, router_id, bandwidth):
+    def _report_bandwidth(self, router_id):
+        "Called when the Automaton is asked for the traffic of the router"
         LOG.debug('reporting bandwidth for %s', router_id)
-        msg = {
-            'tenant_id': self.tenant_id,
-            'timestamp': timeutils.isotime(),
-            'event_type': 'akanda.bandwidth.used',
-            'payload': dict((b.pop('name'), b) for b in bandwidth),
-            'router_id': router_id,
-        }
-        self.notify(msg)
+        if self._bandwidth_callback is not None:
+            self._bandwidth_callback(router_id)
 
     def get_state_machines(self, message, worker_context):
         """Return the state machines and the queue for sending it messages for
@@ -114,6 +324,20 @@ class TenantRouterManager(object):
         """
         router_id = message.router_id
         if not router_id:
+            # Send events about networks, subnets and ports to the
+            # routers attached to them, if we know which those are.
+            router_ids = self.network_routers.routers(
+                _network_keys_for_message(message)
+            )
+            state_machines = [
+                sm for sm in (self.state_machines.get(rid)
+                              for rid in router_ids)
+                if sm is not None and not sm.deleted
+            ]
+            if state_machines:
+                LOG.debug('routing to %d attached state machines',
+                          len(state_machines))
+                return state_machines
             LOG.debug('looking for router for %s', message.tenant_id)
             if self._default_router_id is None:
                 # TODO(mark): handle muliple router lookup
@@ -145,8 +369,11 @@ class TenantRouterManager(object):
         # Send to routers that have an ERROR status
         elif router_id == 'error':
             state_machines = [
-                sm for sm in self.state_machines.values()
-                if sm.has_error()
+                sm for sm in (
+                    self.state_machines.get(rid)
+                    for rid in self.errored_routers.routers(self.tenant_id)
+                )
+                if sm is not None
             ]
             LOG.debug('routing to %d errored state machines',
                       len(state_machines))
@@ -166,6 +393,8 @@ class TenantRouterManager(object):
                 worker_context=worker_context,
                 queue_warning_threshold=self._queue_warning_threshold,
                 reboot_error_threshold=self._reboot_error_threshold,
+                error_callback=self._router_error,
+                router_callback=self.network_routers.update,
             )
             self.state_machines[router_id] = sm
             state_machines = [sm]
@@ -0,0 +1,182 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import os
+import shutil
+import tempfile
+
+import mock
+import unittest2 as unittest
+
+from akanda.rug.api import keystone
+from akanda.rug.openstack.common import timeutils
+
+
+class FakeConf:
+    admin_user = 'admin'
+    admin_password = 'password'
+    admin_tenant_name = 'admin'
+    auth_url = 'http://127.0.0.1:35357/v2.0/'
+    auth_strategy = 'keystone'
+    auth_region = 'RegionOne'
+    auth_token_cache_file = None
+
+
+def _access(token_id, expires_in=3600):
+    expires = timeutils.utcnow() + datetime.timedelta(seconds=expires_in)
+    return {
+        'token': {
+            'id': token_id,
+            'expires': timeutils.isotime(expires),
+        },
+        'serviceCatalog': [
+            {'type': 'network',
+             'endpoints': [
+                 {'region': 'OtherRegion',
+                  'publicURL': 'http://10.0.0.1:9696/'},
+                 {'region': 'RegionOne',
+                  'publicURL': 'http://127.0.0.1:9696/'},
+             ]},
+            {'type': 'compute',
+             'endpoints': [
+                 {'region': 'RegionOne',
+                  'publicURL': 'http://127.0.0.1:8774/v2/tenant'},
+             ]},
+        ],
+    }
+
+
+class TestTokenCache(unittest.TestCase):
+
+    def setUp(self):
+        super(TestTokenCache, self).setUp()
+        self.addCleanup(mock.patch.stopall)
+        self.post = mock.patch.object(keystone.requests, 'post').start()
+        self.tokens = iter(['token-%d' % i for i in range(10)])
+        self.post.side_effect = lambda *a, **k: mock.Mock(
+            **{'json.return_value': {'access': _access(next(self.tokens))}}
+        )
+        self.conf = FakeConf()
+
+    def test_authenticate_once(self):
+        cache = keystone.TokenCache(self.conf)
+        self.assertEqual(cache.get().id, 'token-0')
+        self.assertEqual(cache.get().id, 'token-0')
+        self.assertEqual(self.post.call_count, 1)
+        args, kwargs = self.post.call_args
+        self.assertEqual(args[0], 'http://127.0.0.1:35357/v2.0/tokens')
+
+    def test_endpoints_for_region(self):
+        token = keystone.TokenCache(self.conf).get()
+        self.assertEqual(token.endpoint_for('network'),
+                         'http://127.0.0.1:9696')
+        self.assertEqual(token.endpoint_for('compute'),
+                         'http://127.0.0.1:8774/v2/tenant')
+
+    def test_stale_token_refreshed(self):
+        cache = keystone.TokenCache(self.conf)
+        cache.get()
+        self.assertEqual(cache.get(stale_token_id='token-0').id, 'token-1')
+        # A caller that was also holding the old token gets the new one
+        # without another request to keystone.
+        self.assertEqual(cache.get(stale_token_id='token-0').id, 'token-1')
+        self.assertEqual(self.post.call_count, 2)
+
+    def test_expiring_token_refreshed(self):
+        token = keystone.Token.from_access(_access('old', expires_in=60),
+                                           'RegionOne')
+        cache = keystone.TokenCache(self.conf, token=token)
+        self.assertEqual(cache.get().id, 'token-0')
+
+    def test_shared_through_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.conf.auth_token_cache_file = os.path.join(tmpdir, 'token')
+        self.assertEqual(keystone.TokenCache(self.conf).get().id, 'token-0')
+        # A cache in another process finds the token in the file.
+        self.assertEqual(keystone.TokenCache(self.conf).get().id, 'token-0')
+        self.assertEqual(self.post.call_count, 1)
+        mode = os.stat(self.conf.auth_token_cache_file).st_mode
+        self.assertEqual(mode & 0o777, 0o600)
+
+    def test_unreadable_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.conf.auth_token_cache_file = os.path.join(tmpdir, 'token')
+        with open(self.conf.auth_token_cache_file, 'w') as f:
+            f.write('not json')
+        self.assertEqual(keystone.TokenCache(self.conf).get().id, 'token-0')
+
+
+class TestGetTokenCache(unittest.TestCase):
+
+    def setUp(self):
+        super(TestGetTokenCache, self).setUp()
+        self.addCleanup(mock.patch.stopall)
+        mock.patch.object(keystone, '_cache', None).start()
+
+    def test_same_process(self):
+        self.assertIs(keystone.get_token_cache(FakeConf),
+                      keystone.get_token_cache(FakeConf))
+
+    def test_new_process_keeps_token(self):
+        cache = keystone.get_token_cache(FakeConf)
+        cache._token = mock.sentinel.token
+        with mock.patch('os.getpid', return_value=cache._pid + 1):
+            child = keystone.get_token_cache(FakeConf)
+        self.assertIsNot(child, cache)
+        self.assertIs(child._token, mock.sentinel.token)
+
+
+class TestShareToken(unittest.TestCase):
+
+    def setUp(self):
+        super(TestShareToken, self).setUp()
+        self.addCleanup(mock.patch.stopall)
+        self.cache = mock.Mock()
+        self.cache.get.return_value = keystone.Token.from_access(
+            _access('shared'), 'RegionOne',
+        )
+        mock.patch.object(keystone, 'get_token_cache',
+                          return_value=self.cache).start()
+
+    def test_authenticate(self):
+        http_client = mock.Mock(auth_token=None, endpoint_url=None)
+        keystone.share_token(http_client, 'network', 'endpoint_url',
+                             FakeConf)
+        http_client.authenticate()
+        self.cache.get.assert_called_once_with(stale_token_id=None)
+        self.assertEqual(http_client.auth_token, 'shared')
+        self.assertEqual(http_client.endpoint_url, 'http://127.0.0.1:9696')
+
+    def test_reauthenticate_passes_stale_token(self):
+        http_client = mock.Mock(auth_token='expired', management_url='x')
+        keystone.share_token(http_client, 'compute', 'management_url',
+                             FakeConf)
+        http_client.unauthenticate()
+        http_client.authenticate()
+        self.cache.get.assert_called_once_with(stale_token_id='expired')
+        self.assertEqual(http_client.management_url,
+                         'http://127.0.0.1:8774/v2/tenant')
+
+    def test_not_keystone(self):
+        http_client = mock.Mock()
+        conf = FakeConf()
+        conf.auth_strategy = 'noauth'
+        keystone.share_token(http_client, 'network', 'endpoint_url', conf)
+        http_client.authenticate()
+        self.assertEqual(self.cache.get.call_count, 0)
@@ -117,6 +117,23 @@ class TestNovaWrapper(unittest.TestCase):
         self.client.assert_has_calls(expected)
         self.assertIsNone(result)
 
+    def test_own_instance(self):
+        class FakeServer(object):
+            def __init__(self, manager, info, loaded=False):
+                self.manager = manager
+                self._info = info
+                self.loaded = loaded
+
+        instance = FakeServer(mock.Mock(), {'id': 'instance-id'}, True)
+        result = nova._own_instance(self.nova, instance)
+        self.assertIsNot(result, instance)
+        self.assertIs(result.manager, self.client.servers)
+        self.assertEqual(result._info, {'id': 'instance-id'})
+        self.assertTrue(result.loaded)
+
+    def test_own_instance_not_found(self):
+        self.assertIsNone(nova._own_instance(self.nova, None))
+
     def test_get_router_instance_status(self):
         instance = mock.Mock()
         instance.status = 'ACTIVE'
@@ -452,3 +452,27 @@ class TestExternalPort(unittest.TestCase):
                 self.assertEqual(6, e.missing[1][0])
             else:
                 self.fail('Should have seen MissingIPAllocation')
+
+
+class TestWaitForDevice(unittest.TestCase):
+
+    def setUp(self):
+        super(TestWaitForDevice, self).setUp()
+        self.exists = mock.patch.object(quantum.ip_lib,
+                                        'device_exists').start()
+        self.sleep = mock.patch.object(quantum.time, 'sleep').start()
+        self.time = mock.patch.object(quantum.time, 'time').start()
+        self.time.return_value = 100.0
+        self.addCleanup(mock.patch.stopall)
+
+    def test_ready(self):
+        self.exists.side_effect = [False, False, True]
+        self.assertTrue(quantum._wait_for_device('tap0'))
+        self.assertEqual([mock.call(0.05), mock.call(0.1)],
+                         self.sleep.call_args_list)
+
+    def test_timeout(self):
+        self.exists.return_value = False
+        self.time.side_effect = [100.0, 101.0, 106.0]
+        self.assertFalse(quantum._wait_for_device('tap0', timeout=5))
+        self.assertEqual(1, self.sleep.call_count)
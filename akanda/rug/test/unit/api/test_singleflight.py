@@ -0,0 +1,170 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import threading
+
+import mock
+import unittest2 as unittest
+
+from akanda.rug.api import singleflight
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSingleFlight, self).setUp()
+        self.group = singleflight.SingleFlight('test')
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def _slow(self, value):
+        self.started.set()
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def _run_concurrently(self, key, value, num_threads=3):
+        results = []
+        errors = []
+
+        def call():
+            try:
+                results.append(self.group.do(key, self._slow, value))
+            except Exception as e:
+                errors.append(e)
+
+        first = threading.Thread(target=call)
+        first.start()
+        self.started.wait(5)
+        others = [threading.Thread(target=call)
+                  for i in range(num_threads - 1)]
+        for t in others:
+            t.start()
+        # Wait for the other threads to join the call in progress.
+        while self.group.merged < num_threads - 1:
+            threading.Event().wait(0.01)
+        self.release.set()
+        for t in [first] + others:
+            t.join(5)
+        return results, errors
+
+    def test_merges_concurrent_calls(self):
+        results, errors = self._run_concurrently('key', 'value')
+        self.assertEqual(errors, [])
+        # The thread that ran the call shares the result too.
+        self.assertEqual(results, [('value', True)] * 3)
+        self.assertEqual(self.group.requests, 3)
+        self.assertEqual(self.group.merged, 2)
+
+    def test_shares_exception(self):
+        err = RuntimeError('boom')
+        results, errors = self._run_concurrently('key', err)
+        self.assertEqual(results, [])
+        self.assertEqual(errors, [err, err, err])
+
+    def test_sequential_calls_not_merged(self):
+        func = mock.Mock(return_value='value')
+        self.assertEqual(('value', False), self.group.do('key', func))
+        self.assertEqual(('value', False), self.group.do('key', func))
+        self.assertEqual(func.call_count, 2)
+        self.assertEqual(self.group.merged, 0)
+
+    def test_different_keys_not_merged(self):
+        func = mock.Mock(return_value='value')
+        self.group.do('key1', func, 1)
+        self.group.do('key2', func, 2)
+        func.assert_has_calls([mock.call(1), mock.call(2)])
+
+
+class TestSharedRead(unittest.TestCase):
+
+    def test_key(self):
+        group = mock.Mock()
+        group.do.return_value = ('result', False)
+        adapt = mock.Mock()
+
+        class Client(object):
+            @singleflight.shared_read(group, adapt)
+            def read(self, thing_id):
+                return thing_id
+
+        client = Client()
+        self.assertEqual(client.read('abc'), 'result')
+        group.do.assert_called_once_with(('read', ('abc',), frozenset()),
+                                         mock.ANY, client, 'abc')
+        self.assertEqual(adapt.call_count, 0)
+
+    def test_keyword_arguments(self):
+        group = singleflight.SingleFlight('test')
+
+        class Client(object):
+            @singleflight.shared_read(group)
+            def read(self, thing_id, detail=False):
+                return thing_id, detail
+
+        client = Client()
+        self.assertEqual(client.read('abc', detail=True), ('abc', True))
+        with mock.patch.object(group, 'do') as do:
+            do.return_value = ('result', False)
+            client.read('abc', detail=True)
+        do.assert_called_once_with(
+            ('read', ('abc',), frozenset([('detail', True)])),
+            mock.ANY, client, 'abc', detail=True,
+        )
+
+    def test_every_caller_gets_a_copy(self):
+        group = singleflight.SingleFlight('test')
+        original = {'ports': []}
+        started = threading.Event()
+        release = threading.Event()
+
+        class Client(object):
+            @singleflight.shared_read(group, lambda c, r: dict(r))
+            def read(self, thing_id):
+                started.set()
+                release.wait(5)
+                return original
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            Client().read('abc'))) for i in range(3)]
+        threads[0].start()
+        started.wait(5)
+        for t in threads[1:]:
+            t.start()
+        while group.merged < 2:
+            threading.Event().wait(0.01)
+        release.set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual([original] * 3, results)
+        self.assertFalse(any(r is original for r in results))
+        self.assertEqual(3, len(set(id(r) for r in results)))
+
+    def test_adapt_shared_result(self):
+        group = mock.Mock()
+        group.do.return_value = ('result', True)
+        adapt = mock.Mock(return_value='copy')
+
+        class Client(object):
+            @singleflight.shared_read(group, adapt)
+            def read(self, thing_id):
+                return thing_id
+
+        client = Client()
+        self.assertEqual(client.read('abc'), 'copy')
+        adapt.assert_called_once_with(client, 'result')
@@ -0,0 +1,61 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import json
+from cStringIO import StringIO
+
+import mock
+import unittest2 as unittest
+
+from akanda.rug.cli import worker
+
+
+class TestWorkerStatus(unittest.TestCase):
+
+    def setUp(self):
+        super(TestWorkerStatus, self).setUp()
+        self.app = mock.Mock()
+        self.app.stdout = StringIO()
+        self.app.rug_ini.control_socket = '/var/run/rug.sock'
+        self.cmd = worker.WorkerStatus(self.app, None)
+        self.status = {
+            'workers': [{
+                'name': 'p00',
+                'routers': [{'router_id': 'r1'}, {'router_id': 'r2'}],
+            }],
+        }
+
+    def _run(self, *args):
+        parsed = self.cmd.get_parser('rug-ctl').parse_args(list(args))
+        with mock.patch('akanda.rug.control.query') as query:
+            query.return_value = self.status
+            self.cmd.take_action(parsed)
+        return query, json.loads(self.app.stdout.getvalue())
+
+    def test_default_socket(self):
+        query, output = self._run()
+        query.assert_called_once_with('/var/run/rug.sock')
+        self.assertEqual(self.status, output)
+
+    def test_socket_option(self):
+        query, output = self._run('--socket', '/tmp/other.sock')
+        query.assert_called_once_with('/tmp/other.sock')
+
+    def test_router_filter(self):
+        query, output = self._run('--router', 'r2')
+        self.assertEqual([{'router_id': 'r2'}],
+                         output['workers'][0]['routers'])
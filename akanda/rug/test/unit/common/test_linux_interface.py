@@ -114,7 +114,7 @@ class TestABCDriver(TestBase):
         ns = '12345678-1234-5678-90ab-ba0987654321'
         bc.init_l3('tap0', ['192.168.1.2/24'], namespace=ns)
         self.ip_dev.assert_has_calls(
-            [mock.call('tap0', 'sudo', namespace=ns),
+            [mock.call('tap0', 'sudo', namespace=ns, batch=mock.ANY),
              mock.call().addr.list(scope='global', filters=['permanent']),
              mock.call().addr.add(4, '192.168.1.2/24', '192.168.1.255'),
              mock.call().addr.delete(4, '172.16.77.240/24')])
@@ -137,11 +137,13 @@ class TestOVSInterfaceDriver(TestBase):
         if not bridge:
             bridge = 'br-int'
 
-        def device_exists(dev, root_helper=None, namespace=None):
+        def device_exists(dev, root_helper=None, namespace=None,
+                          batch=None):
             return dev == bridge
 
-        vsctl_cmd = ['ovs-vsctl', '--', '--may-exist', 'add-port',
-                     bridge, 'tap0', '--', 'set', 'Interface', 'tap0',
+        vsctl_cmd = ['ovs-vsctl', '--timeout=2', '--', '--may-exist',
+                     'add-port', bridge, 'tap0',
+                     '--', 'set', 'Interface', 'tap0',
                      'type=internal', '--', 'set', 'Interface', 'tap0',
                      'external-ids:iface-id=port-1234', '--', 'set',
                      'Interface', 'tap0',
@@ -158,9 +160,9 @@ class TestOVSInterfaceDriver(TestBase):
                      'aa:bb:cc:dd:ee:ff',
                      bridge=bridge,
                      namespace=namespace)
-            execute.assert_called_once_with(vsctl_cmd, 'sudo')
+            execute.assert_called_once_with(vsctl_cmd, root_helper='sudo')
 
-        expected = [mock.call('sudo'),
+        expected = [mock.call('sudo', batch=mock.ANY),
                     mock.call().device('tap0'),
                     mock.call().device().link.set_address('aa:bb:cc:dd:ee:ff')]
         expected.extend(additional_expectation)
@@ -200,7 +202,8 @@ class TestBridgeInterfaceDriver(TestBase):
         self._test_plug(namespace='01234567-1234-1234-99')
 
     def _test_plug(self, namespace=None):
-        def device_exists(device, root_helper=None, namespace=None):
+        def device_exists(device, root_helper=None, namespace=None,
+                          batch=None):
             return device.startswith('brq')
 
         root_veth = mock.Mock()
@@ -216,7 +219,8 @@ class TestBridgeInterfaceDriver(TestBase):
                 'aa:bb:cc:dd:ee:ff',
                 namespace=namespace)
 
-        ip_calls = [mock.call('sudo'), mock.call().add_veth('tap0', 'ns-0')]
+        ip_calls = [mock.call('sudo', batch=mock.ANY),
+                    mock.call().add_veth('tap0', 'ns-0')]
         if namespace:
             ip_calls.extend([
                 mock.call().ensure_namespace('01234567-1234-1234-99'),
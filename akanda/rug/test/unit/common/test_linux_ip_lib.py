@@ -49,12 +49,12 @@ LINK_SAMPLE = [
     '1: lo: <LOOPBACK,UP,LOWER_UP> mtu 16436 qdisc noqueue state UNKNOWN \\'
     'link/loopback 00:00:00:00:00:00 brd 00:00:00:00:00:00',
     '2: eth0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 qdisc mq state UP '
-    'qlen 1000\    link/ether cc:dd:ee:ff:ab:cd brd ff:ff:ff:ff:ff:ff'
-    '\    alias openvswitch',
+    'qlen 1000\\    link/ether cc:dd:ee:ff:ab:cd brd ff:ff:ff:ff:ff:ff'
+    '\\    alias openvswitch',
     '3: br-int: <BROADCAST,MULTICAST> mtu 1500 qdisc noop state DOWN '
-    '\    link/ether aa:bb:cc:dd:ee:ff brd ff:ff:ff:ff:ff:ff',
+    '\\    link/ether aa:bb:cc:dd:ee:ff brd ff:ff:ff:ff:ff:ff',
     '4: gw-ddc717df-49: <BROADCAST,MULTICAST> mtu 1500 qdisc noop '
-    'state DOWN \    link/ether fe:dc:ba:fe:dc:ba brd ff:ff:ff:ff:ff:ff']
+    'state DOWN \\    link/ether fe:dc:ba:fe:dc:ba brd ff:ff:ff:ff:ff:ff']
 
 ADDR_SAMPLE = ("""
 2: eth0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 qdisc mq state UP qlen 1000
@@ -239,7 +239,7 @@ class TestIpWrapper(unittest.TestCase):
                 ip.ensure_namespace('ns')
                 self.execute.assert_has_calls(
                     [mock.call([], 'netns', ('add', 'ns'), 'sudo', None)])
-                ip_dev.assert_has_calls([mock.call('lo', 'sudo', 'ns'),
+                ip_dev.assert_has_calls([mock.call('lo', 'sudo', 'ns', None),
                                          mock.call().link.set_up()])
 
     def test_ensure_namespace_existing(self):
@@ -326,6 +326,123 @@ class TestIpWrapper(unittest.TestCase):
         self.assertEqual(dev.mock_calls, [])
 
 
+ADDR_DUMP_SAMPLE = [
+    '1: lo    inet 127.0.0.1/8 scope host lo\\       valid_lft forever',
+    '2: eth0    inet 172.16.77.240/24 brd 172.16.77.255 scope global eth0'
+    '\\       valid_lft forever preferred_lft forever',
+    '2: eth0    inet6 2001:470:9:1224:dfcc:aaff:feb9:76ce/64 scope global '
+    'dynamic \\       valid_lft 14187sec preferred_lft 3387sec',
+    '2: eth0    inet6 fe80::dfcc:aaff:feb9:76ce/64 scope link '
+    '\\       valid_lft forever preferred_lft forever']
+
+
+class TestIPBatch(unittest.TestCase):
+    def setUp(self):
+        super(TestIPBatch, self).setUp()
+        self.execute_p = mock.patch('akanda.rug.common.linux.utils.execute')
+        self.execute = self.execute_p.start()
+        self.addCleanup(self.execute_p.stop)
+        self.batch = ip_lib.IPBatch('sudo')
+
+    def test_changes_batched(self):
+        device = self.batch.device('eth0')
+        device.link.set_up()
+        device.link.set_mtu(9000)
+        device.addr.add(4, '10.0.0.1/24', '10.0.0.255')
+        self.assertFalse(self.execute.called)
+        self.batch.run()
+        self.assertEqual(
+            [mock.call(['ip', '-batch', '-'], root_helper='sudo',
+                       process_input='link set eth0 up\n'
+                                     'link set eth0 mtu 9000\n'),
+             mock.call(['ip', '-4', '-batch', '-'], root_helper='sudo',
+                       process_input='addr add 10.0.0.1/24 brd 10.0.0.255 '
+                                     'scope global dev eth0\n')],
+            self.execute.call_args_list)
+        self.batch.run()
+        self.assertEqual(2, self.execute.call_count)
+
+    def test_namespace(self):
+        batch = ip_lib.IPBatch('sudo', 'ns')
+        batch.device('eth0').link.set_up()
+        batch.run()
+        self.execute.assert_called_once_with(
+            ['ip', 'netns', 'exec', 'ns', 'ip', '-batch', '-'],
+            root_helper='sudo', process_input='link set eth0 up\n')
+
+    def test_run_at_end(self):
+        with self.batch:
+            self.batch.device('eth0').link.set_up()
+        self.assertEqual(1, self.execute.call_count)
+
+    def test_dropped_on_error(self):
+        try:
+            with self.batch:
+                self.batch.device('eth0').link.set_up()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.batch.run()
+        self.assertFalse(self.execute.called)
+
+    def test_query_sees_changes(self):
+        device = self.batch.device('eth0')
+        device.link.set_up()
+        device.route.get_gateway()
+        self.assertEqual(
+            [['ip', '-batch', '-'], ['ip', 'route', 'list', 'dev', 'eth0']],
+            [c[0][0] for c in self.execute.call_args_list])
+
+    def test_not_batched(self):
+        device = self.batch.device('eth0')
+        device.link.set_up()
+        device.link.set_alias('my alias')
+        ip_lib.IPWrapper('sudo', batch=self.batch).netns.delete('ns')
+        self.assertEqual(
+            [['ip', '-batch', '-'],
+             ['ip', 'link', 'set', 'eth0', 'alias', 'my alias'],
+             ['ip', 'netns', 'delete', 'ns']],
+            [c[0][0] for c in self.execute.call_args_list])
+
+    def test_other_namespace_not_batched(self):
+        ip_lib.IPDevice('eth0', 'sudo', 'ns', self.batch).link.set_up()
+        self.execute.assert_called_once_with(
+            ['ip', 'netns', 'exec', 'ns', 'ip', 'link', 'set', 'eth0', 'up'],
+            root_helper='sudo')
+
+    def test_link_dump(self):
+        self.execute.return_value = '\n'.join(LINK_SAMPLE)
+        self.assertTrue(ip_lib.device_exists('eth0', batch=self.batch))
+        self.assertTrue(ip_lib.device_exists('br-int', batch=self.batch))
+        self.assertFalse(ip_lib.device_exists('tap0', batch=self.batch))
+        self.assertEqual(1500, self.batch.device('eth0').link.mtu)
+        self.execute.assert_called_once_with(['ip', '-o', 'link', 'show'],
+                                             root_helper=None)
+
+    def test_dump_after_change(self):
+        self.execute.return_value = '\n'.join(LINK_SAMPLE)
+        device = self.batch.device('eth0')
+        device.link.address
+        device.link.set_up()
+        device.link.address
+        self.assertEqual(
+            [['ip', '-o', 'link', 'show'],
+             ['ip', '-batch', '-'],
+             ['ip', '-o', 'link', 'show']],
+            [c[0][0] for c in self.execute.call_args_list])
+
+    def test_addr_dump(self):
+        self.execute.return_value = '\n'.join(ADDR_DUMP_SAMPLE)
+        addr = self.batch.device('eth0').addr
+        self.assertEqual(
+            [dict(cidr='172.16.77.240/24', broadcast='172.16.77.255',
+                  scope='global', ip_version=4, dynamic=False)],
+            addr.list(scope='global', filters=['permanent']))
+        self.assertEqual(3, len(addr.list()))
+        self.execute.assert_called_once_with(['ip', '-o', 'addr', 'show'],
+                                             root_helper=None)
+
+
 class TestIPDevice(unittest.TestCase):
     def test_eq_same_name(self):
         dev1 = ip_lib.IPDevice('tap0')
@@ -403,6 +520,7 @@ class TestIPCmdBase(unittest.TestCase):
         self.parent = mock.Mock()
         self.parent.name = 'eth0'
         self.parent.root_helper = 'sudo'
+        self.parent.batch = None
 
     def _assert_call(self, options, args):
         self.parent.assert_has_calls([
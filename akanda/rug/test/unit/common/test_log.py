@@ -0,0 +1,224 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import logging
+import os
+import threading
+import time
+
+import mock
+import unittest2 as unittest
+
+from akanda.rug import state
+from akanda.rug.openstack.common import log
+
+
+def _record(msg, args=None, level=logging.DEBUG, created=0,
+            router_id=None):
+    record = logging.LogRecord('test', level, __file__, 1, msg, args, None)
+    record.created = created
+    if router_id is not None:
+        record.router_id = router_id
+    return record
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.blocked = threading.Event()
+        self.blocked.set()
+
+    def emit(self, record):
+        self.blocked.wait()
+        self.records.append(record)
+
+
+class TestRateLimitFilter(unittest.TestCase):
+
+    def setUp(self):
+        super(TestRateLimitFilter, self).setUp()
+        self.f = log.RateLimitFilter(burst=2, interval=10)
+
+    def _router_record(self, router_id='r1', **kwargs):
+        return _record('%s: hello %%s' % router_id, ('x',),
+                       router_id=router_id, **kwargs)
+
+    def test_burst(self):
+        results = [self.f.filter(self._router_record()) for i in range(4)]
+        self.assertEqual([True, True, False, False], results)
+
+    def test_routers_counted_apart(self):
+        for i in range(2):
+            self.f.filter(self._router_record())
+        self.assertFalse(self.f.filter(self._router_record()))
+        self.assertTrue(self.f.filter(self._router_record('r2')))
+        self.assertTrue(self.f.filter(
+            self._router_record(level=logging.INFO)))
+
+    def test_warnings_not_dropped(self):
+        for i in range(5):
+            self.assertTrue(self.f.filter(
+                self._router_record(level=logging.WARNING)))
+
+    def test_not_about_a_router(self):
+        # Status reports and the like log the same format string for
+        # every router, and all of them are wanted.
+        for i in range(5):
+            self.assertTrue(self.f.filter(
+                _record('Ignoring router: %s', (i,), level=logging.INFO)))
+
+    def test_next_window_reports_suppressed(self):
+        for i in range(5):
+            self.f.filter(self._router_record())
+        record = self._router_record(created=10)
+        self.assertTrue(self.f.filter(record))
+        self.assertEqual('r1: hello x (3 similar messages suppressed)',
+                         record.getMessage())
+
+    def test_forgets_quiet_sources(self):
+        self.f.MAX_SOURCES = 2
+        self.f.filter(self._router_record('a'))
+        self.f.filter(self._router_record('b', created=5))
+        self.f.filter(self._router_record('c', created=12))
+        self.assertEqual(set(['b', 'c']),
+                         set(key[0] for key in self.f._windows))
+
+    def test_router_log(self):
+        logger = logging.getLogger('test_router_log')
+        logger.propagate = False
+        self.addCleanup(setattr, logger, 'propagate', True)
+        logger.setLevel(logging.DEBUG)
+        target = ListHandler()
+        target.addFilter(self.f)
+        logger.addHandler(target)
+        self.addCleanup(logger.removeHandler, target)
+        router_log = state.RouterLog(logger, 'r1')
+        for i in range(4):
+            router_log.debug('hello %s', i)
+        self.assertEqual(['r1: hello 0', 'r1: hello 1'],
+                         [r.getMessage() for r in target.records])
+
+
+class TestAsyncHandler(unittest.TestCase):
+
+    def setUp(self):
+        super(TestAsyncHandler, self).setUp()
+        self.target = ListHandler()
+        self.h = log.AsyncHandler([self.target], max_size=3)
+        self.addCleanup(self.h.close)
+
+    def test_written(self):
+        self.h.handle(_record('hello %s', ('world',)))
+        self.h.flush()
+        self.assertEqual(['hello world'],
+                         [r.getMessage() for r in self.target.records])
+
+    def test_message_built_when_logged(self):
+        args = ['before']
+        self.target.blocked.clear()
+        self.h.handle(_record('%s', (args,)))
+        args[0] = 'after'
+        self.target.blocked.set()
+        self.h.flush()
+        self.assertEqual("['before']", self.target.records[0].getMessage())
+
+    def test_target_level(self):
+        self.target.setLevel(logging.INFO)
+        self.h.handle(_record('debug'))
+        self.h.handle(_record('info', level=logging.INFO))
+        self.h.flush()
+        self.assertEqual(['info'],
+                         [r.getMessage() for r in self.target.records])
+
+    def test_drop_when_full(self):
+        self.target.blocked.clear()
+        # The writer takes the first record and waits, the next three
+        # fill the buffer and the rest are dropped.
+        self.h.handle(_record('first'))
+        for i in range(10):
+            self.h.flush(timeout=0.01)
+            if not self.h._records:
+                break
+        for i in range(5):
+            self.h.handle(_record('msg %d', (i,)))
+        self.target.blocked.set()
+        self.h.flush()
+        messages = [r.getMessage() for r in self.target.records]
+        self.assertEqual(['first', 'msg 0', 'msg 1', 'msg 2'], messages[:4])
+        self.assertEqual(
+            'dropped 2 log messages (2 DEBUG) because the log output '
+            'could not keep up',
+            messages[4],
+        )
+        self.assertEqual(logging.WARNING, self.target.records[4].levelno)
+
+    def test_warnings_wait_when_full(self):
+        self.target.blocked.clear()
+        self.h.handle(_record('first'))
+        for i in range(10):
+            self.h.flush(timeout=0.01)
+            if not self.h._records:
+                break
+        for i in range(3):
+            self.h.handle(_record('msg %d', (i,)))
+        t = threading.Thread(
+            target=self.h.handle,
+            args=(_record('error', level=logging.ERROR),),
+        )
+        t.start()
+        t.join(0.1)
+        self.assertTrue(t.is_alive())
+        self.target.blocked.set()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.h.flush()
+        self.assertEqual(['first', 'msg 0', 'msg 1', 'msg 2', 'error'],
+                         [r.getMessage() for r in self.target.records])
+        self.assertEqual(0, self.h.dropped)
+
+    def test_no_handler_lock(self):
+        self.assertIsNone(self.h.lock)
+
+    def test_forked_once(self):
+        # Pretend to be in a forked process, where the handlers are
+        # slow to reset, and log from several threads at once.
+        self.h._pid -= 1
+        with mock.patch.object(self.h, '_start') as start:
+            start.side_effect = lambda: setattr(self.h, '_pid', os.getpid())
+            with mock.patch.object(self.target, 'createLock') as create:
+                create.side_effect = lambda: time.sleep(0.01)
+                threads = [threading.Thread(target=self.h._restart)
+                           for i in range(4)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+        start.assert_called_once_with()
+
+    def test_forked(self):
+        old_thread = self.h._thread
+        with mock.patch('os.getpid') as getpid:
+            getpid.return_value = self.h._pid + 1
+            with mock.patch.object(self.target, 'createLock') as create:
+                self.h.handle(_record('in the child'))
+                create.assert_called_once_with()
+            self.assertIsNot(old_thread, self.h._thread)
+            self.h.flush()
+            self.h.close()
+        self.assertEqual(['in the child'],
+                         [r.getMessage() for r in self.target.records])
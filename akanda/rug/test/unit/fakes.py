@@ -0,0 +1,40 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Fake objects shared by the unit tests.
+"""
+
+import mock
+
+
+def fake_scheduler(answers):
+    """Return a scheduler with one worker for each answer to its queries.
+
+    The workers are named p00, p01, ... and have 2 messages waiting in
+    their inbox.
+    """
+    sched = mock.Mock()
+    sched.workers = []
+    for i, answer in enumerate(answers):
+        w = {'worker': mock.Mock(), 'queue': mock.Mock()}
+        w['worker'].name = 'p%02d' % i
+        w['worker'].pid = 100 + i
+        w['worker'].is_alive.return_value = True
+        w['queue'].qsize.return_value = 2
+        sched.workers.append(w)
+    sched.query.return_value = answers
+    return sched
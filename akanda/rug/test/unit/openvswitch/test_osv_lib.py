@@ -32,6 +32,7 @@
 #    under the License.
 # @author: Dan Wendlandt, Nicira, Inc.
 
+import json
 import unittest
 import uuid
 import mox
@@ -206,18 +207,14 @@ class OVS_Lib_Test(unittest.TestCase):
         ip = "9.9.9.9"
         ofport = "6"
 
-        utils.execute(["ovs-vsctl", self.TO, "add-port",
-                       self.BR_NAME, pname], root_helper=self.root_helper)
-        utils.execute(["ovs-vsctl", self.TO, "set", "Interface",
-                       pname, "type=gre"], root_helper=self.root_helper)
-        utils.execute(["ovs-vsctl", self.TO, "set", "Interface",
-                       pname, "options:remote_ip=" + ip],
-                      root_helper=self.root_helper)
-        utils.execute(["ovs-vsctl", self.TO, "set", "Interface",
-                       pname, "options:in_key=flow"],
-                      root_helper=self.root_helper)
-        utils.execute(["ovs-vsctl", self.TO, "set", "Interface",
-                       pname, "options:out_key=flow"],
+        utils.execute(["ovs-vsctl", self.TO,
+                       "--", "add-port", self.BR_NAME, pname,
+                       "--", "set", "Interface", pname, "type=gre",
+                       "--", "set", "Interface", pname,
+                       "options:remote_ip=" + ip,
+                       "--", "set", "Interface", pname, "options:in_key=flow",
+                       "--", "set", "Interface", pname,
+                       "options:out_key=flow"],
                       root_helper=self.root_helper)
         utils.execute(["ovs-vsctl", self.TO, "get",
                        "Interface", pname, "ofport"],
@@ -232,12 +229,11 @@ class OVS_Lib_Test(unittest.TestCase):
         peer = "bar10"
         ofport = "6"
 
-        utils.execute(["ovs-vsctl", self.TO, "add-port",
-                       self.BR_NAME, pname], root_helper=self.root_helper)
-        utils.execute(["ovs-vsctl", self.TO, "set", "Interface",
-                       pname, "type=patch"], root_helper=self.root_helper)
-        utils.execute(["ovs-vsctl", self.TO, "set",
-                       "Interface", pname, "options:peer=" + peer],
+        utils.execute(["ovs-vsctl", self.TO,
+                       "--", "add-port", self.BR_NAME, pname,
+                       "--", "set", "Interface", pname, "type=patch",
+                       "--", "set", "Interface", pname,
+                       "options:peer=" + peer],
                       root_helper=self.root_helper)
         utils.execute(["ovs-vsctl", self.TO, "get",
                        "Interface", pname, "ofport"],
@@ -247,28 +243,38 @@ class OVS_Lib_Test(unittest.TestCase):
         self.assertEqual(self.br.add_patch_port(pname, peer), ofport)
         self.mox.VerifyAll()
 
+    def _expect_interfaces(self, output):
+        utils.execute(["ovs-vsctl", self.TO, "--format=json",
+                       "--", "list-ports", self.BR_NAME,
+                       "--", "--columns=name,external_ids,ofport",
+                       "list", "Interface"],
+                      root_helper=self.root_helper).AndReturn(output)
+
+    def _interfaces(self, port_names, rows):
+        table = {
+            'headings': ['name', 'external_ids', 'ofport'],
+            'data': [[name, ['map', sorted(external_ids.items())], ofport]
+                     for name, external_ids, ofport in rows],
+        }
+        return ''.join('%s\n' % n for n in port_names + [json.dumps(table)])
+
     def _test_get_vif_ports(self, is_xen=False):
         pname = "tap99"
-        ofport = "6"
+        ofport = 6
         vif_id = generate_uuid()
         mac = "ca:fe:de:ad:be:ef"
 
-        utils.execute(["ovs-vsctl", self.TO, "list-ports", self.BR_NAME],
-                      root_helper=self.root_helper).AndReturn("%s\n" % pname)
-
         if is_xen:
-            external_ids = ('{xs-vif-uuid="%s", attached-mac="%s"}'
-                            % (vif_id, mac))
+            external_ids = {'xs-vif-uuid': vif_id, 'attached-mac': mac}
         else:
-            external_ids = ('{iface-id="%s", attached-mac="%s"}'
-                            % (vif_id, mac))
-
-        utils.execute(["ovs-vsctl", self.TO, "get",
-                       "Interface", pname, "external_ids"],
-                      root_helper=self.root_helper).AndReturn(external_ids)
-        utils.execute(["ovs-vsctl", self.TO, "get",
-                       "Interface", pname, "ofport"],
-                      root_helper=self.root_helper).AndReturn(ofport)
+            external_ids = {'iface-id': vif_id, 'attached-mac': mac}
+
+        # Only the ports of the bridge with an attached mac are VIFs.
+        self._expect_interfaces(self._interfaces(
+            [pname, 'patch-tun'],
+            [(pname, external_ids, ofport),
+             ('patch-tun', {}, 1),
+             ('other', {'iface-id': 'x', 'attached-mac': mac}, 2)]))
         if is_xen:
             utils.execute(["xe", "vif-param-get", "param-name=other-config",
                            "param-key=nicira-iface-id", "uuid=" + vif_id],
@@ -290,6 +296,71 @@ class OVS_Lib_Test(unittest.TestCase):
     def test_get_vif_ports_xen(self):
         self._test_get_vif_ports(True)
 
+    def test_get_vif_port_set(self):
+        mac = "ca:fe:de:ad:be:ef"
+        self._expect_interfaces(self._interfaces(
+            ['tap1', 'tap2'],
+            [('tap1', {'iface-id': 'a', 'attached-mac': mac}, 1),
+             ('tap2', {'iface-id': 'b', 'attached-mac': mac}, ['set', []])]))
+        self.mox.ReplayAll()
+        self.assertEqual(set(['a', 'b']), self.br.get_vif_port_set())
+        self.mox.VerifyAll()
+
+    def test_get_vif_port_by_id(self):
+        vif_id = "5c1321a7-c73f-4a77-95e6-9f86402e5c8f"
+        self._expect_interfaces(self._interfaces(
+            [],
+            [('tap1', {'iface-id': 'a', 'attached-mac': 'x'}, 1),
+             ('dhc5c1321a7-c7', {'iface-id': vif_id,
+                                 'attached-mac': 'fa:16:3e:23:5b:f2',
+                                 'iface-status': 'active'}, 2)]))
+        self.mox.ReplayAll()
+        port = self.br.get_vif_port_by_id(vif_id)
+        self.assertEqual('fa:16:3e:23:5b:f2', port.vif_mac)
+        self.assertEqual(vif_id, port.vif_id)
+        self.assertEqual('dhc5c1321a7-c7', port.port_name)
+        self.assertEqual(2, port.ofport)
+        self.mox.VerifyAll()
+
+    def test_get_vif_port_by_id_missing(self):
+        self._expect_interfaces(None)
+        self.mox.ReplayAll()
+        self.assertIsNone(self.br.get_vif_port_by_id('nope'))
+        self.mox.VerifyAll()
+
+    def test_transaction(self):
+        utils.execute(["ovs-vsctl", self.TO,
+                       "--", "--may-exist", "add-port", self.BR_NAME, "tap1",
+                       "--", "set", "Interface", "tap1",
+                       "external-ids:iface-id=a",
+                       "--", "--if-exists", "del-port", self.BR_NAME, "tap2"],
+                      root_helper=self.root_helper)
+        self.mox.ReplayAll()
+        with self.br.transaction() as txn:
+            txn.add_port("tap1")
+            txn.set_db_attribute("Interface", "tap1",
+                                 "external-ids:iface-id", "a")
+            txn.delete_port("tap2")
+        self.mox.VerifyAll()
+
+    def test_transaction_not_run_on_error(self):
+        self.mox.ReplayAll()
+        with self.assertRaises(ValueError):
+            with self.br.transaction() as txn:
+                txn.add_port("tap1")
+                raise ValueError()
+        self.mox.VerifyAll()
+
+    def test_transaction_check_error(self):
+        utils.execute(["ovs-vsctl", self.TO, "--", "--may-exist",
+                       "add-port", self.BR_NAME, "tap1"],
+                      root_helper=self.root_helper).AndRaise(RuntimeError)
+        self.mox.ReplayAll()
+        txn = self.br.transaction(check_error=True)
+        txn.add_port("tap1")
+        self.assertRaises(RuntimeError, txn.commit)
+        self.mox.VerifyAll()
+
     def test_clear_db_attribute(self):
         pname = "tap77"
         utils.execute(["ovs-vsctl", self.TO, "clear", "Port",
@@ -298,21 +369,6 @@ class OVS_Lib_Test(unittest.TestCase):
         self.br.clear_db_attribute("Port", pname, "tag")
         self.mox.VerifyAll()
 
-    def test_port_id_regex(self):
-        result = ('external_ids        : {attached-mac="fa:16:3e:23:5b:f2",'
-                  ' iface-id="5c1321a7-c73f-4a77-95e6-9f86402e5c8f",'
-                  ' iface-status=active}\nname                :'
-                  ' "dhc5c1321a7-c7"\nofport              : 2\n')
-        match = self.br.re_id.search(result)
-        vif_mac = match.group('vif_mac')
-        vif_id = match.group('vif_id')
-        port_name = match.group('port_name')
-        ofport = int(match.group('ofport'))
-        self.assertEqual(vif_mac, 'fa:16:3e:23:5b:f2')
-        self.assertEqual(vif_id, '5c1321a7-c73f-4a77-95e6-9f86402e5c8f')
-        self.assertEqual(port_name, 'dhc5c1321a7-c7')
-        self.assertEqual(ofport, 2)
-
     def test_iface_to_br(self):
         iface = 'tap0'
         br = 'br-int'
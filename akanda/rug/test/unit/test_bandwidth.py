@@ -0,0 +1,103 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import threading
+
+import mock
+import unittest2 as unittest
+
+from akanda.rug import bandwidth
+
+
+def _labels(**counters):
+    return [{'name': name, 'bytes': value}
+            for name, value in sorted(counters.items())]
+
+
+class TestBandwidthCollector(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBandwidthCollector, self).setUp()
+        self.routers = []
+        self.notify = mock.Mock()
+        self.collector = bandwidth.BandwidthCollector(
+            lambda: list(self.routers), self.notify, interval=0,
+            concurrency=2,
+        )
+        self.addCleanup(self.collector.stop)
+
+    def _router(self, tenant_id, router_id, *readings):
+        vm = mock.Mock()
+        vm.read_stats.side_effect = list(readings)
+        self.routers.append((tenant_id, router_id, vm))
+        return vm
+
+    def _messages(self):
+        return [c[0][0] for c in self.notify.call_args_list]
+
+    def test_reported_by_tenant(self):
+        self._router('t2', 'r1', _labels(a=3))
+        self._router('t1', 'r2', _labels(a=1))
+        self._router('t2', 'r3', _labels(a=0))
+        self.collector.collect()
+        messages = self._messages()
+        self.assertEqual(['t1', 't2'], [m['tenant_id'] for m in messages])
+        self.assertEqual({'r1': {'a': {'bytes': 3}},
+                          'r3': {'a': {'bytes': 0}}},
+                         messages[1]['payload'])
+        self.assertEqual('akanda.tenant.bandwidth.used',
+                         messages[1]['event_type'])
+        self.assertEqual(messages[0]['timestamp'], messages[1]['timestamp'])
+
+    def test_each_reading_reported(self):
+        # The appliance resets its counters when they are read.
+        self._router('t1', 'r1', _labels(a=7), _labels(a=2))
+        self.collector.collect()
+        self.assertEqual({'r1': {'a': {'bytes': 7}}},
+                         self.notify.call_args[0][0]['payload'])
+        self.collector.collect()
+        self.assertEqual({'r1': {'a': {'bytes': 2}}},
+                         self.notify.call_args[0][0]['payload'])
+
+    def test_not_configured(self):
+        self._router('t1', 'r1', None, None)
+        self.collector.collect()
+        self.collector.collect()
+        self.assertFalse(self.notify.called)
+
+    def test_read_fails(self):
+        self._router('t1', 'r1', IOError('timed out'))
+        self._router('t1', 'r2', _labels(a=5))
+        self.collector.collect()
+        msg = self.notify.call_args[0][0]
+        self.assertEqual({'r2': {'a': {'bytes': 5}}}, msg['payload'])
+
+    def test_collect_some(self):
+        self._router('t1', 'r1', _labels(a=1))
+        other = self._router('t1', 'r2')
+        self.collector.collect(set(['r1']))
+        self.assertFalse(other.read_stats.called)
+
+    def test_request(self):
+        done = threading.Event()
+        self._router('t1', 'r1', _labels(a=3))
+        self.notify.side_effect = lambda msg: done.set()
+        self.collector.start()
+        self.collector.request('r1')
+        self.assertTrue(done.wait(5))
+        self.assertEqual({'r1': {'a': {'bytes': 3}}},
+                         self.notify.call_args[0][0]['payload'])
@@ -0,0 +1,88 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import shutil
+import stat
+import tempfile
+
+import mock
+import unittest2 as unittest
+
+from akanda.rug import control
+from akanda.rug.test.unit import fakes
+
+
+class TestSnapshot(unittest.TestCase):
+
+    @mock.patch('akanda.rug.populate.status')
+    def test_snapshot(self, populate_status):
+        populate_status.return_value = {'total': 5, 'seeded': 2}
+        sched = fakes.fake_scheduler([{'queue_depth': 1, 'routers': []}, None])
+        snap = control.snapshot(sched)
+        self.assertEqual({'total': 5, 'seeded': 2}, snap['pre_populate'])
+        sched.query.assert_called_once_with('status', control.QUERY_TIMEOUT)
+        self.assertIn('taken_at', snap)
+        self.assertEqual([
+            {'name': 'p00', 'pid': 100, 'alive': True, 'answered': True,
+             'inbox_depth': 2, 'queue_depth': 1, 'routers': []},
+            {'name': 'p01', 'pid': 101, 'alive': True, 'answered': False,
+             'inbox_depth': 2},
+        ], snap['workers'])
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        super(TestServer, self).setUp()
+        self.dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dirname)
+        self.path = os.path.join(self.dirname, 'run', 'control.sock')
+        self.sched = fakes.fake_scheduler([{'queue_depth': 3}])
+        self.server = control.start_server(self.path, self.sched)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_status(self):
+        snap = control.query(self.path)
+        self.assertEqual(3, snap['workers'][0]['queue_depth'])
+
+    def test_only_owner_can_connect(self):
+        mode = stat.S_IMODE(os.stat(self.path).st_mode)
+        self.assertEqual(0o600, mode)
+
+    def test_unknown_request(self):
+        self.assertIn('error', control.query(self.path, 'nonsense'))
+        self.assertFalse(self.sched.query.called)
+
+    def test_snapshot_fails(self):
+        self.sched.query.side_effect = RuntimeError('boom')
+        self.assertEqual({'error': 'boom'}, control.query(self.path))
+
+    def test_stale_socket_replaced(self):
+        self.server.shutdown()
+        self.server.server_close()
+        server = control.start_server(self.path, self.sched)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.assertEqual(3, control.query(self.path)['workers'][0][
+            'queue_depth'])
+
+    def test_cannot_bind(self):
+        path = os.path.join(self.dirname, 'file', 'control.sock')
+        open(os.path.join(self.dirname, 'file'), 'w').close()
+        self.assertIsNone(control.start_server(path, self.sched))
@@ -0,0 +1,133 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+import unittest2 as unittest
+
+from akanda.rug import dirwatch
+
+
+def _touch(*parts):
+    open(os.path.join(*parts), 'a').close()
+
+
+def _wait_for(check, timeout=5):
+    deadline = time.time() + timeout
+    while not check() and time.time() < deadline:
+        time.sleep(0.01)
+    return check()
+
+
+class TestDirectoryWatcher(unittest.TestCase):
+
+    def setUp(self):
+        super(TestDirectoryWatcher, self).setUp()
+        self.dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dirname, True)
+
+    def _watcher(self, **kwargs):
+        w = dirwatch.DirectoryWatcher(self.dirname, **kwargs)
+        self.addCleanup(w.close)
+        return w
+
+    def test_no_path(self):
+        w = dirwatch.DirectoryWatcher(None)
+        self.assertEqual(frozenset(), w.names())
+        self.assertNotIn('a', w)
+
+    def test_missing_directory(self):
+        w = dirwatch.DirectoryWatcher(os.path.join(self.dirname, 'nope'))
+        self.assertEqual(frozenset(), w.names())
+
+    def test_initial_names(self):
+        _touch(self.dirname, 'a')
+        w = self._watcher()
+        self.assertEqual(frozenset(['a']), w.names())
+        self.assertIn('a', w)
+
+    @unittest.skipIf(dirwatch._inotify() is None, 'inotify not available')
+    def test_notified(self):
+        w = self._watcher()
+        self.assertIsNotNone(w._fd)
+        with mock.patch('os.listdir') as listdir:
+            for i in range(3):
+                self.assertNotIn('a', w)
+            self.assertFalse(listdir.called)
+        _touch(self.dirname, 'a')
+        self.assertTrue(_wait_for(lambda: 'a' in w))
+        os.unlink(os.path.join(self.dirname, 'a'))
+        self.assertTrue(_wait_for(lambda: 'a' not in w))
+
+    @unittest.skipIf(dirwatch._inotify() is None, 'inotify not available')
+    def test_directory_removed(self):
+        w = self._watcher(poll_interval=0)
+        shutil.rmtree(self.dirname)
+        self.assertTrue(_wait_for(lambda: w._fd is None))
+        os.mkdir(self.dirname)
+        _touch(self.dirname, 'a')
+        self.assertIn('a', w)
+
+    @unittest.skipIf(dirwatch._inotify() is None, 'inotify not available')
+    def test_close(self):
+        w = self._watcher()
+        w.close()
+        self.assertTrue(_wait_for(lambda: w._fd is None))
+
+
+class TestPolling(unittest.TestCase):
+
+    def setUp(self):
+        super(TestPolling, self).setUp()
+        self.dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dirname)
+        mock.patch.object(dirwatch, '_inotify', return_value=None).start()
+        self.time = mock.patch.object(dirwatch.time, 'time').start()
+        self.time.return_value = 1000.0
+        self.addCleanup(mock.patch.stopall)
+        _touch(self.dirname, 'a')
+        os.utime(self.dirname, (900, 900))
+        self.w = dirwatch.DirectoryWatcher(self.dirname, poll_interval=2)
+
+    def test_listed_once_per_change(self):
+        self.assertIsNone(self.w._fd)
+        with mock.patch('os.listdir') as listdir:
+            self.time.return_value = 1003.0
+            self.assertIn('a', self.w)
+            self.assertFalse(listdir.called)
+
+    def test_checked_after_interval(self):
+        _touch(self.dirname, 'b')
+        os.utime(self.dirname, (950, 950))
+        self.time.return_value = 1001.0
+        self.assertNotIn('b', self.w)
+        self.time.return_value = 1002.0
+        self.assertIn('b', self.w)
+
+    def test_recent_change_listed_again(self):
+        os.utime(self.dirname, (1000, 1000))
+        self.w._list()
+        # Changed within the same second as the last listing, without
+        # moving the timestamp.
+        _touch(self.dirname, 'b')
+        os.utime(self.dirname, (1000, 1000))
+        self.time.return_value = 1002.0
+        self.assertIn('b', self.w)
@@ -0,0 +1,63 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import pickle
+
+import mock
+import unittest2 as unittest
+
+from akanda.rug import event
+
+
+class TestTrace(unittest.TestCase):
+
+    @mock.patch.object(event.time, 'time')
+    def test_intervals(self, now):
+        now.return_value = 10.0
+        trace = event.Trace()
+        now.return_value = 10.5
+        trace.stamp('queued')
+        now.return_value = 12.0
+        trace.stamp('done')
+        self.assertEqual([('queued', 0.5), ('done', 1.5)], trace.intervals())
+        self.assertEqual(2.0, trace.total)
+
+    def test_max_hops(self):
+        trace = event.Trace()
+        for i in range(event.Trace.MAX_HOPS * 2):
+            trace.stamp('hop')
+        self.assertEqual(event.Trace.MAX_HOPS, len(trace.hops))
+
+
+class TestEvent(unittest.TestCase):
+
+    def test_trace_created(self):
+        e = event.Event('tenant', 'router', event.UPDATE, {})
+        self.assertEqual('received', e.trace.hops[0][0])
+
+    def test_equal_ignores_trace(self):
+        self.assertEqual(
+            event.Event('tenant', 'router', event.UPDATE, {}),
+            event.Event('tenant', 'router', event.UPDATE, {}),
+        )
+
+    def test_pickle_keeps_trace(self):
+        e = event.Event('tenant', 'router', event.UPDATE, {})
+        e.trace.stamp('shuffled')
+        copy = pickle.loads(pickle.dumps(e, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(e, copy)
+        self.assertEqual(e.trace.hops, copy.trace.hops)
@@ -16,6 +16,7 @@
 
 import sys
 import socket
+import threading
 
 import mock
 import unittest2 as unittest
@@ -33,6 +34,12 @@ from akanda.rug import notifications as ak_notifications
 @mock.patch('akanda.rug.main.health')
 class TestMainPippo(unittest.TestCase):
 
+    def setUp(self):
+        super(TestMainPippo, self).setUp()
+        self.proxy = mock.patch(
+            'akanda.rug.main.metadata.ProxyProcesses').start()
+        self.addCleanup(mock.patch.stopall)
+
     def test_shuffle_notifications(self, health, populate, scheduler,
                                    notifications, multiprocessing, quantum_api,
                                    cfg):
@@ -48,6 +55,37 @@ class TestMainPippo(unittest.TestCase):
             'message'
         )
 
+    def test_shuffle_notifications_trace(
+            self, health, populate, scheduler, notifications,
+            multiprocessing, quantum_api, cfg):
+        message = mock.Mock()
+        queue = mock.Mock()
+        queue.get.side_effect = [
+            ('9306bbd8-f3cc-11e2-bd68-080027e60b25', message),
+            KeyboardInterrupt,
+        ]
+        sched = scheduler.Scheduler.return_value
+        main.shuffle_notifications(queue, sched)
+        message.trace.stamp.assert_called_once_with('shuffled')
+
+    @mock.patch.dict('akanda.rug.metrics.NOTIFICATIONS', clear=True)
+    def test_shuffle_notifications_counted(
+            self, health, populate, scheduler, notifications,
+            multiprocessing, quantum_api, cfg):
+        queue = mock.Mock()
+        queue.get.side_effect = [
+            ('t1', mock.Mock(crud='update')),
+            ('t2', mock.Mock(crud='update')),
+            ('t3', mock.Mock(crud='delete')),
+            KeyboardInterrupt,
+        ]
+        sched = scheduler.Scheduler.return_value
+        main.shuffle_notifications(queue, sched)
+        self.assertEqual(
+            {'update': 2, 'delete': 1},
+            dict(main.metrics.NOTIFICATIONS),
+        )
+
     def test_shuffle_notifications_error(
             self, health, populate, scheduler, notifications,
             multiprocessing, quantum_api, cfg):
@@ -63,18 +101,122 @@ class TestMainPippo(unittest.TestCase):
             '9306bbd8-f3cc-11e2-bd68-080027e60b25', 'message'
         )
 
+    @mock.patch('akanda.rug.main.control.start_server')
+    @mock.patch('akanda.rug.main.metrics.start_server')
     @mock.patch('akanda.rug.main.shuffle_notifications')
-    def test_ensure_local_service_port(self, shuffle_notifications, health,
-                                       populate, scheduler, notifications,
-                                       multiprocessing, quantum_api, cfg):
+    def test_ensure_local_service_port(self, shuffle_notifications,
+                                       start_server, control_server,
+                                       health, populate, scheduler,
+                                       notifications, multiprocessing,
+                                       quantum_api, cfg):
         main.main()
         quantum = quantum_api.Quantum.return_value
         quantum.ensure_local_service_port.assert_called_once_with()
 
+    @mock.patch('akanda.rug.main.control.start_server')
+    @mock.patch('akanda.rug.main.metrics.start_server')
+    @mock.patch('akanda.rug.main.shuffle_notifications')
+    def test_bounded_notification_queue(self, shuffle_notifications,
+                                        start_server, control_server,
+                                        health, populate, scheduler,
+                                        notifications, multiprocessing,
+                                        quantum_api, cfg):
+        cfg.CONF.notification_queue_size = 500
+        main.main()
+        multiprocessing.Queue.assert_called_once_with(500)
+
+    @mock.patch('akanda.rug.main.control.start_server')
+    @mock.patch('akanda.rug.main.metrics.start_server')
     @mock.patch('akanda.rug.main.shuffle_notifications')
-    def test_ceilometer_disabled(self, shuffle_notifications, health,
-                                 populate, scheduler, notifications,
-                                 multiprocessing, quantum_api, cfg):
+    def test_local_port_fails(self, shuffle_notifications,
+                              start_server, control_server,
+                              health, populate, scheduler,
+                              notifications, multiprocessing,
+                              quantum_api, cfg):
+        quantum = quantum_api.Quantum.return_value
+        quantum.ensure_local_service_port.side_effect = RuntimeError()
+        self.assertRaises(RuntimeError, main.main)
+        self.assertFalse(shuffle_notifications.called)
+        self.assertFalse(self.proxy.called)
+        scheduler.Scheduler.return_value.stop.assert_called_once_with()
+        multiprocessing.Process.return_value.terminate.assert_called_with()
+
+    @mock.patch('akanda.rug.main.control.start_server')
+    @mock.patch('akanda.rug.main.metrics.start_server')
+    @mock.patch('akanda.rug.main.shuffle_notifications')
+    def test_metadata_processes(self, shuffle_notifications,
+                                start_server, control_server,
+                                health, populate, scheduler,
+                                notifications, multiprocessing,
+                                quantum_api, cfg):
+        cfg.CONF.metadata_workers = 4
+        quantum_api.get_local_service_ip.return_value = 'fdca::1/64'
+        main.main()
+        self.proxy.assert_called_once_with('fdca::1', 4)
+        self.proxy.return_value.start.assert_called_once_with()
+        self.proxy.return_value.stop.assert_called_once_with()
+
+    @mock.patch('akanda.rug.main.control.start_server')
+    @mock.patch('akanda.rug.main.metrics.start_server')
+    @mock.patch('akanda.rug.main.shuffle_notifications')
+    def test_metrics_server(self, shuffle_notifications, start_server,
+                            control_server, health, populate, scheduler,
+                            notifications, multiprocessing, quantum_api,
+                            cfg):
+        cfg.CONF.metrics_host = '127.0.0.1'
+        cfg.CONF.metrics_port = 9183
+        main.main()
+        counts = notifications.MessageCounts.return_value
+        counts.start_reading.assert_called_once_with()
+        start_server.assert_called_once_with(
+            '127.0.0.1', 9183, scheduler.Scheduler.return_value, counts,
+        )
+        listen_kwargs = multiprocessing.Process.call_args_list[0][1]
+        self.assertIs(counts, listen_kwargs['kwargs']['counts'])
+
+    @mock.patch('akanda.rug.main.control.start_server')
+    @mock.patch('akanda.rug.main.metrics.start_server')
+    @mock.patch('akanda.rug.main.shuffle_notifications')
+    def test_metrics_server_disabled(self, shuffle_notifications,
+                                     start_server, control_server, health,
+                                     populate, scheduler, notifications,
+                                     multiprocessing, quantum_api, cfg):
+        cfg.CONF.metrics_port = 0
+        main.main()
+        self.assertFalse(start_server.called)
+        self.assertFalse(notifications.MessageCounts.called)
+
+    @mock.patch('akanda.rug.main.control.start_server')
+    @mock.patch('akanda.rug.main.metrics.start_server')
+    @mock.patch('akanda.rug.main.shuffle_notifications')
+    def test_control_server(self, shuffle_notifications, start_server,
+                            control_server, health, populate, scheduler,
+                            notifications, multiprocessing, quantum_api,
+                            cfg):
+        cfg.CONF.control_socket = '/tmp/rug.sock'
+        main.main()
+        control_server.assert_called_once_with(
+            '/tmp/rug.sock', scheduler.Scheduler.return_value,
+        )
+
+    @mock.patch('akanda.rug.main.control.start_server')
+    @mock.patch('akanda.rug.main.metrics.start_server')
+    @mock.patch('akanda.rug.main.shuffle_notifications')
+    def test_control_server_disabled(self, shuffle_notifications,
+                                     start_server, control_server, health,
+                                     populate, scheduler, notifications,
+                                     multiprocessing, quantum_api, cfg):
+        cfg.CONF.control_socket = ''
+        main.main()
+        self.assertFalse(control_server.called)
+
+    @mock.patch('akanda.rug.main.control.start_server')
+    @mock.patch('akanda.rug.main.metrics.start_server')
+    @mock.patch('akanda.rug.main.shuffle_notifications')
+    def test_ceilometer_disabled(self, shuffle_notifications, start_server,
+                                 control_server, health, populate, scheduler,
+                                 notifications, multiprocessing, quantum_api,
+                                 cfg):
         cfg.CONF.ceilometer.enabled = False
         notifications.Publisher = mock.Mock(spec=ak_notifications.Publisher)
         notifications.NoopPublisher = mock.Mock(
@@ -83,10 +225,13 @@ class TestMainPippo(unittest.TestCase):
         self.assertEqual(len(notifications.Publisher.mock_calls), 0)
         self.assertEqual(len(notifications.NoopPublisher.mock_calls), 1)
 
+    @mock.patch('akanda.rug.main.control.start_server')
+    @mock.patch('akanda.rug.main.metrics.start_server')
     @mock.patch('akanda.rug.main.shuffle_notifications')
-    def test_ceilometer_enabled(self, shuffle_notifications, health,
-                                populate, scheduler, notifications,
-                                multiprocessing, quantum_api, cfg):
+    def test_ceilometer_enabled(self, shuffle_notifications, start_server,
+                                control_server, health, populate, scheduler,
+                                notifications, multiprocessing, quantum_api,
+                                cfg):
         cfg.CONF.ceilometer.enabled = True
         notifications.Publisher = mock.Mock(spec=ak_notifications.Publisher)
         notifications.NoopPublisher = mock.Mock(
@@ -96,7 +241,56 @@ class TestMainPippo(unittest.TestCase):
         self.assertEqual(len(notifications.NoopPublisher.mock_calls), 0)
 
 
+class TestStartupTimer(unittest.TestCase):
+
+    @mock.patch.object(main.time, 'time')
+    def test_report(self, time):
+        time.side_effect = [10.0, 10.0, 10.5, 12.0]
+        timer = main.StartupTimer()
+        with timer.phase('workers'):
+            pass
+        with mock.patch.object(main.LOG, 'info') as info:
+            timer.report()
+        self.assertEqual([('workers', 0.5)], timer.phases)
+        self.assertEqual('started in 2.00 seconds (workers 0.50)',
+                         info.call_args[0][0] % info.call_args[0][1:])
+
+
+class TestRunInParallel(unittest.TestCase):
+
+    def test_at_the_same_time(self):
+        # Each step waits for the other one to start.
+        first, second = threading.Event(), threading.Event()
+
+        def step(started, other):
+            started.set()
+            self.assertTrue(other.wait(5))
+
+        timer = main.StartupTimer()
+        main.run_in_parallel(timer, [
+            ('first', lambda: step(first, second)),
+            ('second', lambda: step(second, first)),
+        ])
+        self.assertEqual(['first', 'second'],
+                         sorted(name for name, _ in timer.phases))
+
+    def test_error(self):
+        done = []
+
+        def fails():
+            raise RuntimeError('neutron is down')
+
+        with mock.patch.object(main.LOG, 'exception'):
+            self.assertRaises(
+                RuntimeError, main.run_in_parallel, main.StartupTimer(),
+                [('fails', fails), ('works', lambda: done.append(1))],
+            )
+        self.assertEqual([1], done)
+
+
 @mock.patch('akanda.rug.main.cfg')
+@mock.patch('akanda.rug.main.control.start_server')
+@mock.patch('akanda.rug.main.metrics.start_server')
 @mock.patch('akanda.rug.api.quantum.importutils')
 @mock.patch('akanda.rug.api.quantum.AkandaExtClientWrapper')
 @mock.patch('akanda.rug.main.multiprocessing')
@@ -108,14 +302,22 @@ class TestMainPippo(unittest.TestCase):
 @mock.patch('akanda.rug.api.quantum.get_local_service_ip')
 class TestMainExtPortBinding(unittest.TestCase):
 
+    def setUp(self):
+        super(TestMainExtPortBinding, self).setUp()
+        mock.patch('akanda.rug.main.metadata.ProxyProcesses').start()
+        self.addCleanup(mock.patch.stopall)
+
     @unittest.skipIf(
         sys.platform != 'linux2',
         'unsupported platform'
     )
+    @mock.patch('akanda.rug.api.quantum._wait_for_device')
     def test_ensure_local_port_host_binding(
-            self, get_local_service_ip, shuffle_notifications, health,
+            self, wait_for_device, get_local_service_ip,
+            shuffle_notifications, health,
             populate, scheduler, notifications, multiprocessing,
-            akanda_wrapper, importutils, cfg):
+            akanda_wrapper, importutils, start_server, control_server,
+            cfg):
 
         cfg.CONF.plug_external_port = False
 
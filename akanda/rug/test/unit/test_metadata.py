@@ -0,0 +1,292 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import socket
+
+import mock
+import unittest2 as unittest
+import webob
+
+from akanda.rug import metadata
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        super(TestResponseCache, self).setUp()
+        self.time = mock.patch.object(metadata.time, 'time').start()
+        self.time.return_value = 100.0
+        self.addCleanup(mock.patch.stopall)
+        self.cache = metadata.ResponseCache(ttl=5, max_size=2,
+                                            max_bytes=10)
+
+    def test_hit(self):
+        self.cache.put(('i', '/'), 'content')
+        self.assertEqual('content', self.cache.get(('i', '/')))
+        self.assertEqual((1, 0), (self.cache.hits, self.cache.misses))
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get(('i', '/')))
+        self.assertEqual((0, 1), (self.cache.hits, self.cache.misses))
+
+    def test_expired(self):
+        self.cache.put(('i', '/'), 'content')
+        self.time.return_value = 105.0
+        self.assertIsNone(self.cache.get(('i', '/')))
+        self.assertEqual(0, len(self.cache._entries))
+        self.assertEqual(0, self.cache.bytes)
+
+    def test_oldest_dropped(self):
+        for key in 'abc':
+            self.cache.put((key, '/'), key)
+        self.assertIsNone(self.cache.get(('a', '/')))
+        self.assertEqual('c', self.cache.get(('c', '/')))
+
+    def test_oldest_dropped_for_room(self):
+        self.cache.put(('a', '/'), 'aaaa')
+        self.cache.put(('b', '/'), 'bbbb')
+        self.cache.put(('c', '/'), 'ccccccc')
+        self.assertIsNone(self.cache.get(('a', '/')))
+        self.assertIsNone(self.cache.get(('b', '/')))
+        self.assertEqual('ccccccc', self.cache.get(('c', '/')))
+        self.assertEqual(7, self.cache.bytes)
+
+    def test_replaced(self):
+        self.cache.put(('a', '/'), 'aaaa')
+        self.cache.put(('a', '/'), 'aaaaaaaa')
+        self.assertEqual('aaaaaaaa', self.cache.get(('a', '/')))
+        self.assertEqual(8, self.cache.bytes)
+
+    def test_too_large(self):
+        self.cache.put(('a', '/'), 'aaaa')
+        self.cache.put(('b', '/'), 'b' * 11)
+        self.assertIsNone(self.cache.get(('b', '/')))
+        self.assertEqual('aaaa', self.cache.get(('a', '/')))
+        self.assertEqual(4, self.cache.bytes)
+
+    def test_disabled(self):
+        self.cache.ttl = 0
+        self.cache.put(('i', '/'), 'content')
+        self.assertIsNone(self.cache.get(('i', '/')))
+
+
+class TestNovaConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        super(TestNovaConnectionPool, self).setUp()
+        self.conn = mock.Mock()
+        self.conn.getresponse.return_value.status = 200
+        self.conn.getresponse.return_value.read.return_value = 'content'
+        self.conn.getresponse.return_value.will_close = False
+        self.pool = metadata.NovaConnectionPool('127.0.0.1', 8775, 2)
+        self.pool.create = mock.Mock(return_value=self.conn)
+
+    def test_get_url(self):
+        self.assertEqual((200, 'content'),
+                         self.pool.get_url('/latest', {'X': 'y'}))
+        self.conn.request.assert_called_once_with('GET', '/latest',
+                                                  headers={'X': 'y'})
+
+    def test_connection_reused(self):
+        self.pool.get_url('/a', {})
+        self.pool.get_url('/b', {})
+        self.assertEqual(1, self.pool.create.call_count)
+        self.assertFalse(self.conn.close.called)
+
+    def test_retried_once(self):
+        self.conn.request.side_effect = [socket.error('reset'), None]
+        self.assertEqual((200, 'content'), self.pool.get_url('/a', {}))
+        self.conn.close.assert_called_once_with()
+        self.conn.request.side_effect = socket.error('refused')
+        self.assertRaises(socket.error, self.pool.get_url, '/a', {})
+
+
+class TestMetadataProxyHandler(unittest.TestCase):
+
+    def setUp(self):
+        super(TestMetadataProxyHandler, self).setUp()
+        self.conf = mock.patch.object(metadata.cfg, 'CONF').start()
+        self.conf.neutron_metadata_proxy_shared_secret = 'secret'
+        self.addCleanup(mock.patch.stopall)
+        self.pool = mock.Mock()
+        self.pool.get_url.return_value = (200, 'content')
+        self.handler = metadata.MetadataProxyHandler(
+            pool=self.pool,
+            cache=metadata.ResponseCache(ttl=5, max_size=10,
+                                         max_bytes=1000),
+        )
+
+    def _get(self, path, method='GET', instance_id='i-1'):
+        req = webob.Request.blank(path, method=method)
+        req.headers['X-Instance-ID'] = instance_id
+        req.headers['X-Tenant-ID'] = 't-1'
+        return req.get_response(self.handler)
+
+    def test_proxied(self):
+        resp = self._get('/latest/meta-data/?x=1')
+        self.assertEqual(200, resp.status_int)
+        self.assertEqual('content', resp.body)
+        path, headers = self.pool.get_url.call_args[0]
+        self.assertEqual('/latest/meta-data/?x=1', path)
+        self.assertEqual('i-1', headers['X-Instance-ID'])
+        self.assertEqual('t-1', headers['X-Tenant-ID'])
+        self.assertNotIn('X-Forwarded-For', headers)
+
+    def test_no_instance(self):
+        req = webob.Request.blank('/latest/')
+        self.assertEqual(404, req.get_response(self.handler).status_int)
+        self.assertFalse(self.pool.get_url.called)
+
+    def test_cached(self):
+        self._get('/latest/meta-data/')
+        resp = self._get('/latest/meta-data/')
+        self.assertEqual('content', resp.body)
+        self.assertEqual(1, self.pool.get_url.call_count)
+        self.assertEqual(1, self.handler.cache.hits)
+
+    def test_cached_by_instance(self):
+        self._get('/latest/meta-data/')
+        self._get('/latest/meta-data/', instance_id='i-2')
+        self.assertEqual(2, self.pool.get_url.call_count)
+
+    def test_only_get_cached(self):
+        self._get('/latest/', method='POST')
+        self._get('/latest/', method='POST')
+        self.assertEqual(2, self.pool.get_url.call_count)
+
+    def test_errors_not_cached(self):
+        self.pool.get_url.return_value = (404, '')
+        self.assertEqual(404, self._get('/latest/nope').status_int)
+        self.pool.get_url.return_value = (500, '')
+        self.assertEqual(500, self._get('/latest/nope').status_int)
+        self.pool.get_url.return_value = (403, '')
+        self.assertEqual(403, self._get('/latest/nope').status_int)
+        self.assertEqual(3, self.pool.get_url.call_count)
+
+    def test_signature_remembered(self):
+        with mock.patch.object(metadata.hmac, 'new') as new:
+            new.return_value.hexdigest.return_value = 'sig'
+            self.assertEqual('sig', self.handler._sign_instance_id('i-1'))
+            self.assertEqual('sig', self.handler._sign_instance_id('i-1'))
+        new.assert_called_once_with('secret', 'i-1', metadata.hashlib.sha256)
+
+
+class TestListen(unittest.TestCase):
+
+    def test_reuse_port(self):
+        first = metadata._listen('::1', 0, reuse_port=True)
+        self.addCleanup(first.close)
+        port = first.getsockname()[1]
+        second = metadata._listen('::1', port, reuse_port=True)
+        self.addCleanup(second.close)
+        self.assertEqual(port, second.getsockname()[1])
+
+    @mock.patch.object(metadata.time, 'sleep')
+    def test_address_not_ready(self, sleep):
+        err = socket.error(metadata.errno.EADDRNOTAVAIL, 'not available')
+        with mock.patch.object(metadata.socket, 'socket') as sock:
+            sock.return_value.bind.side_effect = err
+            self.assertRaises(RuntimeError, metadata._listen, 'fdca::1', 80)
+        self.assertEqual(5, sleep.call_count)
+        self.assertEqual(5, sock.return_value.close.call_count)
+
+
+class TestProxyProcesses(unittest.TestCase):
+
+    def setUp(self):
+        super(TestProxyProcesses, self).setUp()
+        self.process = mock.patch.object(metadata.multiprocessing,
+                                         'Process').start()
+        self.process.side_effect = lambda **kw: mock.Mock(name=kw['name'])
+        self.listen = mock.patch.object(metadata, '_listen').start()
+        self.reuse = mock.patch.object(metadata, '_can_reuse_port').start()
+        self.reuse.return_value = True
+        self.addCleanup(mock.patch.stopall)
+
+    def _kwargs(self):
+        return [c[1]['kwargs'] for c in self.process.call_args_list]
+
+    def _start(self, count):
+        procs = metadata.ProxyProcesses('fdca::1', count)
+        procs.start()
+        self.assertEqual(1, self.process.call_count)
+        self.assertEqual('metadata-supervisor',
+                         self.process.call_args[1]['name'])
+        procs._supervisor.start.assert_called_once_with()
+        self.process.reset_mock()
+        # What the supervisor does first, in its own process.
+        procs._start_procs()
+        return procs
+
+    def test_one_process(self):
+        self._start(1)
+        self.assertEqual(1, self.process.call_count)
+        self.assertEqual('metadata-proxy',
+                         self.process.call_args[1]['name'])
+        self.assertEqual([{'port': metadata.RUG_META_PORT, 'sock': None,
+                           'reuse_port': False}], self._kwargs())
+
+    def test_reuse_port(self):
+        self._start(3)
+        self.assertEqual(3, self.process.call_count)
+        self.assertTrue(all(kw['reuse_port'] for kw in self._kwargs()))
+        self.assertFalse(self.listen.called)
+
+    def test_shared_socket(self):
+        self.reuse.return_value = False
+        self._start(2)
+        self.listen.assert_called_once_with('fdca::1',
+                                            metadata.RUG_META_PORT)
+        self.assertEqual([self.listen.return_value] * 2,
+                         [kw['sock'] for kw in self._kwargs()])
+
+    def test_restarted(self):
+        procs = self._start(2)
+        dead = procs._procs[1]
+        dead.is_alive.return_value = False
+        procs.check()
+        self.assertEqual(3, self.process.call_count)
+        self.assertIsNot(dead, procs._procs[1])
+        self.assertEqual('metadata-proxy-1',
+                         self.process.call_args[1]['name'])
+
+    @mock.patch.object(metadata.daemon, 'die_with_parent')
+    @mock.patch.object(metadata.signal, 'signal')
+    def test_supervise(self, signal, die_with_parent):
+        procs = self._start(2)
+        self.process.reset_mock()
+        with mock.patch.object(metadata.time, 'sleep') as sleep:
+            sleep.side_effect = [None, SystemExit(0)]
+            with mock.patch.object(procs, 'check') as check:
+                self.assertRaises(SystemExit, procs._supervise)
+        die_with_parent.assert_called_once_with()
+        signal.assert_called_once_with(metadata.signal.SIGTERM,
+                                       metadata._exit_on_signal)
+        check.assert_called_once_with()
+        self.assertEqual(2, self.process.call_count)
+        for proc in procs._procs:
+            proc.terminate.assert_called_once_with()
+
+    def test_stop(self):
+        procs = metadata.ProxyProcesses('fdca::1', 2)
+        procs.start()
+        supervisor = procs._supervisor
+        procs.stop()
+        supervisor.terminate.assert_called_once_with()
+        supervisor.join.assert_called_once_with(5)
+        procs.stop()
+        self.assertEqual(1, supervisor.terminate.call_count)
@@ -0,0 +1,203 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import urllib2
+
+import mock
+import unittest2 as unittest
+
+from akanda.rug import metrics
+from akanda.rug import stats
+from akanda.rug.test.unit import fakes
+
+
+class TestExposition(unittest.TestCase):
+
+    def test_render(self):
+        e = metrics.Exposition()
+        e.add('a_total', 'counter', 'Things.', [('x', '1')], 2)
+        e.add('a_total', 'counter', 'Things.', [('x', '2')], 3)
+        e.add('b', 'gauge', 'Other things.', [], 0.5)
+        self.assertEqual(
+            '# HELP a_total Things.\n'
+            '# TYPE a_total counter\n'
+            'a_total{x="1"} 2\n'
+            'a_total{x="2"} 3\n'
+            '# HELP b Other things.\n'
+            '# TYPE b gauge\n'
+            'b 0.5\n',
+            e.render(),
+        )
+
+    def test_escape_labels(self):
+        e = metrics.Exposition()
+        e.add('a', 'gauge', 'A.', [('x', 'say "hi"\\\n')], 1)
+        self.assertIn('a{x="say \\"hi\\"\\\\\\n"} 1', e.render())
+
+    def test_histogram(self):
+        h = stats.Histogram(buckets=(0.1, 1.0))
+        h.observe(0.05)
+        h.observe(0.5)
+        h.observe(5)
+        e = metrics.Exposition()
+        e.add_histogram('d_seconds', 'Durations.', [('x', '1')], h)
+        lines = e.render().splitlines()
+        self.assertEqual([
+            '# HELP d_seconds Durations.',
+            '# TYPE d_seconds histogram',
+            'd_seconds_bucket{x="1",le="0.1"} 1',
+            'd_seconds_bucket{x="1",le="1.0"} 2',
+            'd_seconds_bucket{x="1",le="+Inf"} 3',
+            'd_seconds_sum{x="1"} 5.55',
+            'd_seconds_count{x="1"} 3',
+        ], lines)
+
+
+class TestCollect(unittest.TestCase):
+
+    def setUp(self):
+        super(TestCollect, self).setUp()
+        calls = stats.Timings()
+        calls.observe(('nova', 'get_instance'), 0.2)
+        latency = stats.Timings()
+        latency.observe('akanda.bandwidth.used', 0.002)
+        self.answer = {
+            'uptime': 10.0,
+            'queue_depth': 3,
+            'tenants': 2,
+            'routers_by_state': {'up': 4, 'error': 1},
+            'threads': {
+                't00': {'alive': True, 'status': 'waiting for task',
+                        'busy_seconds': 2.5, 'busy_ratio': 0.25},
+            },
+            'api_calls': calls.snapshot(),
+            'publisher': {
+                'queue_depth': 1,
+                'dropped': 2,
+                'latency': latency.snapshot(),
+            },
+        }
+        mock.patch.dict(metrics.NOTIFICATIONS, {'update': 5},
+                        clear=True).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_collect(self):
+        sched = fakes.fake_scheduler([self.answer])
+        lines = metrics.collect(sched).splitlines()
+        sched.query.assert_called_once_with('metrics', metrics.QUERY_TIMEOUT)
+        for expected in [
+                'akanda_rug_notifications_total{crud="update"} 5',
+                'akanda_rug_worker_up{worker="p00"} 1',
+                'akanda_rug_worker_inbox_depth{worker="p00"} 2',
+                'akanda_rug_worker_queue_depth{worker="p00"} 3',
+                'akanda_rug_worker_tenants{worker="p00"} 2',
+                'akanda_rug_thread_busy_seconds_total'
+                '{worker="p00",thread="t00"} 2.5',
+                'akanda_rug_thread_busy_ratio'
+                '{worker="p00",thread="t00"} 0.25',
+                'akanda_rug_routers{worker="p00",state="error"} 1',
+                'akanda_rug_routers{worker="p00",state="up"} 4',
+                'akanda_rug_api_call_duration_seconds_count'
+                '{worker="p00",service="nova",call="get_instance"} 1',
+                'akanda_rug_publisher_queue_depth{worker="p00"} 1',
+                'akanda_rug_publisher_dropped_total{worker="p00"} 2',
+                'akanda_rug_publish_latency_seconds_count'
+                '{worker="p00",event_type="akanda.bandwidth.used"} 1']:
+            self.assertIn(expected, lines)
+
+    @mock.patch('akanda.rug.populate.status')
+    def test_pre_populate(self, populate_status):
+        populate_status.return_value = {
+            'total': 10, 'seeded': 4, 'done': False,
+            'elapsed_seconds': 2.0, 'eta_seconds': 3.0,
+        }
+        lines = metrics.collect(fakes.fake_scheduler([])).splitlines()
+        for expected in [
+                'akanda_rug_pre_populate_routers 10',
+                'akanda_rug_pre_populate_seeded 4',
+                'akanda_rug_pre_populate_done 0',
+                'akanda_rug_pre_populate_eta_seconds 3.0']:
+            self.assertIn(expected, lines)
+
+    @mock.patch('akanda.rug.populate.status')
+    def test_pre_populate_not_started(self, populate_status):
+        populate_status.return_value = None
+        body = metrics.collect(fakes.fake_scheduler([]))
+        self.assertNotIn('pre_populate', body)
+
+    def test_message_counts(self):
+        counts = mock.Mock()
+        counts.received = {'port.create.end': 3, 'port.create.start': 3}
+        counts.dropped = {'port.create.start': 3}
+        lines = metrics.collect(fakes.fake_scheduler([]),
+                                message_counts=counts).splitlines()
+        for expected in [
+                'akanda_rug_listener_messages_total'
+                '{type="port.create.end"} 3',
+                'akanda_rug_listener_messages_total'
+                '{type="port.create.start"} 3',
+                'akanda_rug_listener_dropped_total'
+                '{type="port.create.start"} 3']:
+            self.assertIn(expected, lines)
+
+    def test_worker_not_answering(self):
+        sched = fakes.fake_scheduler([self.answer, None])
+        lines = metrics.collect(sched).splitlines()
+        self.assertIn('akanda_rug_worker_up{worker="p01"} 0', lines)
+        self.assertIn('akanda_rug_worker_inbox_depth{worker="p01"} 2', lines)
+        self.assertNotIn('akanda_rug_worker_queue_depth{worker="p01"} 0',
+                         lines)
+        self.assertFalse([l for l in lines if 'worker="p01",' in l])
+
+
+def _get(url):
+    # Do not let a proxy from the environment get in the way.
+    return urllib2.build_opener(urllib2.ProxyHandler({})).open(url)
+
+
+class TestServer(unittest.TestCase):
+
+    def _start(self, port=0):
+        server = metrics.start_server('127.0.0.1', port,
+                                      fakes.fake_scheduler([]))
+        if server is not None:
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+        return server
+
+    def test_serve(self):
+        server = self._start()
+        sched = server.scheduler
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+        with mock.patch.object(metrics, 'collect') as collect:
+            collect.return_value = 'a_metric 1\n'
+            r = _get(url + '/metrics')
+            self.assertEqual('a_metric 1\n', r.read())
+            self.assertEqual(metrics.CONTENT_TYPE,
+                             r.info()['Content-Type'])
+            collect.assert_called_once_with(sched, message_counts=None)
+
+    def test_not_found(self):
+        server = self._start()
+        url = 'http://127.0.0.1:%d/other' % server.server_address[1]
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            _get(url)
+        self.assertEqual(404, cm.exception.code)
+
+    def test_address_in_use(self):
+        server = self._start()
+        self.assertIsNone(self._start(server.server_address[1]))
@@ -15,8 +15,10 @@
 # under the License.
 
 
+import json
 import mock
 import socket
+import time
 
 import unittest2 as unittest
 
@@ -303,9 +305,15 @@ class TestSend(unittest.TestCase):
         super(TestSend, self).setUp()
         self.messages = []
         self.producer = mock.Mock()
-        self.producer.publish.side_effect = self.messages.append
+        self.producer.publish.side_effect = (
+            lambda body, **kwargs: self.messages.append(json.loads(body))
+        )
         producer_cls.return_value = self.producer
-        self.notifier = notifications.Publisher('url', 'quantum', 'topic')
+        self.broker = broker.return_value
+        self.broker.ensure.side_effect = lambda obj, fun, **kwargs: fun
+        self.broker.connection_errors = (IOError,)
+        self.notifier = notifications.Publisher('url', 'quantum', 'topic',
+                                                queue_size=3)
         self.notifier.start()
         self.addCleanup(self.notifier.stop)
 
@@ -326,6 +334,15 @@ class TestSend(unittest.TestCase):
         msg = self.messages[0]
         self.assertIn('_context_tenant', msg)
 
+    def test_context_replaces_message_values(self):
+        self.notifier.publish({'payload': 'message here',
+                               '_context_tenant': 'other'})
+        self.notifier.publish({})
+        self.notifier.stop()  # flushes the queue
+        msg1, msg2 = self.messages
+        self.assertEqual(msg2['_context_tenant'], msg1['_context_tenant'])
+        self.assertIn('_unique_id', msg2)
+
     def test_unique_id(self):
         self.notifier.publish({'payload': 'message here'})
         self.notifier.publish({'payload': 'message here'})
@@ -333,6 +350,64 @@ class TestSend(unittest.TestCase):
         msg1, msg2 = self.messages
         self.assertNotEqual(msg1['_unique_id'], msg2['_unique_id'])
 
+    def test_reconnects(self):
+        self.broker.ensure.assert_called_once_with(
+            self.producer, self.producer.publish,
+            errback=mock.ANY,
+            max_retries=None,
+            interval_start=2,
+            interval_step=2,
+            interval_max=30)
+
+    @mock.patch('kombu.connection.BrokerConnection')
+    @mock.patch('kombu.entity.Exchange')
+    @mock.patch('kombu.Producer')
+    def test_sender_gives_up(self, producer_cls, exchange, broker):
+        with notifications.Sender('url', 'quantum', 'topic'):
+            pass
+        retries = dict(errback=mock.ANY,
+                       max_retries=notifications.SENDER_MAX_RETRIES,
+                       interval_start=2,
+                       interval_step=2,
+                       interval_max=30)
+        broker.return_value.ensure_connection.assert_called_once_with(
+            **retries)
+        broker.return_value.ensure.assert_called_once_with(
+            producer_cls.return_value, producer_cls.return_value.publish,
+            **retries)
+
+    def test_batch(self):
+        self.notifier.BATCH_WINDOW = 10
+        self.notifier.MAX_BATCH = 2
+        with mock.patch.object(notifications.Sender, 'send_batch') as send:
+            send.return_value = 2
+            for i in range(3):
+                self.notifier.publish({'event_type': 'e', 'payload': i})
+            self.notifier.stop()
+        self.assertEqual(
+            [mock.call([{'event_type': 'e', 'payload': 0},
+                        {'event_type': 'e', 'payload': 1}]),
+             mock.call([{'event_type': 'e', 'payload': 2}])],
+            send.call_args_list,
+        )
+        stats = self.notifier.latency.snapshot()
+        self.assertEqual(['e'], [key for key, h in stats])
+        self.assertEqual(3, stats[0][1].count)
+
+    def test_connection_lost(self):
+        self.producer.publish.side_effect = [None, IOError('lost')]
+        for i in range(3):
+            self.notifier.publish({'payload': i})
+        self.notifier.stop()
+        self.assertEqual(2, self.notifier.get_stats()['dropped'])
+
+    def test_queue_full(self):
+        self.notifier.stop()
+        for i in range(5):
+            self.notifier.publish({'payload': i})
+        self.assertEqual({'queue_depth': 3, 'dropped': 2, 'latency': []},
+                         self.notifier.get_stats())
+
 
 class TestListen(unittest.TestCase):
 
@@ -377,3 +452,308 @@ class TestListen(unittest.TestCase):
                                     interval_start=2,
                                     interval_step=2,
                                     interval_max=30)])
+
+    @mock.patch('kombu.connection.BrokerConnection')
+    def test_prefetch_count(self, mock_broker):
+        broker = mock_broker.return_value
+        broker.drain_events = mock.Mock(side_effect=SystemExit())
+        channel = broker.channel.return_value
+
+        notifications.listen('test-host', 'amqp://test.host',
+                             'test-notifications', 'test-rpc',
+                             mock.MagicMock(), prefetch_count=10)
+
+        channel.basic_qos.assert_called_once_with(0, 10, False)
+
+
+class TestAckBatchSize(unittest.TestCase):
+
+    def test_no_prefetch_limit(self):
+        self.assertEqual(notifications.MAX_ACK_BATCH,
+                         notifications._ack_batch_size(0))
+
+    def test_half_of_prefetch(self):
+        self.assertEqual(10, notifications._ack_batch_size(20))
+        self.assertEqual(1, notifications._ack_batch_size(1))
+        self.assertEqual(notifications.MAX_ACK_BATCH,
+                         notifications._ack_batch_size(1000))
+
+
+class TestAcknowledger(unittest.TestCase):
+
+    def setUp(self):
+        super(TestAcknowledger, self).setUp()
+        self.channel = mock.Mock()
+        self.acks = notifications.Acknowledger(3)
+
+    def _message(self, tag):
+        message = mock.Mock()
+        message.channel = self.channel
+        message.delivery_tag = tag
+        return message
+
+    def test_batch(self):
+        for tag in range(1, 3):
+            self.acks.ack(self._message(tag))
+        self.assertTrue(self.acks.pending)
+        self.assertFalse(self.channel.basic_ack.called)
+        self.acks.ack(self._message(3))
+        self.channel.basic_ack.assert_called_once_with(3, multiple=True)
+        self.assertFalse(self.acks.pending)
+
+    def test_flush(self):
+        self.acks.flush()
+        self.assertFalse(self.channel.basic_ack.called)
+        self.acks.ack(self._message(1))
+        self.acks.flush()
+        self.channel.basic_ack.assert_called_once_with(1, multiple=True)
+
+    def test_reject(self):
+        m1 = self._message(1)
+        m2 = self._message(2)
+        self.acks.ack(m1)
+        self.acks.reject(m2)
+        self.channel.basic_ack.assert_called_once_with(1, multiple=True)
+        m2.reject.assert_called_once_with()
+        self.assertFalse(self.acks.pending)
+
+    def test_one_at_a_time(self):
+        self.acks.multiple = False
+        messages = [self._message(tag) for tag in range(1, 4)]
+        for m in messages:
+            self.acks.ack(m)
+        for m in messages:
+            m.ack.assert_called_once_with()
+        self.assertFalse(self.channel.basic_ack.called)
+
+    def test_forgotten_when_ack_fails(self):
+        self.channel.basic_ack.side_effect = IOError()
+        self.acks.ack(self._message(1))
+        self.assertRaises(IOError, self.acks.flush)
+        self.assertFalse(self.acks.pending)
+
+
+def _wire_message(body, content_type='application/json'):
+    message = mock.Mock()
+    message.content_type = content_type
+    message.content_encoding = 'utf-8'
+    message.body = body
+    message.decode.side_effect = lambda: json.loads(body)
+    return message
+
+
+def _notification(event_type, **extra):
+    body = {
+        'event_type': event_type,
+        '_context_tenant_id': 'tenant',
+        'payload': {'router': {'id': 'r1'}},
+    }
+    body.update(extra)
+    return json.dumps(body)
+
+
+def _rpc(method):
+    return json.dumps({
+        'oslo.version': '2.0',
+        'oslo.message': json.dumps({
+            'method': method,
+            '_context_tenant_id': 'tenant',
+            'args': {'router_id': 'r1'},
+        }),
+    })
+
+
+class TestPeek(unittest.TestCase):
+
+    def _peek(self, body, **kwargs):
+        return notifications._peek(_wire_message(body, **kwargs))
+
+    def test_interesting_notification(self):
+        self.assertEqual(('port.create.end', True),
+                         self._peek(_notification('port.create.end')))
+
+    def test_uninteresting_notification(self):
+        for event_type in ['port.create.start', 'routerstatus.update',
+                           'floatingip.update.start']:
+            self.assertEqual((event_type, False),
+                             self._peek(_notification(event_type)))
+
+    def test_command(self):
+        self.assertEqual(('akanda.rug.command', True),
+                         self._peek(_notification('akanda.rug.command')))
+
+    def test_rpc_in_envelope(self):
+        self.assertEqual(('router_deleted', True),
+                         self._peek(_rpc('router_deleted')))
+        self.assertEqual(('routers_updated', False),
+                         self._peek(_rpc('routers_updated')))
+
+    def test_nested_event_type(self):
+        body = _notification('port.create.start',
+                             payload={'event_type': 'port.create.end'})
+        self.assertEqual((None, True), self._peek(body))
+
+    def test_not_a_string(self):
+        self.assertEqual((None, True), self._peek(_notification(None)))
+
+    def test_not_json(self):
+        self.assertEqual(
+            (None, True),
+            self._peek('event_type', content_type='application/x-python'),
+        )
+
+    def test_agrees_with_make_event(self):
+        for body in [_notification('router.interface.create'),
+                     _notification('router.create.end'),
+                     _notification('subnet.delete.end'),
+                     _notification('port.update.start'),
+                     _notification('routerstatus.update'),
+                     _rpc('router_deleted'),
+                     _rpc('router_added_to_agent')]:
+            kind, interesting = self._peek(body)
+            event = notifications._make_event_from_message(
+                json.loads(body))
+            self.assertEqual(interesting, event is not None, kind)
+
+
+class TestMessageCounts(unittest.TestCase):
+
+    def setUp(self):
+        super(TestMessageCounts, self).setUp()
+        self.counts = notifications.MessageCounts()
+
+    def test_count(self):
+        self.counts.count('port.create.end', False)
+        self.counts.count('port.create.start', True)
+        self.counts.count(None, True)
+        self.assertEqual({'port.create.end': 1, 'port.create.start': 1,
+                          'unknown': 1}, dict(self.counts.received))
+        self.assertEqual({'port.create.start': 1, 'unknown': 1},
+                         dict(self.counts.dropped))
+
+    def test_too_many_types(self):
+        self.counts.MAX_TYPES = 2
+        for kind in ['a', 'b', 'c', 'd', 'a']:
+            self.counts.count(kind, False)
+        self.assertEqual({'a': 2, 'b': 1, 'other': 2},
+                         dict(self.counts.received))
+
+    def test_published(self):
+        self.counts.count('port.create.start', True)
+        parent = notifications.MessageCounts()
+        parent._totals = self.counts._totals
+        parent.start_reading()
+        self.counts.publish()
+        for i in range(500):
+            if parent.received:
+                break
+            time.sleep(0.01)
+        self.assertEqual({'port.create.start': 1}, dict(parent.received))
+        self.assertEqual({'port.create.start': 1}, dict(parent.dropped))
+
+    def test_published_when_changed(self):
+        self.counts._totals = mock.Mock()
+        self.counts.publish()
+        self.counts.count('port.create.start', True)
+        self.counts.publish()
+        self.counts.publish()
+        self.assertEqual(2, self.counts._totals.put.call_count)
+
+
+class TestListenFilter(unittest.TestCase):
+
+    def setUp(self):
+        super(TestListenFilter, self).setUp()
+        broker_cls = mock.patch('kombu.connection.BrokerConnection').start()
+        consumer_cls = mock.patch('kombu.messaging.Consumer').start()
+        self.addCleanup(mock.patch.stopall)
+        self.messages = []
+
+        def drain_events(timeout=None):
+            if not self.messages:
+                if timeout is not None:
+                    raise socket.timeout()
+                raise SystemExit()
+            on_message = consumer_cls.call_args[1]['on_message']
+            on_message(self.messages.pop(0))
+        self.broker = broker_cls.return_value
+        self.broker.drain_events.side_effect = drain_events
+        self.broker.transport.driver_type = 'memory'
+        self.queue = mock.Mock()
+        self.counts = mock.Mock()
+
+    def _listen(self, *messages, **kwargs):
+        self.messages.extend(messages)
+        notifications.listen('test-host', 'amqp://test.host',
+                             'test-notifications', 'test-rpc',
+                             self.queue, counts=self.counts, **kwargs)
+
+    def test_dropped_without_decoding(self):
+        message = _wire_message(_notification('port.create.start'))
+        self._listen(message)
+        self.assertFalse(message.decode.called)
+        message.ack.assert_called_once_with()
+        self.assertFalse(self.queue.put.called)
+        self.counts.count.assert_called_once_with('port.create.start', True)
+
+    def test_delivered(self):
+        message = _wire_message(_notification('port.create.end'))
+        self._listen(message)
+        message.ack.assert_called_once_with()
+        self.queue.put.assert_called_once_with(('tenant', mock.ANY))
+        self.counts.count.assert_called_once_with('port.create.end', False)
+
+    def test_decoded_and_dropped(self):
+        body = _notification('routerstatus.update',
+                             payload={'event_type': 'x'})
+        message = _wire_message(body)
+        self._listen(message)
+        self.assertTrue(message.decode.called)
+        message.ack.assert_called_once_with()
+        self.assertFalse(self.queue.put.called)
+        self.counts.count.assert_called_once_with(None, True)
+
+    def test_bad_message(self):
+        message = _wire_message('{"event_type": "port.create.end", ')
+        self._listen(message)
+        message.reject.assert_called_once_with()
+        self.assertFalse(message.ack.called)
+        self.counts.count.assert_called_once_with('port.create.end', True)
+
+    def test_acked_together(self):
+        self.broker.transport.driver_type = 'amqp'
+        messages = [_wire_message(_notification('port.create.end'))
+                    for i in range(3)]
+        channel = mock.Mock()
+        for i, m in enumerate(messages):
+            m.channel = channel
+            m.delivery_tag = i + 1
+        self._listen(*messages)
+        channel.basic_ack.assert_called_once_with(3, multiple=True)
+        for m in messages:
+            self.assertFalse(m.ack.called)
+
+    def test_acked_before_prefetch_used(self):
+        self.broker.transport.driver_type = 'amqp'
+        messages = [_wire_message(_notification('port.create.end'))
+                    for i in range(5)]
+        channel = mock.Mock()
+        for i, m in enumerate(messages):
+            m.channel = channel
+            m.delivery_tag = i + 1
+        self._listen(*messages, prefetch_count=4)
+        self.assertEqual(
+            [mock.call(2, multiple=True), mock.call(4, multiple=True),
+             mock.call(5, multiple=True)],
+            channel.basic_ack.call_args_list,
+        )
+
+    def test_old_binding_removed(self):
+        queue = mock.patch('kombu.entity.Queue').start()
+        self._listen()
+        self.assertEqual(
+            notifications.NOTIFICATIONS_ROUTING_KEY,
+            queue.call_args_list[0][1]['routing_key'],
+        )
+        queue.return_value.unbind_from.assert_called_once_with(
+            mock.ANY, routing_key='notifications.*')
@@ -15,11 +15,14 @@
 # under the License.
 
 
+import threading
+
 import mock
 import unittest2 as unittest
 
 from neutronclient.common import exceptions as q_exceptions
 
+from akanda.rug import health
 from akanda.rug import populate
 
 
@@ -86,13 +89,17 @@ class TestPrePopulateWorkers(unittest.TestCase):
         sched = mock.Mock()
         populate._pre_populate_workers(sched)
         expected = [
-            mock.call.warning(u'Could not fetch routers from quantum: '
-                              'An unknown exception occurred.'),
-            mock.call.warning('sleeping 1 seconds before retrying'),
+            mock.call.warning('Could not fetch routers from quantum: %s',
+                              mock.ANY),
+            mock.call.warning('sleeping %s seconds before retrying', 1),
             mock.call.debug('Start pre-populating the workers '
-                            'with %d fetched routers', 1)
+                            'with %d fetched routers', 1),
+            mock.call.info('Pre-populated %d of %d routers, ETA %s seconds',
+                           1, 1, 0),
         ]
         self.assertEqual(log.mock_calls, expected)
+        err = log.warning.call_args_list[0][0][1]
+        self.assertEqual(u'An unknown exception occurred.', unicode(err))
 
     @mock.patch('akanda.rug.event.Event')
     @mock.patch('akanda.rug.api.quantum.Quantum')
@@ -137,10 +144,118 @@ class TestPrePopulateWorkers(unittest.TestCase):
         t = populate.pre_populate_workers(sched)
         thread.assert_called_once_with(
             target=populate._pre_populate_workers,
-            args=(sched,),
+            args=(sched, None),
             name='PrePopulateWorkers'
         )
         self.assertEqual(
             t.mock_calls,
             [mock.call.setDaemon(True), mock.call.start()]
         )
+
+    @mock.patch('akanda.rug.api.quantum.Quantum')
+    def test_holds_sweep_lock(self, mocked_quantum_api):
+        sweep_lock = mock.MagicMock()
+        quantum_client = mock.Mock()
+        quantum_client.get_routers.return_value = []
+        mocked_quantum_api.return_value = quantum_client
+        populate._pre_populate_workers(mock.Mock(), sweep_lock)
+        sweep_lock.__enter__.assert_called_once_with()
+        sweep_lock.__exit__.assert_called_once_with(None, None, None)
+
+    @mock.patch('time.sleep')
+    @mock.patch('akanda.rug.api.quantum.Quantum')
+    def test_sweeps_while_fetch_fails(self, mocked_quantum_api, sleep):
+        sweep_lock = threading.Lock()
+        health_sched = mock.Mock()
+
+        def sweep(seconds):
+            # Run one round of the health check while waiting to
+            # try quantum again.
+            with mock.patch.object(health, 'time') as health_time:
+                health_time.sleep.side_effect = [None, StopIteration]
+                self.assertRaises(StopIteration, health._health_inspector,
+                                  60, health_sched, sweep_lock)
+        sleep.side_effect = sweep
+
+        quantum_client = mocked_quantum_api.return_value
+        quantum_client.get_routers.side_effect = [
+            q_exceptions.NeutronClientException,
+            q_exceptions.NeutronClientException,
+            q_exceptions.NeutronClientException,
+            [],
+        ]
+        populate._pre_populate_workers(mock.Mock(), sweep_lock)
+        self.assertEqual(3, health_sched.handle_message.call_count)
+        self.assertEqual('*', health_sched.handle_message.call_args[0][0])
+
+
+class TestFeedRouters(unittest.TestCase):
+
+    def _router(self, router_id, status):
+        return mock.Mock(id=router_id, tenant_id='t' + router_id,
+                         status=status)
+
+    def test_priority_order(self):
+        routers = [
+            self._router('1', 'ACTIVE'),
+            self._router('2', 'DOWN'),
+            self._router('3', 'ERROR'),
+            self._router('4', 'ACTIVE'),
+            self._router('5', 'BUILD'),
+        ]
+        sched = mock.Mock()
+        populate._feed_routers(sched, routers, 0)
+        self.assertEqual(
+            [c[0][1].router_id for c in sched.handle_message.call_args_list],
+            ['3', '5', '2', '1', '4'],
+        )
+
+    @mock.patch('time.sleep')
+    def test_rate_limited(self, sleep):
+        routers = [self._router(str(i), 'ACTIVE') for i in range(10)]
+        sched = mock.Mock()
+        with mock.patch('time.time', return_value=100.0):
+            populate._feed_routers(sched, routers, 5)
+        self.assertEqual(sched.handle_message.call_count, 10)
+        # The first router goes out right away, and the clock is not
+        # moving so each of the others waits for its slot.
+        self.assertEqual(sleep.call_count, 9)
+        self.assertAlmostEqual(sleep.call_args_list[-1][0][0], 1.8)
+
+    @mock.patch('time.sleep')
+    def test_no_rate_limit(self, sleep):
+        routers = [self._router(str(i), 'ACTIVE') for i in range(10)]
+        populate._feed_routers(mock.Mock(), routers, 0)
+        self.assertEqual(sleep.call_count, 0)
+
+    def test_progress(self):
+        routers = [self._router(str(i), 'ACTIVE') for i in range(3)]
+        progress = populate._feed_routers(mock.Mock(), routers, 0)
+        self.assertEqual(progress.total, 3)
+        self.assertEqual(progress.seeded, 3)
+        self.assertEqual(progress.eta, 0)
+
+    def test_progress_status(self):
+        self.addCleanup(setattr, populate, 'PROGRESS', populate.PROGRESS)
+        populate.PROGRESS = None
+        self.assertIsNone(populate.status())
+        routers = [self._router(str(i), 'ACTIVE') for i in range(3)]
+        sched = mock.Mock()
+        seen = []
+        sched.handle_message.side_effect = (
+            lambda *args: seen.append(populate.status())
+        )
+        populate._feed_routers(sched, routers, 0)
+        self.assertEqual([0, 1, 2], [s['seeded'] for s in seen])
+        self.assertFalse(seen[-1]['done'])
+        status = populate.status()
+        self.assertEqual((3, 3, True),
+                         (status['total'], status['seeded'], status['done']))
+        self.assertEqual(0, status['eta_seconds'])
+
+    def test_progress_eta(self):
+        with mock.patch('time.time', return_value=100.0):
+            progress = populate.Progress(10)
+        progress.seeded = 2
+        with mock.patch('time.time', return_value=104.0):
+            self.assertEqual(progress.eta, 16)
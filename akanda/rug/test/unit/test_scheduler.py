@@ -16,6 +16,7 @@
 
 
 import mock
+import threading
 import uuid
 
 import unittest2 as unittest
@@ -52,6 +53,58 @@ class TestScheduler(unittest.TestCase):
             self.assertEqual(w['worker'].join.call_count, 2)
 
 
+class TestQuery(unittest.TestCase):
+
+    def setUp(self):
+        super(TestQuery, self).setUp()
+        process = mock.patch('multiprocessing.Process').start()
+        self.addCleanup(mock.patch.stopall)
+        self.s = scheduler.Scheduler(2, mock.Mock)
+        self.workers = []
+        # Answer the queries from threads standing in for the worker
+        # processes.
+        for call in process.call_args_list:
+            w = mock.Mock()
+            w.handle_query.side_effect = lambda name, w=w: (name, id(w))
+            t = threading.Thread(
+                target=scheduler._answer_queries,
+                args=(call[1]['kwargs']['queries'], w),
+            )
+            t.setDaemon(True)
+            t.start()
+            self.workers.append(w)
+
+    def test_all_workers_answer(self):
+        self.assertEqual(
+            [('metrics', id(w)) for w in self.workers],
+            self.s.query('metrics'),
+        )
+
+    def test_error(self):
+        self.workers[0].handle_query.side_effect = ValueError('bad query')
+        answers = self.s.query('metrics')
+        self.assertIsNone(answers[0])
+        self.assertEqual(('metrics', id(self.workers[1])), answers[1])
+
+    def test_timeout_then_late_answer(self):
+        release = threading.Event()
+
+        def slow(name):
+            release.wait()
+            return 'late %s' % name
+        self.workers[0].handle_query.side_effect = slow
+        answers = self.s.query('first', timeout=0.1)
+        self.assertIsNone(answers[0])
+        # The answer to the first query arrives while the second one is
+        # being asked, and must not be taken for the second answer.
+        self.workers[0].handle_query.side_effect = (
+            lambda name: 'on time %s' % name
+        )
+        release.set()
+        answers = self.s.query('second')
+        self.assertEqual('on time second', answers[0])
+
+
 class TestDispatcher(unittest.TestCase):
 
     def setUp(self):
@@ -15,8 +15,9 @@
 # under the License.
 
 
+import collections
 import logging
-from collections import deque
+import random
 
 import mock
 import unittest2 as unittest
@@ -39,7 +40,7 @@ class BaseTestStateCase(unittest.TestCase):
         self.params = state.StateParams(
             vm=self.vm,
             log=log,
-            queue=deque(),
+            queue=state.PendingActions(),
             bandwidth_callback=mock.Mock(),
             reboot_error_threshold=3,
             router_image_uuid='GLANCE-IMAGE-123'
@@ -54,6 +55,179 @@ class BaseTestStateCase(unittest.TestCase):
         return result
 
 
+def _collapse(action, queue):
+    "How CalcAction collapsed the events when each one was queued."
+    if event.DELETE in queue:
+        return event.DELETE
+    while queue:
+        if action == event.UPDATE and queue[0] == event.CREATE:
+            action = queue.popleft()
+        elif action in (event.CREATE, event.UPDATE) and \
+                queue[0] == event.REBUILD:
+            action = queue.popleft()
+        elif action == event.CREATE and queue[0] == event.UPDATE:
+            queue.popleft()
+        elif action and queue[0] == event.POLL:
+            queue.popleft()
+        elif action and action != event.POLL and action != queue[0]:
+            break
+        else:
+            action = queue.popleft()
+    return action
+
+
+# The actions whose work each action also does.
+_COVERS = {
+    event.DELETE: set([event.DELETE, event.REBUILD, event.CREATE,
+                       event.UPDATE, event.READ, event.POLL]),
+    event.REBUILD: set([event.REBUILD, event.CREATE, event.UPDATE,
+                        event.POLL]),
+    event.CREATE: set([event.CREATE, event.UPDATE, event.POLL]),
+    event.UPDATE: set([event.UPDATE, event.POLL]),
+    event.READ: set([event.READ]),
+    event.POLL: set([event.POLL]),
+    None: set(),
+}
+
+
+def _covered(actions):
+    return set().union(*[_COVERS[action] for action in actions])
+
+
+def _run_actions(action, batches, queue, collapse):
+    """Return the actions picked by collapse until the router is deleted.
+
+    Each batch of events is queued before picking the next action, and
+    the action picked before is kept for the next round when the batch
+    asks for it, the way the states hand it back to CalcAction.
+    """
+    picked = []
+    for keep, batch in batches:
+        for crud in batch:
+            queue.append(crud)
+        if not queue:
+            continue
+        action = collapse(action if keep else event.POLL, queue)
+        picked.append(action)
+        if action == event.DELETE:
+            return picked
+    while queue:
+        action = collapse(event.POLL, queue)
+        picked.append(action)
+        if action == event.DELETE:
+            break
+    return picked
+
+
+class TestPendingActions(unittest.TestCase):
+
+    def _queue(self, *actions):
+        queue = state.PendingActions()
+        for action in actions:
+            queue.append(action)
+        return queue
+
+    def assertQueue(self, expected, *actions):
+        self.assertEqual(expected, list(self._queue(*actions)))
+
+    def test_duplicates(self):
+        self.assertQueue([event.UPDATE], event.UPDATE, event.UPDATE)
+
+    def test_duplicates_not_adjacent(self):
+        self.assertQueue([event.UPDATE, event.READ],
+                         event.UPDATE, event.READ, event.UPDATE)
+
+    def test_delete_replaces_all(self):
+        self.assertQueue([event.DELETE],
+                         event.CREATE, event.READ, event.DELETE,
+                         event.UPDATE)
+
+    def test_poll_alone(self):
+        self.assertQueue([event.POLL], event.POLL, event.POLL)
+
+    def test_poll_after_action(self):
+        self.assertQueue([event.READ], event.READ, event.POLL)
+
+    def test_action_after_poll(self):
+        self.assertQueue([event.UPDATE], event.POLL, event.UPDATE)
+
+    def test_update_upgraded_to_create(self):
+        self.assertQueue([event.CREATE], event.UPDATE, event.CREATE)
+
+    def test_update_after_create(self):
+        self.assertQueue([event.CREATE], event.CREATE, event.UPDATE)
+
+    def test_rebuild_not_merged(self):
+        self.assertQueue([event.UPDATE, event.REBUILD],
+                         event.UPDATE, event.REBUILD)
+        self.assertQueue([event.REBUILD, event.CREATE],
+                         event.REBUILD, event.CREATE, event.REBUILD)
+
+    def test_not_upgraded_past_read(self):
+        self.assertQueue([event.UPDATE, event.READ, event.CREATE],
+                         event.UPDATE, event.READ, event.CREATE)
+
+    def test_storm_merged(self):
+        actions = [event.UPDATE, event.POLL, event.UPDATE, event.CREATE] * 1000
+        queue = self._queue(*actions)
+        self.assertEqual([event.CREATE], list(queue))
+        self.assertEqual(4000, queue.events)
+
+    def test_alternating_bounded(self):
+        for pair in [(event.UPDATE, event.READ),
+                     (event.REBUILD, event.UPDATE),
+                     (event.CREATE, event.READ, event.UPDATE)]:
+            queue = self._queue(*(pair * 5000))
+            self.assertEqual(list(pair[:2]), list(queue)[:2])
+            self.assertLessEqual(len(queue), len(pair))
+
+    def test_bounded(self):
+        kinds = [event.POLL, event.CREATE, event.READ, event.UPDATE,
+                 event.REBUILD]
+        rand = random.Random(7)
+        queue = state.PendingActions()
+        for i in range(10000):
+            queue.append(rand.choice(kinds))
+            self.assertLessEqual(len(queue), len(kinds) - 1)
+
+    def test_events_reset_when_empty(self):
+        queue = self._queue(event.UPDATE, event.UPDATE)
+        queue.popleft()
+        self.assertEqual(0, queue.events)
+
+    def test_appendleft(self):
+        queue = self._queue(event.READ, event.UPDATE)
+        queue.appendleft(event.UPDATE)
+        self.assertEqual([event.UPDATE, event.READ, event.UPDATE],
+                         list(queue))
+
+    def test_covers_collapsing_events(self):
+        # Run the events through CalcAction a few at a time, as they
+        # would arrive while the router is busy, and compare the
+        # actions picked with the ones picked from the events queued
+        # one by one: the work asked for is still done, with no more
+        # actions.
+        calc = state.CalcAction(mock.Mock(log=logging.getLogger(__name__)))
+        kinds = [event.POLL, event.CREATE, event.READ, event.UPDATE,
+                 event.DELETE, event.REBUILD]
+        rand = random.Random(42)
+        for i in range(2000):
+            batches = [
+                (rand.random() < 0.5,
+                 [rand.choice(kinds) for j in range(rand.randint(0, 4))])
+                for k in range(rand.randint(1, 5))
+            ]
+            start = rand.choice(kinds[:-2] + [None])
+            expected = _run_actions(start, batches, collections.deque(),
+                                    lambda a, q: _collapse(a, q))
+            actual = _run_actions(start, batches, state.PendingActions(),
+                                  calc._collapse)
+            self.assertLessEqual(_covered(expected), _covered(actual),
+                                 (start, batches))
+            self.assertLessEqual(len(actual), len(expected),
+                                 (start, batches))
+
+
 class TestBaseState(BaseTestStateCase):
     def test_execute(self):
         self.assertEqual(
@@ -68,12 +242,29 @@ class TestBaseState(BaseTestStateCase):
         )
 
 
+class TestStateParams(BaseTestStateCase):
+
+    def test_state_reused(self):
+        calc = self.params.state(state.CalcAction)
+        self.assertIsInstance(calc, state.CalcAction)
+        self.assertIs(calc, self.params.state(state.CalcAction))
+        self.assertIs(self.params, calc.params)
+
+    def test_transition_reuses_state(self):
+        self.vm.state = vm_manager.UP
+        alive = self.params.state(state.Alive)
+        calc = self.params.state(state.CalcAction)
+        self.assertIs(alive, calc.transition(event.POLL, self.ctx))
+
+
 class TestCalcActionState(BaseTestStateCase):
     state_cls = state.CalcAction
 
     def _test_hlpr(self, expected_action, queue_states,
                    leftover=0, initial_action=event.POLL):
-        self.params.queue = deque(queue_states)
+        self.params.queue = state.PendingActions()
+        for action in queue_states:
+            self.params.queue.append(action)
         self.assertEqual(
             self.state.execute(initial_action, self.ctx),
             expected_action
@@ -84,7 +275,7 @@ class TestCalcActionState(BaseTestStateCase):
         self._test_hlpr('testaction', [], initial_action='testaction')
 
     def test_execute_delete_in_queue(self):
-        self._test_hlpr(event.DELETE, [event.CREATE, event.DELETE], 2)
+        self._test_hlpr(event.DELETE, [event.CREATE, event.DELETE], 1)
 
     def test_none_start_action_update(self):
         self._test_hlpr(expected_action=event.UPDATE,
@@ -488,14 +679,14 @@ class TestReadStatsState(BaseTestStateCase):
     state_cls = state.ReadStats
 
     def test_execute(self):
-        self.vm.read_stats.return_value = 'foo'
+        self.vm.router_id = 'router-id'
 
         self.assertEqual(
             self.state.execute(event.READ, self.ctx),
             event.POLL
         )
-        self.vm.read_stats.assert_called_once_with()
-        self.params.bandwidth_callback.assert_called_once_with('foo')
+        self.assertFalse(self.vm.read_stats.called)
+        self.params.bandwidth_callback.assert_called_once_with('router-id')
 
     def test_transition(self):
         self._test_transition_hlpr(event.POLL, state.CalcAction)
@@ -523,6 +714,19 @@ class TestAutomaton(unittest.TestCase):
             reboot_error_threshold=5,
         )
 
+    def test_log_not_registered(self):
+        name = state.LOG.name + '.' + self.sm.router_id
+        self.assertNotIn(name, logging.Logger.manager.loggerDict)
+        self.assertIs(self.sm.log.logger, state.LOG)
+
+    def test_log_includes_router_id(self):
+        with mock.patch.object(state.LOG, 'debug') as debug:
+            self.sm.log.debug('hello %s', 'world')
+        debug.assert_called_once_with(
+            '9306bbd8-f3cc-11e2-bd68-080027e60b25: hello %s', 'world',
+            extra={'router_id': '9306bbd8-f3cc-11e2-bd68-080027e60b25'},
+        )
+
     def test_send_message(self):
         message = mock.Mock()
         message.crud = 'update'
@@ -530,8 +734,8 @@ class TestAutomaton(unittest.TestCase):
             self.sm.send_message(message)
             self.assertEqual(len(self.sm._queue), 1)
             logger.debug.assert_called_with(
-                'incoming message brings queue length to %s',
-                1,
+                'incoming message brings queue length to %s (%s events)',
+                1, 1,
             )
 
     def test_send_message_over_threshold(self):
@@ -542,9 +746,10 @@ class TestAutomaton(unittest.TestCase):
         with mock.patch.object(self.sm, 'log') as logger:
             self.sm.send_message(message)
             logger.warning.assert_called_with(
-                'incoming message brings queue length to %s',
-                4,
+                'incoming message brings queue length to %s (%s events)',
+                1, 4,
             )
+            self.assertEqual(len(self.sm._queue), 1)
 
     def test_send_message_deleting(self):
         message = mock.Mock()
@@ -569,8 +774,8 @@ class TestAutomaton(unittest.TestCase):
             self.sm.send_message(message)
             self.assertEqual(len(self.sm._queue), 1)
             logger.debug.assert_called_with(
-                'incoming message brings queue length to %s',
-                1,
+                'incoming message brings queue length to %s (%s events)',
+                1, 1,
             )
 
     def test_send_rebuild_message_with_custom_image(self):
@@ -638,6 +843,38 @@ class TestAutomaton(unittest.TestCase):
                 ]
             )
 
+    def test_update_records_transition_time(self):
+        message = mock.Mock()
+        message.crud = event.UPDATE
+        self.sm.send_message(message)
+        self.sm.last_transition = 0
+        fake_state = mock.Mock()
+        fake_state.transition.return_value = state.Exit(mock.Mock())
+        self.sm.state = fake_state
+        with mock.patch('time.time') as now:
+            now.return_value = 1234
+            self.sm.update(self.ctx)
+        self.assertEqual(1234, self.sm.last_transition)
+
+    def test_get_status(self):
+        self.vm_mgr_cls.return_value.state = vm_manager.UP
+        message = mock.Mock()
+        message.crud = event.UPDATE
+        self.sm.send_message(message)
+        self.sm.last_transition = 0
+        self.assertEqual(
+            {
+                'router_id': '9306bbd8-f3cc-11e2-bd68-080027e60b25',
+                'tenant_id': 'tenant-id',
+                'state': 'CalcAction',
+                'vm_state': vm_manager.UP,
+                'last_transition': '1970-01-01T00:00:00Z',
+                'pending': [event.UPDATE],
+                'deleted': False,
+            },
+            self.sm.get_status(),
+        )
+
     def test_update_calc_action_args(self):
         message = mock.Mock()
         message.crud = event.UPDATE
@@ -663,7 +900,7 @@ class TestAutomaton(unittest.TestCase):
         message.crud = event.READ
         self.sm.send_message(message)
 
-        self.sm.state = state.ReadStats(mock.Mock())
+        self.sm.state = state.ReadStats(self.sm._state_params)
         with mock.patch.object(self.sm.state, 'execute', self.ctx) as execute:
             execute.return_value = state.Exit(mock.Mock())
             self.sm.update(self.ctx)
@@ -675,6 +912,67 @@ class TestAutomaton(unittest.TestCase):
                 self.bandwidth_callback
             )
 
+    def test_update_records_trace(self):
+        message = event.Event('tenant-id', self.sm.router_id,
+                              event.UPDATE, {})
+        self.sm.send_message(message)
+        self.sm.state = state.Exit(self.sm._state_params)
+        trace = self.sm._trace
+        with mock.patch.object(state, 'TRACES') as traces:
+            self.sm.update(self.ctx)
+        traces.add.assert_called_once_with(trace)
+        self.assertEqual(
+            ['received', 'queued', 'update', 'Exit', 'done'],
+            [hop for hop, when in trace.hops],
+        )
+        self.assertEqual(message.trace.hops, trace.hops[:1])
+        self.assertIsNone(self.sm._trace)
+
+    def test_oldest_trace_kept(self):
+        first = event.Event('tenant-id', self.sm.router_id, event.UPDATE, {})
+        second = event.Event('tenant-id', self.sm.router_id, event.READ, {})
+        self.sm.send_message(first)
+        self.sm.send_message(second)
+        self.assertEqual(first.trace.hops[0], self.sm._trace.hops[0])
+        self.assertEqual(['received', 'queued'],
+                         [hop for hop, when in self.sm._trace.hops])
+
+    def test_wildcard_trace_copied(self):
+        sms = [
+            state.Automaton(
+                router_id='router-%d' % i,
+                tenant_id='tenant-id',
+                delete_callback=self.delete_callback,
+                bandwidth_callback=self.bandwidth_callback,
+                worker_context=self.ctx,
+                queue_warning_threshold=3,
+                reboot_error_threshold=5,
+            )
+            for i in range(40)
+        ]
+        message = event.Event('*', '*', event.POLL, {})
+        for sm in sms:
+            sm.send_message(message)
+        self.assertEqual(['received'],
+                         [hop for hop, when in message.trace.hops])
+        traces = [sm._trace for sm in sms]
+        self.assertEqual(40, len(set(map(id, traces))))
+        for trace in traces:
+            self.assertEqual(['received', 'queued'],
+                             [hop for hop, when in trace.hops])
+
+    def test_update_records_timings(self):
+        message = mock.Mock()
+        message.crud = event.UPDATE
+        self.sm.send_message(message)
+        self.sm.state = state.Exit(self.sm._state_params)
+        with mock.patch.object(state, 'TIMINGS') as timings:
+            self.sm.update(self.ctx)
+        timings.observe.assert_has_calls([
+            mock.call(('Exit', 'execute'), mock.ANY),
+            mock.call(('Exit', 'transition'), mock.ANY),
+        ])
+
     def test_has_error(self):
         with mock.patch.object(self.sm, 'vm') as vm:
             vm.state = vm_manager.ERROR
@@ -0,0 +1,134 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import unittest2 as unittest
+
+from akanda.rug import event
+from akanda.rug import stats
+
+
+class TestHistogram(unittest.TestCase):
+
+    def setUp(self):
+        super(TestHistogram, self).setUp()
+        self.h = stats.Histogram(buckets=(0.1, 1.0))
+
+    def test_empty(self):
+        self.assertEqual(0, self.h.count)
+        self.assertEqual(0.0, self.h.average)
+        self.assertEqual('', self.h.format_buckets())
+
+    def test_observe(self):
+        for seconds in (0.05, 0.1, 0.5, 2.0):
+            self.h.observe(seconds)
+        self.assertEqual([2, 1, 1], self.h.counts)
+        self.assertEqual(4, self.h.count)
+        self.assertAlmostEqual(2.65, self.h.total)
+        self.assertEqual(2.0, self.h.max)
+
+    def test_format_buckets(self):
+        self.h.observe(0.05)
+        self.h.observe(5)
+        self.assertEqual('<=0.1s:1 >1s:1', self.h.format_buckets())
+
+
+class TestTimings(unittest.TestCase):
+
+    def test_snapshot(self):
+        t = stats.Timings()
+        t.observe(('b', 'execute'), 1.0)
+        t.observe(('a', 'execute'), 2.0)
+        t.observe(('a', 'execute'), 3.0)
+        snap = t.snapshot()
+        self.assertEqual([('a', 'execute'), ('b', 'execute')],
+                         [key for key, h in snap])
+        self.assertEqual(2, snap[0][1].count)
+
+    def test_snapshot_is_copy(self):
+        t = stats.Timings()
+        t.observe('a', 1.0)
+        snap = t.snapshot()
+        t.observe('a', 1.0)
+        self.assertEqual(1, snap[0][1].count)
+
+
+class TestTimed(unittest.TestCase):
+
+    def test_records_calls(self):
+        t = stats.Timings()
+
+        @stats.timed('svc', t)
+        def call(a, b=1):
+            return a + b
+
+        self.assertEqual(3, call(1, b=2))
+        snap = t.snapshot()
+        self.assertEqual([('svc', 'call')], [key for key, h in snap])
+        self.assertEqual(1, snap[0][1].count)
+
+    def test_records_failures(self):
+        t = stats.Timings()
+
+        @stats.timed('svc', t)
+        def call():
+            raise RuntimeError('boom')
+
+        self.assertRaises(RuntimeError, call)
+        self.assertEqual(1, t.snapshot()[0][1].count)
+
+
+class TestPercentile(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(0.0, stats.percentile([], 50))
+
+    def test_nearest_rank(self):
+        values = range(1, 101)
+        self.assertEqual(50, stats.percentile(values, 50))
+        self.assertEqual(99, stats.percentile(values, 99))
+        self.assertEqual(1, stats.percentile(values, 0))
+        self.assertEqual(100, stats.percentile(values, 100))
+
+
+class TestTraceBuffer(unittest.TestCase):
+
+    def _trace(self, *intervals):
+        hops = [('received', 0.0)]
+        for hop, seconds in intervals:
+            hops.append((hop, hops[-1][1] + seconds))
+        return event.Trace(hops)
+
+    def test_bounded(self):
+        buf = stats.TraceBuffer(size=2)
+        for i in range(5):
+            buf.add(self._trace(('done', 1.0)))
+        self.assertEqual(2, len(buf))
+
+    def test_summary(self):
+        buf = stats.TraceBuffer()
+        buf.add(self._trace(('queued', 1.0), ('done', 2.0)))
+        buf.add(self._trace(('queued', 3.0), ('done', 4.0)))
+        summary = buf.summary()
+        self.assertEqual(['queued', 'done', 'total'],
+                         [hop for hop, count, pcts in summary])
+        hop, count, pcts = summary[2]
+        self.assertEqual(2, count)
+        self.assertEqual(3.0, pcts[50])
+        self.assertEqual(7.0, pcts[99])
+
+    def test_summary_empty(self):
+        self.assertEqual([], stats.TraceBuffer().summary())
@@ -21,7 +21,20 @@ import unittest2 as unittest
 from akanda.rug import event
 from akanda.rug import tenant
 from akanda.rug import state
-from akanda.rug import vm_manager
+from akanda.rug.api import quantum
+
+
+def _router(router_id, network_id):
+    return quantum.Router(
+        router_id, '1234', 'name', True, 'ACTIVE',
+        internal_ports=[
+            quantum.Port(
+                'port-' + router_id,
+                fixed_ips=[quantum.FixedIp('sub-' + network_id, '10.0.0.1')],
+                network_id=network_id,
+            ),
+        ],
+    )
 
 
 class TestTenantRouterManager(unittest.TestCase):
@@ -71,6 +84,44 @@ class TestTenantRouterManager(unittest.TestCase):
         self.assertEqual(sm.router_id, self.default_router.id)
         self.assertIn(self.default_router.id, self.trm.state_machines)
 
+    def test_attached_routers(self):
+        for rid in ('5678', '9ABC', 'DEF0'):
+            self.trm.state_machines[rid] = mock.Mock(router_id=rid,
+                                                     deleted=False)
+        for rid, net in (('5678', 'net1'), ('9ABC', 'net1'),
+                         ('DEF0', 'net2')):
+            self.trm.network_routers.update(_router(rid, net))
+        msg = event.Event(
+            tenant_id='1234',
+            router_id=None,
+            crud=event.UPDATE,
+            body={'event_type': 'port.create.end',
+                  'payload': {'port': {'id': 'port9',
+                                       'network_id': 'net1',
+                                       'fixed_ips': []}}},
+        )
+        sms = self.trm.get_state_machines(msg, self.ctx)
+        self.assertEqual(['5678', '9ABC'],
+                         sorted(sm.router_id for sm in sms))
+        self.assertEqual(
+            0, self.ctx.neutron.get_router_for_tenant.call_count,
+        )
+
+    def test_unattached_network_uses_default_router(self):
+        self.trm.state_machines['5678'] = mock.Mock(router_id='5678',
+                                                    deleted=False)
+        self.trm.network_routers.update(_router('5678', 'net1'))
+        msg = event.Event(
+            tenant_id='1234',
+            router_id=None,
+            crud=event.UPDATE,
+            body={'event_type': 'subnet.create.end',
+                  'payload': {'subnet': {'id': 'sub9',
+                                         'network_id': 'net9'}}},
+        )
+        sm = self.trm.get_state_machines(msg, self.ctx)[0]
+        self.assertEqual(self.default_router.id, sm.router_id)
+
     def test_all_routers(self):
         self.trm.state_machines.state_machines = {
             str(i): state.Automaton(str(i), '1234',
@@ -91,13 +142,9 @@ class TestTenantRouterManager(unittest.TestCase):
         for i in range(5):
             sm = state.Automaton(str(i), '1234',
                                  None, None, None, 5, 5)
-            # Replace the default mock with one that has 'state' set.
-            if i == 2:
-                status = vm_manager.ERROR
-            else:
-                status = vm_manager.UP
-            sm.vm = mock.Mock(state=status)
             self.trm.state_machines.state_machines[str(i)] = sm
+        # The state machine reports the router going into ERROR.
+        self.trm._router_error('2', True)
         msg = event.Event(
             tenant_id='1234',
             router_id='error',
@@ -109,6 +156,17 @@ class TestTenantRouterManager(unittest.TestCase):
         self.assertEqual('2', sms[0].router_id)
         self.assertIs(self.trm.state_machines.state_machines['2'], sms[0])
 
+    def test_errored_router_recovers(self):
+        self.trm._router_error('2', True)
+        self.trm._router_error('2', False)
+        self.assertEqual(set(), self.trm.errored_routers.routers('1234'))
+
+    def test_errored_router_deleted(self):
+        self.trm.state_machines['2'] = mock.Mock()
+        self.trm._router_error('2', True)
+        self.trm._delete_router('2')
+        self.assertEqual(0, len(self.trm.errored_routers))
+
     def test_existing_router(self):
         msg = event.Event(
             tenant_id='1234',
@@ -191,21 +249,153 @@ class TestTenantRouterManager(unittest.TestCase):
         self.assertNotIn('5678', self.trm.state_machines)
 
     def test_report_bandwidth(self):
-        notifications = []
-        self.notifier.side_effect = notifications.append
-        self.trm._report_bandwidth(
-            '5678',
-            [{'name': 'a',
-              'value': 1,
-              },
-             {'name': 'b',
-              'value': 2,
-              }],
+        self.trm._bandwidth_callback = mock.Mock()
+        self.trm._report_bandwidth('5678')
+        self.trm._bandwidth_callback.assert_called_once_with('5678')
+        self.assertFalse(self.notifier.called)
+
+    def test_shared_deleted_routers(self):
+        deleted = tenant.DeletedRouters()
+        trm = tenant.TenantRouterManager(
+            '1234',
+            notify_callback=self.notifier,
+            queue_warning_threshold=10,
+            reboot_error_threshold=5,
+            deleted_routers=deleted,
         )
-        n = notifications[0]
-        self.assertEqual('1234', n['tenant_id'])
-        self.assertIn('5678', n['router_id'])
-        self.assertIn('timestamp', n)
-        self.assertEqual('akanda.bandwidth.used', n['event_type'])
-        self.assertIn('a', n['payload'])
-        self.assertIn('b', n['payload'])
+        trm.state_machines['5678'] = mock.Mock()
+        trm._delete_router('5678')
+        self.assertIn('5678', deleted)
+
+
+class TestDeletedRouters(unittest.TestCase):
+
+    def setUp(self):
+        super(TestDeletedRouters, self).setUp()
+        self.time = mock.patch.object(tenant.time, 'time').start()
+        self.time.return_value = 1000.0
+        self.addCleanup(mock.patch.stopall)
+        self.deleted = tenant.DeletedRouters(ttl=60, memory_kb=1)
+
+    def test_capacity_from_memory(self):
+        self.assertEqual(1024 // tenant.DeletedRouters.ENTRY_SIZE,
+                         self.deleted.capacity)
+
+    def test_add(self):
+        self.deleted.add('5678')
+        self.assertIn('5678', self.deleted)
+        self.assertNotIn('9ABC', self.deleted)
+
+    def test_expired(self):
+        self.deleted.add('5678')
+        self.time.return_value = 1060.0
+        self.assertNotIn('5678', self.deleted)
+
+    def test_expired_purged(self):
+        self.deleted.add('5678')
+        self.time.return_value = 1061.0
+        self.deleted.add('9ABC')
+        self.assertEqual(1, len(self.deleted))
+
+    def test_oldest_dropped_over_capacity(self):
+        for i in range(self.deleted.capacity + 1):
+            self.deleted.add('router-%d' % i)
+        self.assertNotIn('router-0', self.deleted)
+        self.assertIn('router-1', self.deleted)
+        self.assertEqual(self.deleted.capacity, len(self.deleted))
+
+    def test_deleted_again(self):
+        self.deleted.add('5678')
+        self.time.return_value = 1030.0
+        self.deleted.add('5678')
+        self.time.return_value = 1061.0
+        self.deleted.add('9ABC')
+        self.assertIn('5678', self.deleted)
+
+
+class TestErroredRouters(unittest.TestCase):
+
+    def setUp(self):
+        super(TestErroredRouters, self).setUp()
+        self.errored = tenant.ErroredRouters()
+
+    def test_set(self):
+        self.errored.set('1234', '5678', True)
+        self.errored.set('1234', '9ABC', True)
+        self.errored.set('DEF0', '1111', True)
+        self.assertEqual(set(['5678', '9ABC']), self.errored.routers('1234'))
+        self.assertEqual(['1234', 'DEF0'], sorted(self.errored.tenants()))
+        self.assertEqual(3, len(self.errored))
+
+    def test_clear(self):
+        self.errored.set('1234', '5678', True)
+        self.errored.set('1234', '5678', False)
+        self.assertEqual(set(), self.errored.routers('1234'))
+        self.assertEqual([], self.errored.tenants())
+
+    def test_discard_unknown(self):
+        self.errored.discard('1234', '5678')
+        self.assertEqual(0, len(self.errored))
+
+
+class TestNetworkRouters(unittest.TestCase):
+
+    def setUp(self):
+        super(TestNetworkRouters, self).setUp()
+        self.index = tenant.NetworkRouters()
+
+    def test_update(self):
+        self.index.update(_router('R1', 'net1'))
+        self.index.update(_router('R2', 'net1'))
+        self.assertEqual(set(['R1', 'R2']), self.index.routers(['net1']))
+        self.assertEqual(set(['R1']), self.index.routers(['port-R1']))
+        self.assertEqual(set(['R2']), self.index.routers(['port-R2']))
+        self.assertEqual(set(['R1', 'R2']),
+                         self.index.routers(['sub-net1']))
+
+    def test_update_moves_router(self):
+        self.index.update(_router('R1', 'net1'))
+        self.index.update(_router('R1', 'net2'))
+        self.assertEqual(set(), self.index.routers(['net1', 'sub-net1']))
+        self.assertEqual(set(['R1']), self.index.routers(['net2']))
+
+    def test_discard(self):
+        self.index.update(_router('R1', 'net1'))
+        self.index.discard('R1')
+        self.assertEqual(set(), self.index.routers(['net1']))
+        self.assertEqual(0, len(self.index))
+
+    def test_no_ports(self):
+        self.index.update(_router('R1', 'net1'))
+        self.index.update(quantum.Router('R1', '1234', 'name', True,
+                                         'ACTIVE'))
+        self.assertEqual(0, len(self.index))
+
+
+class TestNetworkKeysForMessage(unittest.TestCase):
+
+    def _keys(self, payload):
+        msg = event.Event('1234', None, event.UPDATE, {'payload': payload})
+        return tenant._network_keys_for_message(msg)
+
+    def test_port(self):
+        self.assertEqual(
+            set(['P1', 'N1', 'S1']),
+            self._keys({'port': {'id': 'P1', 'network_id': 'N1',
+                                 'fixed_ips': [{'subnet_id': 'S1',
+                                                'ip_address': '10.0.0.1'}]}}),
+        )
+
+    def test_subnet(self):
+        self.assertEqual(
+            set(['S1', 'N1']),
+            self._keys({'subnet': {'id': 'S1', 'network_id': 'N1'}}),
+        )
+
+    def test_deleted(self):
+        self.assertEqual(set(['P1']), self._keys({'port_id': 'P1'}))
+        self.assertEqual(set(['S1']), self._keys({'subnet_id': 'S1'}))
+
+    def test_no_payload(self):
+        msg = event.Event('1234', None, event.UPDATE, {})
+        self.assertEqual(set(), tenant._network_keys_for_message(msg))
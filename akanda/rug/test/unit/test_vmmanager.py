@@ -909,6 +909,36 @@ class TestVmManager(unittest.TestCase):
                                                                   'ERROR')
         self.assertEqual(vm_manager.GONE, self.vm_mgr.state)
 
+    def test_router_callback(self):
+        callback = mock.Mock()
+        self.vm_mgr._router_callback = callback
+        rtr = mock.sentinel.router
+        self.ctx.neutron.get_router_detail.return_value = rtr
+        self.vm_mgr._ensure_cache(self.ctx)
+        callback.assert_called_once_with(rtr)
+
+    def test_router_callback_gone(self):
+        callback = mock.Mock()
+        self.vm_mgr._router_callback = callback
+        self.ctx.neutron.get_router_detail.side_effect = (
+            vm_manager.quantum.RouterGone
+        )
+        self.vm_mgr._ensure_cache(self.ctx)
+        self.assertEqual(0, callback.call_count)
+
+    def test_error_callback(self):
+        callback = mock.Mock()
+        self.vm_mgr._error_callback = callback
+        self.vm_mgr.state = vm_manager.BOOTING
+        self.assertEqual(0, callback.call_count)
+        self.vm_mgr.state = vm_manager.ERROR
+        callback.assert_called_once_with('the_id', True)
+        callback.reset_mock()
+        self.vm_mgr.state = vm_manager.ERROR
+        self.assertEqual(0, callback.call_count)
+        self.vm_mgr.state = vm_manager.DOWN
+        callback.assert_called_once_with('the_id', False)
+
     def test_set_error_when_error(self):
         self.vm_mgr.state = vm_manager.ERROR
         rtr = mock.sentinel.router
@@ -949,6 +979,23 @@ class TestVmManager(unittest.TestCase):
         self.vm_mgr.last_error = datetime.utcnow() - timedelta(minutes=5)
         self.assertFalse(self.vm_mgr.error_cooldown)
 
+    @mock.patch('akanda.rug.vm_manager.router_api')
+    @mock.patch('akanda.rug.vm_manager._get_management_address')
+    def test_read_stats(self, get_mgt_addr, router_api):
+        get_mgt_addr.return_value = 'fe80::beef'
+        router_api.read_labels.return_value = [{'name': 'a'}]
+        self.vm_mgr.router_obj = mock.Mock()
+        self.vm_mgr.state = vm_manager.CONFIGURED
+        self.assertEqual([{'name': 'a'}], self.vm_mgr.read_stats())
+        router_api.read_labels.assert_called_once_with('fe80::beef', 5000)
+
+    @mock.patch('akanda.rug.vm_manager.router_api')
+    def test_read_stats_not_configured(self, router_api):
+        self.vm_mgr.router_obj = mock.Mock()
+        self.vm_mgr.state = vm_manager.UP
+        self.assertIsNone(self.vm_mgr.read_stats())
+        self.assertFalse(router_api.read_labels.called)
+
 
 class TestBootAttemptCounter(unittest.TestCase):
 
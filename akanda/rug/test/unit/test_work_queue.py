@@ -0,0 +1,102 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import Queue
+
+import mock
+import unittest2 as unittest
+
+from akanda.rug import work_queue
+
+
+def _item(tenant_id, name):
+    return mock.Mock(tenant_id=tenant_id, router_id=name)
+
+
+class TestTenantFairQueue(unittest.TestCase):
+
+    def setUp(self):
+        super(TestTenantFairQueue, self).setUp()
+        self.q = work_queue.TenantFairQueue()
+
+    def _drain(self):
+        results = []
+        while self.q.qsize():
+            results.append(self.q.get(timeout=0).router_id)
+        return results
+
+    def test_fifo_single_tenant(self):
+        for name in ['a', 'b', 'c']:
+            self.q.put(_item('t1', name))
+        self.assertEqual(self._drain(), ['a', 'b', 'c'])
+
+    def test_round_robin(self):
+        for i in range(4):
+            self.q.put(_item('busy', 'busy%d' % i))
+        self.q.put(_item('quiet', 'quiet0'))
+        self.q.put(_item('other', 'other0'))
+        self.assertEqual(
+            self._drain(),
+            ['busy0', 'quiet0', 'other0', 'busy1', 'busy2', 'busy3'],
+        )
+
+    def test_quantum(self):
+        self.q = work_queue.TenantFairQueue(quantum=2)
+        for i in range(4):
+            self.q.put(_item('busy', 'busy%d' % i))
+        self.q.put(_item('quiet', 'quiet0'))
+        self.assertEqual(
+            self._drain(),
+            ['busy0', 'busy1', 'quiet0', 'busy2', 'busy3'],
+        )
+
+    def test_bad_quantum(self):
+        self.assertRaises(ValueError, work_queue.TenantFairQueue, 0)
+
+    def test_returning_tenant_goes_to_the_end(self):
+        self.q.put(_item('t1', 'a'))
+        self.q.put(_item('t2', 'b'))
+        self.assertEqual(self.q.get(timeout=0).router_id, 'a')
+        self.q.put(_item('t1', 'c'))
+        self.assertEqual(self._drain(), ['b', 'c'])
+
+    def test_none_item(self):
+        self.q.put(None)
+        self.assertIsNone(self.q.get(timeout=0))
+        self.assertEqual(dict(self.q.wait_stats), {})
+
+    def test_empty(self):
+        self.assertRaises(Queue.Empty, self.q.get, timeout=0.01)
+
+    def test_qsize(self):
+        self.q.put(_item('t1', 'a'))
+        self.q.put(_item('t2', 'b'))
+        self.assertEqual(self.q.qsize(), 2)
+        self.q.get()
+        self.assertEqual(self.q.qsize(), 1)
+
+    def test_wait_stats(self):
+        with mock.patch('time.time', return_value=10.0):
+            self.q.put(_item('t1', 'a'))
+            self.q.put(_item('t1', 'b'))
+        with mock.patch('time.time', return_value=11.0):
+            self.q.get()
+        with mock.patch('time.time', return_value=13.0):
+            self.q.get()
+        stats = self.q.wait_stats['t1']
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.max, 3.0)
+        self.assertEqual(stats.average, 2.0)
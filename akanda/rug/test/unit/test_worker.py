@@ -72,6 +72,16 @@ class TestCreatingRouter(unittest.TestCase):
         sm = trm.get_state_machines(self.msg, worker.WorkerContext())[0]
         self.assertEqual(1, len(sm._queue))
 
+    def test_bandwidth_targets(self):
+        trm = self.w.tenant_managers[self.tenant_id]
+        sm = trm.get_state_machines(self.msg, worker.WorkerContext())[0]
+        self.assertEqual([(self.tenant_id, self.router_id, sm.vm)],
+                         self.w._bandwidth_targets())
+
+    def test_bandwidth_requested(self):
+        trm = self.w.tenant_managers[self.tenant_id]
+        self.assertEqual(self.w._bandwidth.request, trm._bandwidth_callback)
+
 
 class TestWildcardMessages(unittest.TestCase):
 
@@ -119,10 +129,16 @@ class TestWildcardMessages(unittest.TestCase):
 
     def test_wildcard_to_error(self):
         trms = self.w._get_trms('error')
-        ids = sorted(trm.tenant_id for trm in trms)
-        self.assertEqual(['98dd9c41-d3ac-4fd6-8927-567afa0b8fc3',
-                          'ac194fc5-f317-412e-8611-fb290629f624'],
-                         ids)
+        self.assertEqual([], trms)
+
+    def test_wildcard_to_error_only_errored_tenants(self):
+        tenant_id = 'ac194fc5-f317-412e-8611-fb290629f624'
+        sm = self.w.tenant_managers[tenant_id].state_machines['EFGH']
+        sm.vm.state = vm_manager.ERROR
+        trms = self.w._get_trms('error')
+        self.assertEqual([tenant_id], [trm.tenant_id for trm in trms])
+        sm.vm.state = vm_manager.DOWN
+        self.assertEqual([], self.w._get_trms('error'))
 
 
 class TestShutdown(unittest.TestCase):
@@ -204,6 +220,74 @@ class TestUpdateStateMachine(unittest.TestCase):
             used_context = w._thread_target()
             meth.assert_called_once_with(used_context)
 
+    def test_deleted_router_forgotten(self):
+        w = worker.Worker(0, mock.Mock())
+        tenant_id = '98dd9c41-d3ac-4fd6-8927-567afa0b8fc3'
+        router_id = 'ac194fc5-f317-412e-8611-fb290629f624'
+        msg = event.Event(
+            tenant_id=tenant_id,
+            router_id=router_id,
+            crud=event.DELETE,
+            body={},
+        )
+        trm = w._get_trms(tenant_id)[0]
+        sm = trm.get_state_machines(msg, self.worker_context)[0]
+
+        def delete(context):
+            sm._do_delete()
+
+        with mock.patch.object(sm, 'update') as meth:
+            meth.side_effect = delete
+            w.handle_message(tenant_id, msg)
+            self.assertIn(router_id, w._router_locks)
+            w.work_queue.put(None)
+            w._thread_target()
+        self.assertNotIn(router_id, w._router_locks)
+        self.assertNotIn(tenant_id, w.tenant_managers)
+
+        # A late event for the router is still dropped after the
+        # tenant manager is gone.
+        msg = event.Event(tenant_id, router_id, event.UPDATE, {})
+        trm = w._get_trms(tenant_id)[0]
+        self.assertEqual([], trm.get_state_machines(msg, self.worker_context))
+
+    def test_tenant_manager_kept_for_other_routers(self):
+        w = worker.Worker(0, mock.Mock())
+        tenant_id = '98dd9c41-d3ac-4fd6-8927-567afa0b8fc3'
+        router_ids = ['ac194fc5-f317-412e-8611-fb290629f624',
+                      '9ec2bb3f-f9ef-44e5-8a4e-4c8e6b5d6a1b']
+        trm = w._get_trms(tenant_id)[0]
+        sms = [
+            trm.get_state_machines(
+                event.Event(tenant_id, rid, event.CREATE, {}),
+                self.worker_context,
+            )[0]
+            for rid in router_ids
+        ]
+        sms[0]._do_delete()
+        w._forget_router(sms[0])
+        self.assertIs(trm, w.tenant_managers[tenant_id])
+
+    def test_tenant_without_router_forgotten(self):
+        w = worker.Worker(0, mock.Mock())
+        w._context.neutron.get_router_for_tenant.return_value = None
+        tenant_id = '98dd9c41-d3ac-4fd6-8927-567afa0b8fc3'
+        msg = event.Event(tenant_id, None, event.UPDATE,
+                          {'port': {'network_id': 'net-id'}})
+        w.handle_message(tenant_id, msg)
+        self.assertNotIn(tenant_id, w.tenant_managers)
+        self.assertEqual(0, w.work_queue.qsize())
+
+    def test_late_event_for_deleted_router(self):
+        w = worker.Worker(0, mock.Mock())
+        tenant_id = '98dd9c41-d3ac-4fd6-8927-567afa0b8fc3'
+        router_id = 'ac194fc5-f317-412e-8611-fb290629f624'
+        w._deleted_routers.add(router_id)
+        w.handle_message(
+            tenant_id, event.Event(tenant_id, router_id, event.UPDATE, {}),
+        )
+        self.assertNotIn(tenant_id, w.tenant_managers)
+
 
 class TestReportStatus(unittest.TestCase):
 
@@ -234,6 +318,76 @@ class TestReportStatus(unittest.TestCase):
             self.assertTrue(conf.log_opt_values.called)
 
 
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+
+        self.conf = mock.patch.object(vm_manager.cfg, 'CONF').start()
+        self.conf.boot_timeout = 1
+        self.conf.akanda_mgt_service_port = 5000
+        self.conf.max_retries = 3
+        self.conf.management_prefix = 'fdca:3ba5:a17a:acda::/64'
+
+        mock.patch('akanda.rug.worker.nova').start()
+        mock.patch('akanda.rug.worker.quantum').start()
+        self.addCleanup(mock.patch.stopall)
+
+        self.w = worker.Worker(0, mock.Mock())
+        self.tenant_id = '98dd9c41-d3ac-4fd6-8927-567afa0b8fc3'
+        self.router_id = 'ac194fc5-f317-412e-8611-fb290629f624'
+
+    def test_routers_by_state(self):
+        msg = event.Event(self.tenant_id, self.router_id, event.CREATE, {})
+        self.w.handle_message(self.tenant_id, msg)
+        metrics = self.w.handle_query('metrics')
+        self.assertEqual({vm_manager.DOWN: 1}, metrics['routers_by_state'])
+        self.assertEqual(1, metrics['queue_depth'])
+        self.assertEqual(1, metrics['tenants'])
+
+    def test_thread_busy_time(self):
+        msg = event.Event(self.tenant_id, self.router_id, event.CREATE, {})
+        trm = self.w._get_trms(self.tenant_id)[0]
+        sm = trm.get_state_machines(msg, worker.WorkerContext())[0]
+        with mock.patch.object(sm, 'update'):
+            self.w.handle_message(self.tenant_id, msg)
+            self.w.work_queue.put(None)
+            with mock.patch('akanda.rug.worker.time') as now:
+                now.time.side_effect = [self.w._started + 1,
+                                        self.w._started + 3]
+                self.w._thread_target()
+        name = threading.current_thread().name
+        self.assertEqual(2, self.w._thread_busy[name])
+        self.assertNotIn(name, self.w._thread_busy_since)
+
+    def test_thread_busy_ratio(self):
+        self.w.threads = [mock.Mock()]
+        self.w.threads[0].name = 't00'
+        self.w._thread_busy['t00'] = 1.0
+        self.w._thread_busy_since['t00'] = self.w._started + 2
+        with mock.patch('akanda.rug.worker.time') as now:
+            now.time.return_value = self.w._started + 4
+            threads = self.w.get_metrics()['threads']
+        self.assertEqual(3.0, threads['t00']['busy_seconds'])
+        self.assertEqual(0.75, threads['t00']['busy_ratio'])
+
+    def test_status(self):
+        msg = event.Event(self.tenant_id, self.router_id, event.CREATE, {})
+        self.w.handle_message(self.tenant_id, msg)
+        self.w._debug_tenants.add('t1')
+        status = self.w.handle_query('status')
+        self.assertEqual(1, status['queue_depth'])
+        self.assertEqual(['t1'], status['debug_tenants'])
+        self.assertEqual([], status['debug_routers'])
+        self.assertEqual([], status['ignored_routers'])
+        self.assertEqual([self.router_id],
+                         [r['router_id'] for r in status['routers']])
+        self.assertEqual([event.CREATE], status['routers'][0]['pending'])
+
+    def test_unknown_query(self):
+        self.assertRaises(ValueError, self.w.handle_query, 'nonsense')
+
+
 class TestDebugRouters(unittest.TestCase):
 
     def setUp(self):
@@ -286,6 +440,7 @@ class TestDebugRouters(unittest.TestCase):
                                      'router_id': 'this-router-id'}}),
         )
         self.assertEqual(set(), self.w._debug_routers)
+        self.assertNotIn('this-router-id', self.w._router_locks)
 
     def testManageUnlocked(self):
         self.w._debug_routers = set(['this-router-id'])
@@ -510,3 +665,17 @@ class TestNormalizeUUID(unittest.TestCase):
                 'ac194fc5f317412e8611fb290629f624'
             )
         )
+
+
+class TestWorkerContext(unittest.TestCase):
+
+    @mock.patch('akanda.rug.worker.nova')
+    @mock.patch('akanda.rug.worker.quantum')
+    def test_clients_created_when_used(self, quantum, nova):
+        ctx = worker.WorkerContext()
+        self.assertFalse(quantum.Quantum.called)
+        self.assertFalse(nova.Nova.called)
+        self.assertIs(ctx.neutron, ctx.neutron)
+        self.assertIs(ctx.nova_client, ctx.nova_client)
+        self.assertEqual(1, quantum.Quantum.call_count)
+        self.assertEqual(1, nova.Nova.call_count)
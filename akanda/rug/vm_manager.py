@@ -79,11 +79,14 @@ class BootAttemptCounter(object):
 
 class VmManager(object):
 
-    def __init__(self, router_id, tenant_id, log, worker_context):
+    def __init__(self, router_id, tenant_id, log, worker_context,
+                 error_callback=None, router_callback=None):
         self.router_id = router_id
         self.tenant_id = tenant_id
         self.log = log
-        self.state = DOWN
+        self._error_callback = error_callback
+        self._router_callback = router_callback
+        self._state = DOWN
         self.router_obj = None
         self.last_boot = None
         self.last_error = None
@@ -92,6 +95,18 @@ class VmManager(object):
         self._last_synced_status = None
         self.update_state(worker_context, silent=True)
 
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        was_error = self._state == ERROR
+        self._state = value
+        is_error = value == ERROR
+        if was_error != is_error and self._error_callback is not None:
+            self._error_callback(self.router_id, is_error)
+
     @property
     def attempts(self):
         return self._boot_counter.count
@@ -215,7 +230,7 @@ class VmManager(object):
                 self._check_boot_timeout()
             return self.state == CONFIGURED
 
-        self.log.debug('Router is %s' % self.state.upper())
+        self.log.debug('Router is %s', self.state.upper())
         return False
 
     @synchronize_router_status
@@ -297,6 +312,20 @@ class VmManager(object):
             'Router failed to stop within %d secs',
             cfg.CONF.boot_timeout)
 
+    def read_stats(self):
+        """Return the traffic of the router since it was last read.
+
+        Reading the counters resets them. Returns None when the router
+        is not configured. Called from outside of the state machine, so
+        it only uses what the state machine already knows about the
+        router.
+        """
+        router_obj = self.router_obj
+        if self.state != CONFIGURED or router_obj is None:
+            return None
+        addr = _get_management_address(router_obj)
+        return router_api.read_labels(addr, cfg.CONF.akanda_mgt_service_port)
+
     def configure(self, worker_context, failure_state=RESTART, attempts=None):
         self.log.debug('Begin router config')
         self.state = UP
@@ -388,7 +417,7 @@ class VmManager(object):
                 port = expected_ports.get(mac)
                 if port:
                     self.log.debug(
-                        'New port %s, %s found, plugging...' % (port.id, mac)
+                        'New port %s, %s found, plugging...', port.id, mac
                     )
                     try:
                         instance.interface_attach(port.id, None, None)
@@ -443,7 +472,7 @@ class VmManager(object):
                 # ahead and clean up any orphaned neutron ports that may have
                 # been detached
                 for port in ports_to_delete:
-                    self.log.debug('Deleting orphaned port %s' % port.id)
+                    self.log.debug('Deleting orphaned port %s', port.id)
                     worker_context.neutron.api_client.update_port(
                         port.id, {'port': {'device_owner': ''}}
                     )
@@ -465,6 +494,9 @@ class VmManager(object):
             # and return without doing any more work.
             self.state = GONE
             self.router_obj = None
+        else:
+            if self._router_callback is not None:
+                self._router_callback(self.router_obj)
 
     def _check_boot_timeout(self):
         if self.last_boot:
@@ -0,0 +1,133 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Work queue shared fairly between the tenants of a worker.
+"""
+
+import collections
+import Queue
+import threading
+import time
+
+
+class WaitStats(object):
+    """How long the tasks for a tenant waited in the queue.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def average(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+
+class TenantFairQueue(object):
+    """A work queue that takes turns between tenants.
+
+    Items are kept in a separate FIFO for each tenant, and get()
+    serves the tenants using deficit round-robin: on its turn a tenant
+    may have up to quantum items taken from its FIFO before the next
+    tenant gets a turn. A tenant with hundreds of busy routers cannot
+    push the work for the other tenants to the back of the line.
+
+    The interface is the subset of Queue.Queue used by the Worker.
+    """
+
+    def __init__(self, quantum=1):
+        if quantum < 1:
+            raise ValueError('quantum must be at least 1')
+        self._quantum = quantum
+        self._cond = threading.Condition(threading.Lock())
+        # FIFOs of (enqueue time, item), keyed by tenant id
+        self._queues = {}
+        # Tenants with something in their FIFO, in the order they get
+        # their turn.
+        self._active = collections.deque()
+        self._deficit = {}
+        self._size = 0
+        self.wait_stats = collections.defaultdict(WaitStats)
+
+    def put(self, item):
+        """Add an item to the end of the FIFO for its tenant.
+
+        Items without a tenant_id (such as the None used to stop the
+        threads) share a FIFO of their own.
+        """
+        tenant_id = getattr(item, 'tenant_id', None)
+        with self._cond:
+            q = self._queues.get(tenant_id)
+            if q is None:
+                q = self._queues[tenant_id] = collections.deque()
+                self._deficit[tenant_id] = 0
+                self._active.append(tenant_id)
+            q.append((time.time(), item))
+            self._size += 1
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Remove and return the next item.
+
+        Raises Queue.Empty if there is nothing to return before the
+        timeout expires.
+        """
+        with self._cond:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._size:
+                if timeout is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Queue.Empty()
+                self._cond.wait(remaining)
+            return self._pop()
+
+    def _pop(self):
+        tenant_id = self._active[0]
+        if self._deficit[tenant_id] < 1:
+            # Starting a new turn for this tenant.
+            self._deficit[tenant_id] += self._quantum
+        q = self._queues[tenant_id]
+        enqueued, item = q.popleft()
+        self._deficit[tenant_id] -= 1
+        self._size -= 1
+        if not q:
+            # A tenant does not keep its credit while it has nothing
+            # to do.
+            del self._queues[tenant_id]
+            del self._deficit[tenant_id]
+            self._active.popleft()
+        elif self._deficit[tenant_id] < 1:
+            self._active.rotate(-1)
+        if tenant_id is not None:
+            self.wait_stats[tenant_id].add(time.time() - enqueued)
+        return item
+
+    def qsize(self):
+        with self._cond:
+            return self._size
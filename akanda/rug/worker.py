@@ -20,16 +20,21 @@
 
 import collections
 import logging
-import os
 import Queue
 import threading
+import time
 import uuid
 
 from oslo.config import cfg
 
+from akanda.rug import bandwidth
 from akanda.rug import commands
+from akanda.rug import dirwatch
 from akanda.rug import event
+from akanda.rug import state
+from akanda.rug import stats
 from akanda.rug import tenant
+from akanda.rug import work_queue
 from akanda.rug.api import nova
 from akanda.rug.api import quantum
 
@@ -42,11 +47,34 @@ def _normalize_uuid(value):
 
 class WorkerContext(object):
     """Holds resources owned by the worker and used by the Automaton.
+
+    The clients are created the first time they are used, so starting
+    the worker threads does not wait for them.
     """
 
     def __init__(self):
-        self.neutron = quantum.Quantum(cfg.CONF)
-        self.nova_client = nova.Nova(cfg.CONF)
+        self._neutron = None
+        self._nova_client = None
+
+    @property
+    def neutron(self):
+        if self._neutron is None:
+            self._neutron = quantum.Quantum(cfg.CONF)
+        return self._neutron
+
+    @neutron.setter
+    def neutron(self, value):
+        self._neutron = value
+
+    @property
+    def nova_client(self):
+        if self._nova_client is None:
+            self._nova_client = nova.Nova(cfg.CONF)
+        return self._nova_client
+
+    @nova_client.setter
+    def nova_client(self, value):
+        self._nova_client = value
 
 
 class Worker(object):
@@ -59,17 +87,40 @@ class Worker(object):
 
     QUEUE_WARNING_THRESHOLD_DEFAULT = 100
     REBOOT_ERROR_THRESHOLD_DEFAULT = 5
+    DELETED_ROUTER_TTL_DEFAULT = 3600
+    DELETED_ROUTER_MEMORY_DEFAULT = 1024
 
     def __init__(self,
                  num_threads,
                  notifier,
                  ignore_directory=None,
                  queue_warning_threshold=QUEUE_WARNING_THRESHOLD_DEFAULT,
-                 reboot_error_threshold=REBOOT_ERROR_THRESHOLD_DEFAULT):
-        self._ignore_directory = ignore_directory
+                 reboot_error_threshold=REBOOT_ERROR_THRESHOLD_DEFAULT,
+                 deleted_router_ttl=DELETED_ROUTER_TTL_DEFAULT,
+                 deleted_router_memory=DELETED_ROUTER_MEMORY_DEFAULT,
+                 bandwidth_interval=0,
+                 bandwidth_poll_concurrency=1):
+        # Routers named by the files in the ignore directory, kept up
+        # to date as the directory changes.
+        self._ignored_routers = dirwatch.DirectoryWatcher(ignore_directory)
         self._queue_warning_threshold = queue_warning_threshold
         self._reboot_error_threshold = reboot_error_threshold
-        self.work_queue = Queue.Queue()
+        # Routers deleted recently by any of our tenants, so late
+        # events for them can be dropped. Shared by the tenant
+        # managers so it outlives the managers of empty tenants.
+        self._deleted_routers = tenant.DeletedRouters(
+            ttl=deleted_router_ttl,
+            memory_kb=deleted_router_memory,
+        )
+        # Routers in the ERROR state, so commands for them do not have
+        # to visit every tenant and router.
+        self._errored_routers = tenant.ErroredRouters()
+        # Routers attached to each network, subnet and port, so
+        # events about those reach the right routers.
+        self._network_routers = tenant.NetworkRouters()
+        # Tenants take turns getting their routers updated, so a busy
+        # tenant does not starve the others.
+        self.work_queue = work_queue.TenantFairQueue()
         self.lock = threading.Lock()
         self._keep_going = True
         self.tenant_managers = {}
@@ -80,6 +131,15 @@ class Worker(object):
         # The notifier needs to be started here to ensure that it
         # happens inside the worker process and not the parent.
         self.notifier.start()
+        # Read the traffic of our routers in a thread of its own, so
+        # it does not hold up the worker threads.
+        self._bandwidth = bandwidth.BandwidthCollector(
+            self._bandwidth_targets,
+            self.notifier.publish,
+            interval=bandwidth_interval,
+            concurrency=bandwidth_poll_concurrency,
+        )
+        self._bandwidth.start()
         # Track the routers and tenants we are told to ignore
         self._debug_routers = set()
         self._debug_tenants = set()
@@ -89,6 +149,11 @@ class Worker(object):
         # Messages about what each thread is doing, keyed by thread id
         # and reported by the debug command.
         self._thread_status = {}
+        # Seconds each thread has spent on finished tasks, and when it
+        # started the task it is working on now, keyed by thread id.
+        self._thread_busy = collections.defaultdict(float)
+        self._thread_busy_since = {}
+        self._started = time.time()
         # Start the threads last, so they can use the instance
         # variables created above.
         self.threads = [
@@ -134,6 +199,7 @@ class Worker(object):
             # don't have that data in the sm, yet.
             LOG.debug('performing work on %s for tenant %s',
                       sm.router_id, sm.tenant_id)
+            self._thread_busy_since[my_id] = time.time()
             try:
                 self._thread_status[my_id] = 'updating %s' % sm.router_id
                 sm.update(context)
@@ -144,7 +210,6 @@ class Worker(object):
                 self._thread_status[my_id] = (
                     'finalizing task for %s' % sm.router_id
                 )
-                self.work_queue.task_done()
                 with self.lock:
                     # Release the lock that prevents us from adding
                     # the state machine back into the queue. If we
@@ -164,6 +229,10 @@ class Worker(object):
                         self._add_router_to_work_queue(sm)
                     else:
                         LOG.debug('%s has no more work', sm.router_id)
+                        if sm.deleted:
+                            self._forget_router(sm)
+                started = self._thread_busy_since.pop(my_id)
+                self._thread_busy[my_id] += time.time() - started
         # Return the context object so tests can look at it
         self._thread_status[my_id] = 'exiting'
         return context
@@ -172,18 +241,20 @@ class Worker(object):
         """Stop the worker.
         """
         self.report_status(show_config=False)
+        self._bandwidth.stop()
         # Tell the notifier to stop
         if self.notifier:
             self.notifier.stop()
+        self._ignored_routers.close()
         # Stop the worker threads
         self._keep_going = False
         # Drain the task queue by discarding it
         # FIXME(dhellmann): This could prevent us from deleting
         # routers that need to be deleted.
-        self.work_queue = Queue.Queue()
+        self.work_queue = work_queue.TenantFairQueue()
         for t in self.threads:
             LOG.debug('sending stop message to %s', t.getName())
-            self.work_queue.put((None, None))
+            self.work_queue.put(None)
         # Wait for our threads to finish
         for t in self.threads:
             LOG.debug('waiting for %s to finish', t.getName())
@@ -200,6 +271,12 @@ class Worker(object):
                 trm.shutdown()
 
     def _get_trms(self, target):
+        if target.lower() == 'error':
+            return [
+                self.tenant_managers[tenant_id]
+                for tenant_id in self._errored_routers.tenants()
+                if tenant_id in self.tenant_managers
+            ]
         if target.lower() in commands.WILDCARDS:
             return list(self.tenant_managers.values())
         # Normalize the tenant id to a dash-separated UUID format.
@@ -211,6 +288,10 @@ class Worker(object):
                 notify_callback=self.notifier.publish,
                 queue_warning_threshold=self._queue_warning_threshold,
                 reboot_error_threshold=self._reboot_error_threshold,
+                deleted_routers=self._deleted_routers,
+                errored_routers=self._errored_routers,
+                network_routers=self._network_routers,
+                bandwidth_callback=self._bandwidth.request,
             )
         return [self.tenant_managers[tenant_id]]
 
@@ -258,14 +339,16 @@ class Worker(object):
                 LOG.info('Resuming management of router %s', router_id)
             except KeyError:
                 pass
-            try:
-                self._router_locks[router_id].release()
-                LOG.info('Unlocked router %s', router_id)
-            except KeyError:
-                pass
-            except threading.ThreadError:
-                # Already unlocked, that's OK.
-                pass
+            # Look the lock up without creating one, so unknown router
+            # ids do not leave entries behind.
+            lock = self._router_locks.get(router_id)
+            if lock is not None:
+                try:
+                    lock.release()
+                    LOG.info('Unlocked router %s', router_id)
+                except threading.ThreadError:
+                    # Already unlocked, that's OK.
+                    pass
 
         elif instructions['command'] in self._EVENT_COMMANDS:
             new_msg = event.Event(
@@ -311,13 +394,7 @@ class Worker(object):
             LOG.warn('unrecognized command: %s', instructions)
 
     def _get_routers_to_ignore(self):
-        ignores = set()
-        try:
-            if self._ignore_directory:
-                ignores = set(os.listdir(self._ignore_directory))
-        except OSError:
-            pass
-        return ignores
+        return self._ignored_routers.names()
 
     def _deliver_message(self, target, message):
         if target in self._debug_tenants:
@@ -327,14 +404,12 @@ class Worker(object):
             )
             return
         LOG.debug('preparing to deliver %r to %r', message, target)
-        routers_to_ignore = self._debug_routers.union(
-            self._get_routers_to_ignore()
-        )
         trms = self._get_trms(target)
         for trm in trms:
             sms = trm.get_state_machines(message, self._context)
             for sm in sms:
-                if sm.router_id in routers_to_ignore:
+                if (sm.router_id in self._debug_routers or
+                        sm.router_id in self._ignored_routers):
                     LOG.info(
                         'Ignoring message intended for %s: %s',
                         sm.router_id, message,
@@ -350,6 +425,10 @@ class Worker(object):
                 # the router is done.
                 if sm.send_message(message):
                     self._add_router_to_work_queue(sm)
+            # Events for tenants without routers, or for routers
+            # already deleted, leave the manager without any state
+            # machines.
+            self._forget_tenant_if_empty(trm.tenant_id)
 
     def _add_router_to_work_queue(self, sm):
         """Queue up the state machine by router id.
@@ -366,6 +445,112 @@ class Worker(object):
     def _release_router_lock(self, sm):
         self._router_locks[sm.router_id].release()
 
+    def _forget_router(self, sm):
+        """Drop what the worker holds for a router that was deleted.
+
+        The work queue lock should be held before calling this method.
+        """
+        self._router_locks.pop(sm.router_id, None)
+        self._forget_tenant_if_empty(sm.tenant_id)
+
+    def _forget_tenant_if_empty(self, tenant_id):
+        """Drop the manager of a tenant that has no state machines left.
+
+        The work queue lock should be held before calling this method.
+        """
+        trm = self.tenant_managers.get(tenant_id)
+        if trm is not None and not len(trm.state_machines):
+            LOG.debug('removing tenant manager for %s', tenant_id)
+            del self.tenant_managers[tenant_id]
+            self.work_queue.wait_stats.pop(tenant_id, None)
+
+    def handle_query(self, name):
+        """Answer a question asked by the parent process.
+
+        This is called from a thread of its own, so it must not wait
+        for the work being done by the other threads.
+        """
+        if name == 'metrics':
+            return self.get_metrics()
+        if name == 'status':
+            return self.get_status()
+        raise ValueError('unknown query %r' % name)
+
+    def _bandwidth_targets(self):
+        "Return the routers whose traffic is reported."
+        with self.lock:
+            return [
+                (trm.tenant_id, sm.router_id, sm.vm)
+                for trm in self.tenant_managers.values()
+                for sm in trm.state_machines.values()
+            ]
+
+    def get_metrics(self):
+        """Return the numbers the parent publishes about this worker.
+        """
+        now = time.time()
+        uptime = max(now - self._started, 0.001)
+        threads = {}
+        for thread in self.threads:
+            busy = self._thread_busy.get(thread.name, 0.0)
+            since = self._thread_busy_since.get(thread.name)
+            if since is not None:
+                # Count the task under way, so a thread stuck on a
+                # slow router does not look idle.
+                busy += now - since
+            threads[thread.name] = {
+                'alive': thread.isAlive(),
+                'status': self._thread_status.get(thread.name, 'UNKNOWN'),
+                'busy_seconds': busy,
+                'busy_ratio': min(busy / uptime, 1.0),
+            }
+        states = collections.Counter()
+        with self.lock:
+            tenants = len(self.tenant_managers)
+            for trm in self.tenant_managers.values():
+                for sm in trm.state_machines.values():
+                    states[sm.vm.state] += 1
+        return {
+            'uptime': uptime,
+            'queue_depth': self.work_queue.qsize(),
+            'tenants': tenants,
+            'routers_by_state': dict(states),
+            'threads': threads,
+            'api_calls': stats.API_CALLS.snapshot(),
+            'publisher': self.notifier.get_stats(),
+        }
+
+    def get_status(self):
+        """Return a description of what the worker is doing.
+
+        This holds the same information as the log messages written by
+        report_status(), in a form that can be sent to the parent.
+        """
+        threads = dict(
+            (thread.name, {
+                'alive': thread.isAlive(),
+                'status': self._thread_status.get(thread.name, 'UNKNOWN'),
+            })
+            for thread in self.threads
+        )
+        with self.lock:
+            tenants = len(self.tenant_managers)
+            routers = [
+                sm.get_status()
+                for trm in self.tenant_managers.values()
+                for sm in trm.state_machines.values()
+            ]
+        routers.sort(key=lambda r: r['router_id'])
+        return {
+            'queue_depth': self.work_queue.qsize(),
+            'tenants': tenants,
+            'threads': threads,
+            'debug_routers': sorted(self._debug_routers),
+            'debug_tenants': sorted(self._debug_tenants),
+            'ignored_routers': sorted(self._get_routers_to_ignore()),
+            'routers': routers,
+        }
+
     def report_status(self, show_config=True):
         if show_config:
             cfg.CONF.log_opt_values(LOG, logging.INFO)
@@ -377,6 +562,43 @@ class Worker(object):
             'Number of tenant router managers managed: %d',
             len(self.tenant_managers)
         )
+        LOG.info(
+            'Number of deleted routers remembered: %d',
+            len(self._deleted_routers)
+        )
+        LOG.info(
+            'Number of routers in ERROR state: %d',
+            len(self._errored_routers)
+        )
+        for tenant_id in sorted(self._errored_routers.tenants()):
+            for rid in sorted(self._errored_routers.routers(tenant_id)):
+                LOG.info('Router %s for tenant %s is in ERROR state',
+                         rid, tenant_id)
+        for tenant_id, waits in sorted(self.work_queue.wait_stats.items()):
+            LOG.info(
+                'Tenant %s waited %.3f seconds on average (max %.3f) '
+                'for %d tasks',
+                tenant_id, waits.average, waits.max, waits.count,
+            )
+        timings = state.TIMINGS.snapshot()
+        total = sum(h.total for key, h in timings) or 1.0
+        for (name, method), h in timings:
+            LOG.info(
+                '%s.%s: %d calls, %.3f seconds (%.1f%% of state machine '
+                'time), average %.3f, max %.3f, %s',
+                name, method, h.count, h.total, 100.0 * h.total / total,
+                h.average, h.max, h.format_buckets(),
+            )
+        for hop, count, pcts in state.TRACES.summary():
+            LOG.info(
+                'Latency to %s: %d events, p50 %.3f, p90 %.3f, p99 %.3f',
+                hop, count, pcts[50], pcts[90], pcts[99],
+            )
+        for reads in (quantum.SHARED_READS, nova.SHARED_READS):
+            LOG.info(
+                'Merged %s of %s %s reads',
+                reads.merged, reads.requests, reads.name,
+            )
         for thread in self.threads:
             LOG.info(
                 'Thread %s is %s. Last seen: %s',
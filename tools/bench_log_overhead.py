@@ -0,0 +1,157 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Benchmark the cost of logging for each state machine step.
+
+Several threads poll their own routers through the real state
+machines, with a fake appliance that is always configured, while the
+debug messages go to a log output that takes a while to write each
+line (like a busy syslog daemon). The same work is timed with debug
+logging off, with the output used directly, and through the
+AsyncHandler with and without rate limiting.
+
+Usage: python tools/bench_log_overhead.py [threads] [steps] [delay_ms]
+"""
+
+import logging
+import sys
+import threading
+import time
+import uuid
+
+from oslo.config import cfg
+
+from akanda.rug import event
+from akanda.rug import main
+from akanda.rug import state
+from akanda.rug import vm_manager
+from akanda.rug.openstack.common import log
+
+
+class FakeVM(object):
+    state = vm_manager.CONFIGURED
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def update_state(self, worker_context, silent=False):
+        return self.state
+
+
+class SlowOutput(object):
+    "A log stream that takes delay seconds to write each line."
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.lines = 0
+
+    def write(self, data):
+        time.sleep(self.delay)
+        self.lines += 1
+
+    def flush(self):
+        pass
+
+
+def make_router():
+    sm = state.Automaton(
+        router_id=str(uuid.uuid4()),
+        tenant_id=str(uuid.uuid4()),
+        delete_callback=None,
+        bandwidth_callback=None,
+        worker_context=None,
+        queue_warning_threshold=100,
+        reboot_error_threshold=5,
+    )
+    return sm
+
+
+def poll(sm, steps):
+    msg = event.Event(sm.tenant_id, sm.router_id, event.POLL, {})
+    # Each poll runs CalcAction and Alive.
+    for i in xrange(steps // 2):
+        sm.send_message(msg)
+        sm.update(None)
+
+
+def configure(mode, output):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    target = logging.StreamHandler(output)
+    target.setFormatter(logging.Formatter(
+        '%(asctime)s %(process)d %(threadName)s %(name)s %(message)s'
+    ))
+    if mode == 'off':
+        root.setLevel(logging.INFO)
+        root.addHandler(target)
+        return None
+    root.setLevel(logging.DEBUG)
+    if mode == 'sync':
+        root.addHandler(target)
+        return None
+    handler = log.AsyncHandler([target], cfg.CONF.log_queue_size)
+    if mode == 'async+ratelimit':
+        handler.addFilter(log.RateLimitFilter(
+            cfg.CONF.log_rate_limit_burst,
+            cfg.CONF.log_rate_limit_interval,
+        ))
+    root.addHandler(handler)
+    return handler
+
+
+def run(mode, num_threads, steps, delay):
+    output = SlowOutput(delay)
+    handler = configure(mode, output)
+    routers = [make_router() for i in xrange(num_threads)]
+    threads = [
+        threading.Thread(target=poll, args=(sm, steps))
+        for sm in routers
+    ]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    dropped = 0
+    if handler is not None:
+        handler.close()
+        dropped = handler.dropped
+    return elapsed, output.lines, dropped
+
+
+def main_loop(num_threads=8, steps=2000, delay_ms=0.2):
+    main.register_and_load_opts()
+    cfg.CONF([], project='akanda-rug')
+    vm_manager.VmManager = FakeVM
+
+    print '%-16s %8s %10s %12s %8s %8s' % (
+        'mode', 'steps', 'seconds', 'usec/step', 'lines', 'dropped',
+    )
+    for mode in ('off', 'sync', 'async', 'async+ratelimit'):
+        elapsed, written, dropped = run(mode, num_threads, steps,
+                                        delay_ms / 1000.0)
+        total = num_threads * steps
+        print '%-16s %8d %10.3f %12.1f %8d %8d' % (
+            mode, total, elapsed, elapsed * 1e6 / total, written, dropped,
+        )
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main_loop(*[int(a) for a in args[:2]] + [float(a) for a in args[2:]])
@@ -0,0 +1,177 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Benchmark how many metadata requests the proxy answers.
+
+A fake nova metadata server answers every request after the given
+delay, in milliseconds. The proxy is started with 1, 2 and 4 processes
+in front of it, the way the rug starts them, and clients in processes
+of their own send requests for a few hundred instances, each on a new
+connection like cloud-init does. The answers are not cached, so every
+request goes to the fake nova.
+
+Usage: python tools/bench_metadata.py [requests] [clients] [delay_ms]
+"""
+
+import multiprocessing
+import sys
+import time
+
+import eventlet
+from eventlet.green import httplib
+import eventlet.wsgi
+from oslo.config import cfg
+
+from akanda.rug import metadata
+from akanda.rug import stats
+
+NOVA_PORT = 18775
+PROXY_PORT = 19697
+INSTANCES = 200
+PATHS = ['/latest/meta-data/', '/latest/meta-data/hostname',
+         '/latest/meta-data/public-keys/', '/latest/user-data']
+
+
+class NullLog(object):
+    def write(self, msg):
+        pass
+
+
+def fake_nova(delay):
+    def app(environ, start_response):
+        if delay:
+            eventlet.sleep(delay)
+        body = '%s %s' % (environ['HTTP_X_INSTANCE_ID'],
+                          environ['PATH_INFO'])
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+    sock = eventlet.listen(('127.0.0.1', NOVA_PORT), backlog=1024)
+    eventlet.wsgi.server(sock, app, log=NullLog(),
+                         custom_pool=eventlet.GreenPool(10000))
+
+
+def client(count, concurrency, offset, result):
+    "Send the requests and put their latencies on the result queue."
+    latencies = []
+    errors = [0]
+
+    def get(i):
+        instance_id = 'i-%d' % ((offset + i) % INSTANCES)
+        start = time.time()
+        try:
+            conn = httplib.HTTPConnection('::1', PROXY_PORT, timeout=30)
+            conn.request('GET', PATHS[i % len(PATHS)],
+                         headers={'X-Instance-ID': instance_id,
+                                  'X-Tenant-ID': 'tenant'})
+            resp = conn.getresponse()
+            resp.read()
+            conn.close()
+            if resp.status != 200:
+                errors[0] += 1
+        except Exception:
+            errors[0] += 1
+        latencies.append(time.time() - start)
+
+    pool = eventlet.GreenPool(concurrency)
+    for i in xrange(count):
+        pool.spawn_n(get, i)
+    pool.waitall()
+    result.put((latencies, errors[0]))
+
+
+def wait_for(port, host='::1'):
+    for i in xrange(100):
+        try:
+            conn = httplib.HTTPConnection(host, port, timeout=1)
+            conn.request('GET', '/', headers={'X-Instance-ID': 'i-0',
+                                              'X-Tenant-ID': 'tenant'})
+            conn.getresponse().read()
+            return
+        except Exception:
+            time.sleep(0.1)
+    raise RuntimeError('nothing listening on %s' % port)
+
+
+def run(workers, count, clients, concurrency):
+    procs = metadata.ProxyProcesses('::1', workers, port=PROXY_PORT)
+    procs.start()
+    try:
+        wait_for(PROXY_PORT)
+        result = multiprocessing.Queue()
+        client_procs = [
+            multiprocessing.Process(
+                target=client,
+                args=(count // clients, concurrency, i * 1000, result),
+            )
+            for i in xrange(clients)
+        ]
+        start = time.time()
+        for p in client_procs:
+            p.start()
+        latencies = []
+        errors = 0
+        for p in client_procs:
+            l, e = result.get()
+            latencies.extend(l)
+            errors += e
+        elapsed = time.time() - start
+        for p in client_procs:
+            p.join()
+    finally:
+        procs.stop()
+        # Let the port go before the next run.
+        time.sleep(0.5)
+    latencies.sort()
+    return (len(latencies) / elapsed,
+            stats.percentile(latencies, 50),
+            stats.percentile(latencies, 99),
+            errors)
+
+
+def main(count=20000, clients=2, delay_ms=2):
+    cfg.CONF.register_opts(metadata.metadata_opts)
+    cfg.CONF([], project='akanda-rug')
+    cfg.CONF.set_override('nova_metadata_ip', '127.0.0.1')
+    cfg.CONF.set_override('nova_metadata_port', NOVA_PORT)
+    cfg.CONF.set_override('neutron_metadata_proxy_shared_secret', 'secret')
+    cfg.CONF.set_override('metadata_cache_ttl', 0)
+    metadata.LOG.logger.disabled = True
+
+    nova = multiprocessing.Process(target=fake_nova,
+                                   args=(delay_ms / 1000.0,))
+    nova.start()
+    try:
+        wait_for(NOVA_PORT, host='127.0.0.1')
+        print '%d CPUs, nova answers in %d ms' % (
+            multiprocessing.cpu_count(), delay_ms)
+        print '%-10s %9s %12s %10s %10s %8s' % (
+            'processes', 'requests', 'requests/s', 'p50 ms', 'p99 ms',
+            'errors',
+        )
+        for workers in (1, 2, 4):
+            rate, p50, p99, errors = run(workers, count, clients, 200)
+            print '%-10d %9d %12.0f %10.1f %10.1f %8d' % (
+                workers, count, rate, p50 * 1000, p99 * 1000, errors,
+            )
+    finally:
+        nova.terminate()
+        nova.join()
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
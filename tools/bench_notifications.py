@@ -0,0 +1,178 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Benchmark how fast the notification listener hands events over.
+
+The messages are published to kombu's in-memory transport before the
+listener process is started, so the listener never waits for the
+broker. Like neutron, a router.update.start notification comes before
+each router.update.end, and only the second one is turned into an
+event. The events are read from the same kind of queue the rug uses,
+and are checked to still be in order for each router.
+
+The CPU time used by the listener process itself is reported too,
+since it is what limits the rate.
+
+Usage: python tools/bench_notifications.py [messages] [routers]
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+
+import kombu
+
+from akanda.rug import notifications
+
+EXCHANGE = 'neutron'
+
+
+def memory_connection(**kwargs):
+    return kombu.Connection(
+        'memory://',
+        transport_options={'polling_interval': 0},
+    )
+
+
+def make_message(tenant_id, router_id, seq, event_type):
+    context = {
+        '_context_' + k: v for k, v in [
+            ('tenant_id', tenant_id),
+            ('project_id', tenant_id),
+            ('user_id', str(uuid.uuid4())),
+            ('roles', ['admin', '_member_']),
+            ('is_admin', True),
+            ('read_deleted', 'no'),
+            ('timestamp', '2014-06-02 20:16:25.356862'),
+            ('tenant_name', 'demo'),
+            ('user_name', 'neutron'),
+            ('request_id', 'req-' + str(uuid.uuid4())),
+        ]
+    }
+    message = {
+        'event_type': event_type,
+        'priority': 'INFO',
+        'publisher_id': 'network.neutron-server',
+        'message_id': str(uuid.uuid4()),
+        'timestamp': '2014-06-02 20:16:25.412279',
+        'payload': {
+            'router': {
+                'id': router_id,
+                'tenant_id': tenant_id,
+                'name': 'router-%s' % router_id[:8],
+                'status': 'ACTIVE',
+                'admin_state_up': True,
+                'external_gateway_info': {
+                    'network_id': str(uuid.uuid4()),
+                    'enable_snat': True,
+                },
+                'routes': [
+                    {'destination': '10.%d.0.0/16' % i,
+                     'nexthop': '192.168.0.%d' % i}
+                    for i in range(8)
+                ],
+            },
+            'seq': seq,
+        },
+    }
+    message.update(context)
+    return message
+
+
+def publish(count, num_routers):
+    "Put the messages where the listener will find them."
+    routers = [(str(uuid.uuid4()), str(uuid.uuid4()))
+               for i in range(num_routers)]
+    conn = memory_connection()
+    channel = conn.channel()
+    exchange = kombu.Exchange(EXCHANGE, type='topic', durable=False)
+    queue = kombu.Queue('akanda.notifications', exchange=exchange,
+                        routing_key=notifications.NOTIFICATIONS_ROUTING_KEY,
+                        durable=False)
+    queue(channel).declare()
+    producer = kombu.Producer(channel, exchange=exchange,
+                              serializer='json')
+    for i in xrange(count):
+        router_id, tenant_id = routers[i % num_routers]
+        for event_type in ('router.update.start', 'router.update.end'):
+            producer.publish(make_message(tenant_id, router_id, i,
+                                          event_type),
+                             routing_key='notifications.info')
+
+
+def cpu_seconds(pid):
+    "Return the CPU time used by a process so far."
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime and stime are the 14th and 15th fields.
+    ticks = int(fields[11]) + int(fields[12])
+    return float(ticks) / os.sysconf('SC_CLK_TCK')
+
+
+def run(count, num_routers, prefetch_count):
+    publish(count, num_routers)
+    notification_queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(
+        target=notifications.listen,
+        args=('bench', 'memory://', EXCHANGE, 'l3_agent_fanout',
+              notification_queue),
+        kwargs={'prefetch_count': prefetch_count},
+    )
+    start = time.time()
+    proc.start()
+    last_seq = {}
+    out_of_order = 0
+    for i in xrange(count):
+        tenant_id, event = notification_queue.get()
+        seq = event.body['payload']['seq']
+        if seq < last_seq.get(event.router_id, -1):
+            out_of_order += 1
+        last_seq[event.router_id] = seq
+    elapsed = time.time() - start
+    cpu = cpu_seconds(proc.pid)
+    proc.terminate()
+    proc.join()
+    return elapsed, cpu, out_of_order
+
+
+def main(count=20000, num_routers=100):
+    notifications.kombu.connection.BrokerConnection = memory_connection
+    print '%-9s %9s %10s %12s %14s %8s' % (
+        'prefetch', 'events', 'seconds', 'messages/s', 'listener us/msg',
+        'reorder',
+    )
+    for prefetch_count in [0, 100, 500]:
+        # Each run forks a listener from a fresh copy of the broker.
+        result = multiprocessing.Queue()
+        p = multiprocessing.Process(
+            target=lambda: result.put(
+                run(count, num_routers, prefetch_count)),
+        )
+        p.start()
+        elapsed, cpu, out_of_order = result.get()
+        p.join()
+        # Two messages for each event.
+        print '%-9d %9d %10.3f %12.0f %14.0f %8d' % (
+            prefetch_count, count, elapsed, 2 * count / elapsed,
+            cpu * 1e6 / (2 * count), out_of_order,
+        )
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,135 @@
+# Copyright 2014 DreamHost, LLC
+#
+# Author: DreamHost, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+"""Soak test for the memory used by a worker under router churn.
+
+Every round creates routers for a set of new tenants, then deletes
+them all again through the real state machines, using fake API
+clients. Once the list of deleted routers is full, the worker should
+end every round holding the same amount of memory, no matter how many
+routers it has seen come and go.
+
+Usage: python tools/soak_worker_memory.py [rounds] [tenants] [routers]
+"""
+
+import gc
+import logging
+import resource
+import sys
+import uuid
+
+from oslo.config import cfg
+
+from akanda.rug import event
+from akanda.rug import main
+from akanda.rug import worker
+from akanda.rug.api import quantum
+
+
+class FakeNeutron(object):
+    def get_router_detail(self, router_id):
+        raise quantum.RouterGone(router_id)
+
+    def update_router_status(self, router_id, status):
+        pass
+
+
+class FakeNova(object):
+    def destroy_router_instance(self, router):
+        pass
+
+    def get_router_instance_status(self, router):
+        return None
+
+
+class FakeContext(object):
+    def __init__(self):
+        self.neutron = FakeNeutron()
+        self.nova_client = FakeNova()
+
+
+class FakeNotifier(object):
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def publish(self, msg):
+        pass
+
+
+def rss_kb():
+    "Current resident set size, falling back to the peak."
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def churn(w, num_tenants, num_routers):
+    msgs = []
+    for i in xrange(num_tenants):
+        tenant_id = str(uuid.uuid4())
+        for j in xrange(num_routers):
+            router_id = str(uuid.uuid4())
+            for crud in (event.CREATE, event.DELETE):
+                msgs.append(event.Event(tenant_id, router_id, crud, {}))
+    for msg in msgs:
+        w.handle_message(msg.tenant_id, msg)
+    # Run the worker loop in this thread until the queue is drained.
+    # The stop message takes its turn with the tenants, so the loop
+    # may return before everything has been processed.
+    while w.work_queue.qsize():
+        w.work_queue.put(None)
+        w._thread_target()
+
+
+def main_loop(rounds=20, num_tenants=50, num_routers=10):
+    main.register_and_load_opts()
+    cfg.CONF([], project='akanda-rug')
+    cfg.CONF.set_override('boot_timeout', 1)
+    logging.basicConfig(level=logging.WARNING)
+
+    worker.WorkerContext = FakeContext
+    w = worker.Worker(0, FakeNotifier())
+
+    print '%5s %8s %7s %7s %7s %7s %9s %9s' % (
+        'round', 'routers', 'locks', 'tenants', 'deleted', 'loggers',
+        'objects', 'rss_kb',
+    )
+    for r in xrange(1, rounds + 1):
+        churn(w, num_tenants, num_routers)
+        gc.collect()
+        print '%5d %8d %7d %7d %7d %7d %9d %9d' % (
+            r,
+            r * num_tenants * num_routers,
+            len(w._router_locks),
+            len(w.tenant_managers),
+            len(w._deleted_routers),
+            len(logging.Logger.manager.loggerDict),
+            len(gc.get_objects()),
+            rss_kb(),
+        )
+
+
+if __name__ == '__main__':
+    main_loop(*[int(a) for a in sys.argv[1:]])